@@ -0,0 +1,464 @@
+"""mossbot benchmark
+
+Replays a synthetic or recorded stream of matrix events through the
+routing, the message handler and the history backends. All outbound HTTP
+is stubbed, so only the bot itself gets measured.
+"""
+
+import json
+import logging
+import random
+import tempfile
+import time
+from collections import defaultdict
+from io import BytesIO
+from typing import Dict, Iterable, List, Tuple
+
+import click
+from logzero import loglevel
+from PIL import Image
+
+import mossbot
+
+##############################################################################
+# STUBS ######################################################################
+##############################################################################
+
+
+def gif_bytes() -> bytes:
+    """Creates a small gif"""
+    gif = BytesIO()
+    Image.new('RGBA', size=(50, 50), color=(155, 0, 0)).save(gif, 'gif')
+
+    return gif.getvalue()
+
+
+GIF = gif_bytes()
+
+PAGE = (
+    '<html><head><title>benchmark page</title></head><body>{}</body></html>'
+).format('<p>lorem ipsum</p>' * 2000).encode()
+
+
+class StubResponse(object):
+    """Canned response with the parts of requests.Response mossbot uses"""
+
+    def __init__(self, content: bytes, content_type: str) -> None:
+        self.content = content
+        self.headers = {
+            'Content-Type': content_type,
+            'Content-Length': str(len(content)),
+        }
+        self.status_code = 200
+        self.encoding = 'utf-8'
+
+    @property
+    def text(self) -> str:
+        """Decoded content"""
+        return self.content.decode()
+
+    def json(self) -> Dict:
+        """Parsed content"""
+        return json.loads(self.content.decode())
+
+    def iter_content(self, chunk_size: int = 1) -> Iterable[bytes]:
+        """Yields the content in chunks"""
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self) -> None:
+        """Stub responses never fail"""
+        pass
+
+    def close(self) -> None:
+        """Nothing to close"""
+        pass
+
+
+class StubSession(object):
+    """Answers requests of all routes without touching the network"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.requests = 0
+
+    def get(self, url: str, **kwargs) -> StubResponse:
+        """Returns a response matching the requested api"""
+        self.requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if 'api.giphy.com' in url:
+            return StubResponse(
+                json.dumps(
+                    {
+                        'data': [
+                            {
+                                'images': {
+                                    'downsized': {
+                                        'url': (
+                                            'https://media.giphy.test/'
+                                            f'{i}.gif?fingerprint=abc'
+                                        )
+                                    }
+                                }
+                            }
+                            for i in range(20)
+                        ]
+                    }
+                ).encode(),
+                'application/json'
+            )
+
+        if 'api.openweathermap.org' in url:
+            return StubResponse(
+                json.dumps(
+                    {
+                        'weather': [{'main': 'Fog'}],
+                        'main': {'temp': 20},
+                        'name': 'Wolfsburg',
+                        'cod': 200,
+                    }
+                ).encode(),
+                'application/json'
+            )
+
+        if url.split('?')[0].endswith(('.gif', '.png', '.jpg')):
+            return StubResponse(GIF, 'image/gif')
+
+        return StubResponse(PAGE, 'text/html; charset=utf-8')
+
+
+class StubClient(object):
+    """Matrix client that only counts uploads and sent msgs"""
+
+    def __init__(self) -> None:
+        self.uploads = 0
+        self.sent = 0
+        self.rooms = {}  # type: Dict[str, StubRoom]
+        self.api = self
+
+    def upload(self, content, content_type: str) -> str:
+        """Reads the content and returns a fake mxc uri"""
+        content.read()
+        self.uploads += 1
+
+        return f'mxc://bench/{self.uploads}'
+
+    def send_message_event(self, *args, **kwargs) -> None:
+        """Counts a sent msg"""
+        self.sent += 1
+
+
+class StubRoom(object):
+    """Room with nothing but its id"""
+
+    def __init__(self, room_id: str) -> None:
+        self.room_id = room_id
+
+
+##############################################################################
+# EVENTS #####################################################################
+##############################################################################
+
+
+WORDS = (
+    'moss roy jen richmond douglas fire printer internet reynholm '
+    'basement server coffee monday friday lunch meeting'
+).split()
+
+
+def synthetic_events(
+        count: int,
+        rooms: int,
+        senders: int,
+        urls: int,
+        seed: int = 23,
+) -> List[Dict]:
+    """Creates a stream of msgs with a typical mix of chatter and commands
+
+    :param count: number of events
+    :param rooms: number of rooms
+    :param senders: number of senders
+    :param urls: number of distinct urls and images
+    :param seed: random seed
+    :returns: list of events
+    """
+    rand = random.Random(seed)
+
+    def chatter() -> str:
+        return ' '.join(rand.choice(WORDS) for _ in range(rand.randint(3, 12)))
+
+    bodies = (
+        (70, chatter),
+        (10, lambda: f'look at https://link{rand.randrange(urls)}.test/page'),
+        (3, lambda: f'https://img{rand.randrange(urls)}.test/image.gif'),
+        (3, lambda: f'!reaction {rand.choice(WORDS)}'),
+        (3, lambda: f'!weather {rand.choice(WORDS)}'),
+        (3, lambda: '!ping'),
+        (8, lambda: f's/{rand.choice(WORDS)}/{rand.choice(WORDS)}'),
+    )
+
+    weights = [weight for weight, _ in bodies]
+    makers = [maker for _, maker in bodies]
+
+    return [
+        {
+            'type': 'm.room.message',
+            'event_id': f'$bench{i}',
+            'room_id': f'!room{rand.randrange(rooms)}:bench',
+            'sender': f'@user{rand.randrange(senders)}:bench',
+            'content': {
+                'msgtype': 'm.text',
+                'body': rand.choices(makers, weights)[0](),
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def recorded_events(path: str) -> List[Dict]:
+    """Reads msg events from a file with one JSON event per line
+
+    :param path: events file
+    :returns: list of events
+    """
+    events = []
+
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            event = json.loads(line)
+            if isinstance(event.get('content', {}).get('body'), str):
+                events.append(event)
+
+    return events
+
+
+##############################################################################
+# MEASURING ##################################################################
+##############################################################################
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+
+    index = max(0, int(round(percent / 100 * len(values) + 0.5)) - 1)
+
+    return values[min(index, len(values) - 1)]
+
+
+def route_name(body: str) -> str:
+    """Name of the route a msg triggers"""
+    matched = mossbot.MOSS.match(body)
+
+    return matched[0].func.__name__ if matched else 'no match'
+
+
+def report(title: str, timings: Dict[str, List[float]]) -> None:
+    """Prints throughput and latencies per route
+
+    :param title: name of the measurement
+    :param timings: seconds per event by route name
+    """
+    total = sum(len(values) for values in timings.values())
+    seconds = sum(sum(values) for values in timings.values())
+
+    click.echo(
+        f'\n{title}: {total} msgs in {seconds:.3f}s, '
+        f'{total / seconds if seconds else 0:.0f} msgs/s'
+    )
+    click.echo(f'  {"route":<14}{"count":>8}{"p50 us":>12}{"p99 us":>12}')
+
+    for name, values in sorted(timings.items()):
+        values.sort()
+        click.echo(
+            f'  {name:<14}{len(values):>8}'
+            f'{percentile(values, 50) * 1e6:>12.1f}'
+            f'{percentile(values, 99) * 1e6:>12.1f}'
+        )
+
+
+def bench_dispatch(events: List[Dict]) -> Dict[str, List[float]]:
+    """Times MOSS.match for every msg"""
+    timings = defaultdict(list)  # type: Dict[str, List[float]]
+
+    for event in events:
+        body = event['content']['body']
+
+        start = time.perf_counter()
+        matched = mossbot.MOSS.match(body)
+        elapsed = time.perf_counter() - start
+
+        name = matched[0].func.__name__ if matched else 'no match'
+        timings[name].append(elapsed)
+
+    return timings
+
+
+def bench_handler(
+        events: List[Dict],
+        config: Dict,
+) -> Tuple[Dict[str, List[float]], StubClient, Dict[str, StubRoom]]:
+    """Times MatrixHandler.on_message for every event
+
+    Routes run inline, so the time includes storing, routing and the
+    stubbed HTTP calls. Replies are only queued, sending them happens in
+    the background.
+    """
+    handler = mossbot.MatrixHandler(config)
+    client = StubClient()
+    handler.client = client
+
+    rooms = {}  # type: Dict[str, StubRoom]
+    timings = defaultdict(list)  # type: Dict[str, List[float]]
+
+    for event in events:
+        event = json.loads(json.dumps(event))
+        room = rooms.setdefault(event['room_id'], StubRoom(event['room_id']))
+        name = route_name(event['content']['body'])
+
+        start = time.perf_counter()
+        handler.on_message(room, event)
+        timings[name].append(time.perf_counter() - start)
+
+    handler.outbox.flush()
+
+    return timings, client, rooms
+
+
+def bench_history(
+        backend: str,
+        senders: int,
+        directory: str,
+        samples: int = 200,
+) -> Dict[str, List[float]]:
+    """Times store and replace lookups with a prefilled history
+
+    :param backend: history backend name
+    :param senders: number of senders with a full history
+    :param directory: directory for the history files
+    :param samples: timed operations per measurement
+    """
+    history = mossbot.get_history(
+        {
+            'history_backend': backend,
+            'history_path': f'{directory}/{backend}-{senders}',
+        }
+    )
+
+    for number in range(senders):
+        for i in range(history.limit):
+            history.store('!room:bench', f'@user{number}:bench', f'msg {i}')
+
+    rand = random.Random(senders)
+    picks = [f'@user{rand.randrange(senders)}:bench' for _ in range(samples)]
+    timings = defaultdict(list)  # type: Dict[str, List[float]]
+
+    for sender in picks:
+        start = time.perf_counter()
+        history.store('!room:bench', sender, 'one more msg')
+        timings['store'].append(time.perf_counter() - start)
+
+    # cold lookups load the sender from the history backend
+    recent = mossbot.RecentMessages(history)
+    for sender in picks:
+        recent.msgs.clear()
+
+        start = time.perf_counter()
+        recent.last('!room:bench', sender)
+        timings['replace cold'].append(time.perf_counter() - start)
+
+    for sender in picks:
+        recent.last('!room:bench', sender)
+
+    for sender in picks:
+        start = time.perf_counter()
+        recent.last('!room:bench', sender)
+        timings['replace warm'].append(time.perf_counter() - start)
+
+    return timings
+
+
+##############################################################################
+# USER INTERFACE #############################################################
+##############################################################################
+
+
+@click.command()
+@click.option('--events', default=10000, help='number of synthetic events')
+@click.option('--rooms', default=20, help='number of synthetic rooms')
+@click.option('--senders', default=200, help='number of synthetic senders')
+@click.option('--urls', default=50, help='number of distinct urls')
+@click.option(
+    '--events-file',
+    type=click.Path(exists=True, dir_okay=False),
+    help='recorded events, one JSON event per line'
+)
+@click.option(
+    '--history-sizes',
+    default='100,1000',
+    help='comma separated numbers of senders in the history'
+)
+@click.option('--latency', default=0.0, help='stubbed HTTP latency in ms')
+def main(
+        events: int,
+        rooms: int,
+        senders: int,
+        urls: int,
+        events_file: str,
+        history_sizes: str,
+        latency: float,
+) -> None:
+    """Benchmarks routing, msg handling and history backends"""
+    loglevel(logging.ERROR)
+
+    session = StubSession(latency / 1000)
+    mossbot.HTTP.session = session
+
+    if events_file:
+        stream = recorded_events(events_file)
+    else:
+        stream = synthetic_events(events, rooms, senders, urls)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        report('dispatch (MOSS.match)', bench_dispatch(stream))
+
+        timings, client, _ = bench_handler(
+            stream,
+            {
+                'hostname': 'https://bench',
+                'username': 'bench',
+                'password': '',
+                'uid': '@bench:bench',
+                'giphy_api_key': 'bench',
+                'openweathermap_api_key': 'bench',
+                'history_path': f'{directory}/db.sqlite',
+                'session_path': None,
+                'workers': 0,
+            }
+        )
+        report('handler (MatrixHandler.on_message)', timings)
+        click.echo(
+            f'  http requests: {session.requests}, '
+            f'uploads: {client.uploads}, '
+            f'sent msgs: {client.sent}'
+        )
+
+        for backend in ('sqlite', 'memory'):
+            for size in history_sizes.split(','):
+                report(
+                    f'history {backend} with {size} senders',
+                    bench_history(backend, int(size), directory)
+                )
+
+
+if __name__ == '__main__':
+    # pylint: disable=no-value-for-parameter
+    main()
@@ -6,13 +6,22 @@ from unittest import mock
 import pytest
 from matrix_client.room import Room
 from PIL import Image
-from tinydb import TinyDB
 
 import mossbot
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    mossbot.URL_TITLES.clear()
+    mossbot.MEDIA.clear()
+    mossbot.WEATHER.clear()
+    mossbot.METRICS.clear()
+    mossbot.MOSS.buckets.clear()
+
+
 @pytest.fixture
-def config():
+def config(tmpdir):
     return {
         'username': 'foo',
         'password': 'bar',
@@ -20,21 +29,19 @@ def config():
         'uid': '@foo:bar.tld',
         'giphy_api_key': 'f00b4r',
         'openweathermap_api_key': 'b4rf00',
+        'history_path': tmpdir.join('db.sqlite').strpath,
+        'session_path': tmpdir.join('session.json').strpath,
+        'workers': 0,
     }
 
 
 @pytest.fixture
-def db(tmpdir):
-    yield TinyDB(tmpdir.join('db.json').strpath)
+def history(tmpdir):
+    yield mossbot.SQLiteHistory(tmpdir.join('db.sqlite').strpath)
 
 
 @pytest.fixture
-def matrix_handler(config, monkeypatch, tmpdir):
-
-    monkeypatch.setattr(
-        'mossbot.get_db',
-        lambda: TinyDB(tmpdir.join('db.json').strpath)
-    )
+def matrix_handler(config):
 
     m = mossbot.MatrixHandler(config)
     m.client = mock.Mock()
@@ -44,7 +51,10 @@ def matrix_handler(config, monkeypatch, tmpdir):
 
 @pytest.fixture
 def room():
-    yield mock.Mock(spec=Room)
+    r = mock.Mock(spec=Room)
+    r.room_id = '!room:foo.tld'
+
+    yield r
 
 
 @pytest.fixture
@@ -4,7 +4,6 @@ import os
 import sys
 
 import docker
-from tinydb import TinyDB
 
 client = docker.from_env()
 
@@ -34,29 +33,28 @@ if not os.path.exists('/opt/mossbot'):
     print('creating data directory...')
     os.makedirs('/opt/mossbot')
 
-# init db if not there
-if not os.path.exists('/opt/mossbot/db.json'):
-    print('init db...')
-    TinyDB('/opt/mossbot/db.json')
-
+# the bot keeps history, session, seen events and journals next to the
+# config, the whole directory gets mounted so they survive a deploy
 print('fixing permissions...')
-os.chown('/opt/mossbot/db.json', 1000, 1000)
+os.chown('/opt/mossbot', 1000, 1000)
+for name in os.listdir('/opt/mossbot'):
+    if name != 'config.yml':
+        os.chown(os.path.join('/opt/mossbot', name), 1000, 1000)
 
 print('starting mossbot...')
 client.containers.run(
     'xsteadfastx/mossbot',
     auto_remove=False,
     detach=True,
+    command=['su-exec', 'mossbot', 'python', '/app/mossbot.py', 'config.yml'],
     volumes={
-        '/opt/mossbot/config.yml': {
-            'bind': '/app/config.yml',
-            'mode': 'ro'
-        },
-        '/opt/mossbot/db.json': {
-            'bind': '/app/db.json',
+        '/opt/mossbot': {
+            'bind': '/data',
         }
     },
+    working_dir='/data',
     name='mossbot',
+    restart_policy={'Name': 'unless-stopped'},
 )
 try:
     client.containers.get('mossbot')
@@ -1,27 +1,139 @@
 """mossbot"""
 
+import abc
+import bisect
+import codecs
+import hashlib
+import importlib
+import inspect
+import json
 import logging
+import math
 import mimetypes
+import os
+import queue
 import random
 import re
+import sqlite3
 import sys
+import threading
 import time
-from collections import OrderedDict
-from io import BytesIO
-from multiprocessing import Process
-from typing import Callable, Dict, NamedTuple, Union
+import unicodedata
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from multiprocessing import Event, Pipe, Process
+from multiprocessing.connection import Connection, wait
+from tempfile import SpooledTemporaryFile
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    NamedTuple,
+    Pattern,
+    Tuple,
+    Union,
+)
 from urllib.parse import quote_plus, urlsplit
 
 import click
-import pendulum
-import requests
-import yaml
-from bs4 import BeautifulSoup
 from logzero import logger, loglevel
-from matrix_client.client import MatrixClient
-from matrix_client.room import Room
-from PIL import Image
-from tinydb import Query, TinyDB
+from matrix_client.errors import MatrixRequestError
+
+try:
+    from re import _parser as sre_parse  # type: ignore
+except ImportError:  # pragma: no cover
+    import sre_parse
+
+##############################################################################
+# LAZY IMPORTS ###############################################################
+##############################################################################
+
+
+# startup stages with their duration in seconds and nesting depth
+STARTUP = []  # type: List[Tuple[str, float, int]]
+
+STARTUP_BEGIN = time.perf_counter()
+
+STARTUP_DEPTH = 0
+
+
+@contextmanager
+def startup_stage(name: str) -> Iterator[None]:
+    """Records the duration of a startup stage for the startup report"""
+    # pylint: disable=global-statement
+    global STARTUP_DEPTH
+
+    index = len(STARTUP)
+    depth = STARTUP_DEPTH
+    STARTUP.append((name, 0.0, depth))
+
+    STARTUP_DEPTH += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP[index] = (name, time.perf_counter() - start, depth)
+        STARTUP_DEPTH = depth
+
+
+class LazyModule(object):
+    """Module that gets imported on first attribute access
+
+    Keeps dependencies that only some routes and subsystems need out of
+    the startup path. The import shows up in the startup report.
+    """
+
+    __slots__ = ['module', 'name']
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.module = None  # type: Any
+        LAZY_MODULES.append(self)
+
+    def resolve(self) -> Any:
+        """Imports the module if it is not imported yet"""
+        if self.module is None:
+            with startup_stage(f'import {self.name}'):
+                self.module = importlib.import_module(self.name)
+
+        return self.module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.resolve(), attr)
+
+
+# all lazy modules, loaded by the startup report
+LAZY_MODULES = []  # type: List[LazyModule]
+
+if TYPE_CHECKING:  # pragma: no cover
+    # dependencies of only some routes and subsystems
+    import asyncio  # noqa: I300
+    import http.server as http_server
+
+    import matrix_client.client as matrix_client
+    import requests
+    import requests.adapters
+    import urllib3
+    import yaml
+    from matrix_client.room import Room
+    from PIL import Image, ImageFile
+else:
+    asyncio = LazyModule('asyncio')
+    http_server = LazyModule('http.server')
+    matrix_client = LazyModule('matrix_client.client')
+    requests = LazyModule('requests')
+    urllib3 = LazyModule('urllib3')
+    yaml = LazyModule('yaml')
+    Image = LazyModule('PIL.Image')
+    ImageFile = LazyModule('PIL.ImageFile')
 
 ##############################################################################
 # TYPES and CONSTANTS #########################################################
@@ -40,318 +152,3028 @@ MSG_RETURN = NamedTuple(
 # type for route functions
 ROUTE_TYPE = Callable[[Union[str, None], Union[str, None], Dict], MSG_RETURN]
 
+# how many msgs per sender and room are kept for search and replace
+HISTORY_LIMIT = 10
+
+# msg in the history, room and sender are interned
+HISTORY_MSG = NamedTuple(
+    'HISTORY_MSG',
+    [
+        ('room_id', str),
+        ('sender', str),
+        ('body', str),
+    ]
+)
+
+# bytes of a page that are read at most to find its title
+TITLE_MAX_BYTES = 256 * 1024
+
+# how many urls of a msg get their title looked up
+TITLE_MAX_URLS = 5
+
+# urls in msgs, with and without a scheme
+URL_PATTERN = (
+    r'(?i)(?P<route>\b((?:https?://|www\d{0,3}[.]'
+    r'|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|'
+    r'\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+'
+    r'(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)'
+    r'|[^\s`!()\[\]{};:\'\".,<>?'
+    r'\xab\xbb\u201c\u201d\u2018\u2019])))'
+)
+URLS = re.compile(URL_PATTERN)
+
+# content types that are parsed for a title
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+
+# biggest image that gets downloaded and uploaded
+MEDIA_MAX_BYTES = 10 * 1024 * 1024
+
+# images bigger than this are spooled to a temporary file
+MEDIA_SPOOL_BYTES = 1024 * 1024
+
+# entry point group of plugins with a list of routes
+PLUGIN_GROUP = 'mossbot.plugins'
+
+# msgs that are search and replace commands themselves
+SUBSTITUTION = re.compile(r'^s/.+/.+$')
+
 # dict to store routes and its functions
 ROUTES_TYPE = Dict[str, ROUTE_TYPE]
 
+# compiled route with the literals a message needs to be a candidate
+COMPILED_ROUTE = NamedTuple(
+    'COMPILED_ROUTE',
+    [
+        ('regex', Pattern),
+        ('anchored', bool),
+        ('prefixes', Tuple[str, ...]),
+        ('priority', int),
+        ('func', ROUTE_TYPE),
+    ]
+)
+
 
 ##############################################################################
-# HELPER FUNCTIONS ###########################################################
+# METRICS ####################################################################
 ##############################################################################
 
 
-def get_db() -> TinyDB:
-    """Creates database"""
-    return TinyDB('db.json')
+# upper bounds of the histogram buckets in seconds
+METRIC_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0,
+)
+
+# help texts of the known metrics
+METRIC_HELP = {
+    'mossbot_events_total': 'Msg events received per room',
+    'mossbot_events_replayed_total': 'Msg events skipped as seen before',
+    'mossbot_route_match_seconds': 'Time to find the matching route',
+    'mossbot_route_handler_seconds': 'Wall time of route handlers',
+    'mossbot_http_request_seconds': 'Outbound HTTP latency per host',
+    'mossbot_http_errors_total': 'Failed outbound HTTP requests per host',
+    'mossbot_upload_bytes_total': 'Bytes uploaded to the homeserver',
+    'mossbot_history_store_seconds': 'Time to store a msg in the history',
+    'mossbot_history_flush_seconds': 'Time to store a batch of msgs',
+    'mossbot_sync_seconds': 'Duration of a sync loop iteration',
+    'mossbot_send_retries_total': 'Retried outbound msgs by reason',
+    'mossbot_send_dropped_total': 'Outbound msgs given up on',
+    'mossbot_throttled_total': 'Route calls over a rate limit',
+}
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Formats labels for the prometheus text format"""
+    if not labels:
+        return ''
+
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for k, v in labels
+    )
+
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
 
 
-def get_giphy_reaction_url(api_key: str, term: str) -> Union[str, None]:
-    """Gets a random giphy gif and returns url
+class Metrics(object):
+    """Counters and histograms in the prometheus text format
 
-    :param api_key: GIPHY api key
-    :param term: search term
-    :returns: gif url
+    Recording is a dict update, the metrics can be served over HTTP with
+    ``serve`` or written to a file with ``dump``.
     """
-    term = quote_plus(term)
 
-    url = (
-        f'http://api.giphy.com/v1/gifs/search'
-        f'?api_key={api_key}'
-        f'&q={term}'
-        f'&limit=20'
-    )
+    __slots__ = ['buckets', 'counters', 'histograms', 'lock']
 
-    try:
-        r = requests.get(url)
+    def __init__(self, buckets: Tuple[float, ...] = METRIC_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counters = {}  # type: Dict[str, Dict[Tuple, float]]
+        self.histograms = {}  # type: Dict[str, Dict[Tuple, List]]
+        self.lock = threading.Lock()
 
-        if 'data' in r.json().keys() and len(r.json()['data']) >= 1:
-            random_gif = random.choice(r.json()['data'])
-            gif_url = random_gif['images']['downsized']['url']
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        """Increases a counter
 
-            return gif_url.split('?')[0]
+        :param name: metric name
+        :param value: amount to add
+        """
+        key = tuple(sorted(labels.items()))
 
-        logger.error('could not get reaction video url')
-        return None
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
 
-    except BaseException as e:
-        logger.exception('could not get giphy data: %s', e)
-        return None
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Adds a value to a histogram
 
+        :param name: metric name
+        :param value: observed value
+        """
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                # bucket counts, sum and count
+                histogram = series[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Observes the wall time of a block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        """Returns all metrics in the prometheus text format"""
+        lines = []  # type: List[str]
+
+        with self.lock:
+
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{format_labels(key)} {value}')
+
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, (counts, total, count) in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, bucket in zip(self.buckets, counts):
+                        cumulative += bucket
+                        labels = format_labels(key + (('le', str(bound)), ))
+                        lines.append(f'{name}_bucket{labels} {cumulative}')
+
+                    labels = format_labels(key + (('le', '+Inf'), ))
+                    lines.append(f'{name}_bucket{labels} {count}')
+                    lines.append(f'{name}_sum{format_labels(key)} {total}')
+                    lines.append(f'{name}_count{format_labels(key)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str) -> None:
+        """Writes all metrics to a file"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(
+            self,
+            port: int,
+            host: str = '127.0.0.1',
+    ) -> 'http_server.HTTPServer':
+        """Serves the metrics over HTTP in a daemon thread
+
+        :param port: port to listen on
+        :param host: address to listen on
+        :returns: the running server
+        """
+        metrics = self
 
-def get_image(
-        url: str
-) -> Union[Dict[str, Union[int, str, BytesIO, None]], None]:
-    """Downloads image and analyzes it
+        class MetricsHandler(http_server.BaseHTTPRequestHandler):
+            """Answers every GET with the metrics"""
 
-    :param url: image url
-    :returns: dictionary with image and meta data
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type',
+                    'text/plain; version=0.0.4; charset=utf-8'
+                )
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        server = http_server.HTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info('serving metrics on %s:%s', host, server.server_port)
+
+        return server
+
+    def clear(self) -> None:
+        """Drops all recorded values"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+METRICS = Metrics()
+
+
+##############################################################################
+# HTTP CLIENT ################################################################
+##############################################################################
+
+
+class HTTPClient(object):
+    """Pooled HTTP session shared by all routes
+
+    Keeps connections to every host alive between requests, applies
+    connect and read timeouts and retries failed requests with backoff.
+    The session is created on first use and again in a forked process,
+    so importing mossbot does not import requests and processes do not
+    share connections.
     """
-    try:
-        logger.info('downloading image: %s', url)
-        r = requests.get(url)
 
-        if r.status_code == 200:
+    __slots__ = ['config', 'pid', 'session', 'timeout']
 
-            # loading binary data to mem
-            img = BytesIO(r.content)
+    def __init__(self) -> None:
+        self.config = {}  # type: Dict
+        self.pid = None  # type: Union[int, None]
+        self.session = None  # type: Union[requests.Session, None]
+        self.timeout = (3.05, 10.0)  # type: Tuple[float, float]
 
-            # loading image to PIL
-            pil_img = Image.open(img)
+    def configure(self, config: Dict) -> 'requests.Session':
+        """Creates the session from the bot config
 
-            # seek to 0
-            img.seek(0)
+        :param config: bot config
+        :returns: the new session
+        """
+        self.config = config
+        self.timeout = (
+            config.get('http_connect_timeout', 3.05),
+            config.get('http_read_timeout', 10.0),
+        )
 
-            return {
-                'content-type': r.headers.get('Content-Type'),
-                'image': img,
-                'width': pil_img.width,
-                'height': pil_img.height,
-            }
+        retry = urllib3.util.retry.Retry(
+            total=config.get('http_retries', 2),
+            backoff_factor=config.get('http_backoff', 0.5),
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+            # a long Retry-After would block a worker for that long, the
+            # backoff applies instead
+            respect_retry_after_header=False,
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=config.get('http_pool_hosts', 10),
+            pool_maxsize=config.get('http_pool_size', 10),
+            max_retries=retry,
+        )
 
-        raise Exception('wrong status code %s', r.status_code)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
 
-    except BaseException as e:
-        logger.error('could not download and analyze img: %s', str(e))
+        # the connections of a forked session belong to the parent
+        if self.session is not None and self.pid == os.getpid():
+            self.session.close()
+        self.session = session
+        self.pid = os.getpid()
 
-        return None
+        return session
+
+    def get(self, url: str, **kwargs) -> 'requests.Response':
+        """GET request with the default timeouts
+
+        :param url: url to get
+        :returns: response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).hostname or ''
+
+        try:
+            session = self.session
+            if session is None or self.pid != os.getpid():
+                session = self.configure(self.config)
+
+            with METRICS.timer('mossbot_http_request_seconds', host=host):
+                return session.get(url, **kwargs)
+
+        except requests.RequestException:
+            METRICS.inc('mossbot_http_errors_total', host=host)
+            raise
+
+
+HTTP = HTTPClient()
+
+
+class FetchPool(object):
+    """Bounded thread pool for the outbound requests of a msg
+
+    The threads are started on first use and again in a forked process,
+    a single request runs in the calling thread.
+    """
+
+    __slots__ = ['executor', 'lock', 'pid', 'workers']
+
+    def __init__(self, workers: int = 4) -> None:
+        self.workers = workers
+        self.executor = None  # type: Union[ThreadPoolExecutor, None]
+        self.pid = None  # type: Union[int, None]
+        self.lock = threading.Lock()
+
+    def configure(self, config: Dict) -> None:
+        """Sets the pool size from the bot config
+
+        :param config: bot config
+        """
+        with self.lock:
+            self.workers = config.get('http_fetch_workers', 4)
+
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def map(self, func: Callable, items: List) -> List:
+        """Calls a function for every item on the pool
+
+        :param func: function to call
+        :param items: arguments for the calls
+        :returns: results in the order of the items
+        """
+        if len(items) < 2 or self.workers < 2:
+            return [func(item) for item in items]
+
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.pid = os.getpid()
+
+            executor = self.executor
+
+        return list(executor.map(func, items))
+
+
+FETCHES = FetchPool()
 
 
 ##############################################################################
-# MOSSBOT LOGIC ##############################################################
+# CACHES #####################################################################
 ##############################################################################
 
 
-class MossBot(object):
-    """Bot routing logic"""
+# returned by caches for keys without a valid entry
+MISSING = object()
 
-    __slots__ = ['routes']
 
-    def __init__(self) -> None:
-        # stores all routes and its functions
-        self.routes = OrderedDict()  # type: ROUTES_TYPE
+class TTLCache(object):
+    """Bounded LRU cache with expiring entries
+
+    A value of ``None`` marks a failed lookup and expires after
+    ``negative_ttl``. With a ``path`` the entries are written to a JSON
+    file at most every ``save_interval`` seconds and read back on first
+    use, so they survive a restart of the sync process.
+    """
 
-    def route(self, route: str) -> Callable:
-        """Decorator to save routes to a dictionary"""
+    __slots__ = [
+        'changed',
+        'data',
+        'last_save',
+        'lock',
+        'maxsize',
+        'negative_ttl',
+        'path',
+        'save_interval',
+        'ttl',
+    ]
 
-        def decorator(f: Callable) -> Callable:
-            """Decorates the function."""
-            self.routes[route] = f
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttl: float = 3600.0,
+            negative_ttl: float = 300.0,
+            path: Union[str, None] = None,
+            save_interval: float = 60.0,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self.save_interval = save_interval
+        self.data = None  # type: Union[OrderedDict, None]
+        self.last_save = 0.0
+        # entries were set since the last save
+        self.changed = False
+        self.lock = threading.RLock()
+
+    def load(self) -> OrderedDict:
+        """Returns the entries, reads the file on first use"""
+        if self.data is None:
+            self.data = OrderedDict()
+            self.last_save = time.monotonic()
+
+            if self.path:
+                try:
+                    with open(self.path) as f:
+                        entries = json.load(f)
+
+                    now = time.time()
+                    for key, expires, value in entries:
+                        if expires > now:
+                            key = tuple(key) if isinstance(key, list) else key
+                            self.data[key] = (expires, value)
+
+                except FileNotFoundError:
+                    logger.info('no cache file %s', self.path)
+
+                except ValueError:
+                    logger.exception('could not read cache %s', self.path)
+
+        return self.data
+
+    def save(self) -> None:
+        """Writes the valid entries to the cache file if entries were set"""
+        if not self.path or not self.changed:
+            return
 
-            return f
+        with self.lock:
+            now = time.time()
+            entries = [
+                [key, expires, value]
+                for key, (expires, value) in self.load().items()
+                if expires > now
+            ]
 
-        return decorator
+            write_json(self.path, entries)
 
-    def serve(self, event: Dict) -> Union[MSG_RETURN, None]:
-        """Returns the right function for matching route
+            self.last_save = time.monotonic()
+            self.changed = False
 
-        :param event: Event json object
-        :returns: Matched function from route
+    def get(self, key, default=MISSING):
+        """Returns a valid entry and marks it as recently used"""
+        with self.lock:
+            data = self.load()
+            entry = data.get(key)
+
+            if entry is None:
+                return default
+
+            if entry[0] <= time.time():
+                del data[key]
+                return default
+
+            data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl: Union[float, None] = None):
+        """Stores a value, ``None`` gets the negative ttl
+
+        :param ttl: seconds to keep this entry instead of the default
+        :returns: the stored value
         """
-        raw_msg = event['content']['body']
-        for k in self.routes.keys():
-            m = re.search(k, raw_msg, re.IGNORECASE)
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+
+        with self.lock:
+            data = self.load()
+            data[key] = (time.time() + ttl, value)
+            data.move_to_end(key)
+            self.changed = True
+
+            while len(data) > self.maxsize:
+                data.popitem(last=False)
+
+            if self.path and \
+                    time.monotonic() - self.last_save >= self.save_interval:
+                self.save()
+
+        return value
+
+    def clear(self) -> None:
+        """Drops all entries"""
+        with self.lock:
+            self.data = OrderedDict()
 
-            if m:
 
-                matches = m.groupdict()
-                route = matches.get('route')
-                msg = matches.get('msg')
+class SQLiteCache(object):
+    """Cache like TTLCache with its entries in a SQLite table
 
-                func = self.routes.get(k)
+    All processes using the same file share the entries, the shards of
+    a bot look up url titles and uploads there. Keys and values are
+    stored as JSON, the least recently used entries beyond ``maxsize``
+    get removed every ``prune_interval`` writes.
+    """
 
-                if func:
+    __slots__ = [
+        'conn',
+        'lock',
+        'maxsize',
+        'negative_ttl',
+        'path',
+        'pid',
+        'prune_interval',
+        'table',
+        'ttl',
+        'writes',
+    ]
 
-                    logger.info(
-                        (
-                            'matched route %s '
-                            'with msg %s '
-                            'from %s '
-                            'and triggered "%s"'
-                        ),
-                        route, msg, raw_msg, func.__name__
+    def __init__(
+            self,
+            path: str,
+            table: str,
+            maxsize: int = 1024,
+            ttl: float = 3600.0,
+            negative_ttl: float = 300.0,
+            prune_interval: int = 64,
+    ) -> None:
+        self.path = path
+        self.table = table
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prune_interval = prune_interval
+        self.conn = None  # type: Union[sqlite3.Connection, None]
+        self.pid = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens the database once per process"""
+        if self.conn is None or self.pid != os.getpid():
+            logger.info('open cache db %s', self.path)
+            conn = sqlite3.connect(
+                self.path,
+                timeout=30,
+                check_same_thread=False,
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, '
+                'expires REAL NOT NULL, '
+                'used REAL NOT NULL, '
+                'value TEXT NOT NULL)'
+            )
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_used '
+                f'ON {self.table} (used)'
+            )
+            conn.commit()
+            self.conn = conn
+            self.pid = os.getpid()
+
+        return self.conn
+
+    def get(self, key, default=MISSING):
+        """Returns a valid entry and marks it as recently used"""
+        key = json.dumps(key)
+        now = time.time()
+
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute(
+                f'SELECT expires, value FROM {self.table} WHERE key = ?',
+                (key, )
+            ).fetchone()
+
+            if row is None:
+                return default
+
+            with conn:
+                if row[0] <= now:
+                    conn.execute(
+                        f'DELETE FROM {self.table} WHERE key = ?',
+                        (key, )
                     )
+                    return default
 
-                    return func(route, msg, event)
+                conn.execute(
+                    f'UPDATE {self.table} SET used = ? WHERE key = ?',
+                    (now, key)
+                )
 
-        return None
+        return json.loads(row[1])
 
+    def set(self, key, value, ttl: Union[float, None] = None):
+        """Stores a value, ``None`` gets the negative ttl
+
+        :param ttl: seconds to keep this entry instead of the default
+        :returns: the stored value
+        """
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        now = time.time()
+
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO {self.table} '
+                    '(key, expires, used, value) VALUES (?, ?, ?, ?)',
+                    (json.dumps(key), now + ttl, now, json.dumps(value))
+                )
+
+                self.writes += 1
+                if self.writes % self.prune_interval == 0:
+                    conn.execute(
+                        f'DELETE FROM {self.table} WHERE expires <= ?',
+                        (now, )
+                    )
+                    conn.execute(
+                        f'DELETE FROM {self.table} WHERE key IN ('
+                        f'SELECT key FROM {self.table} '
+                        'ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                        (self.maxsize, )
+                    )
+
+        return value
+
+    def clear(self) -> None:
+        """Drops all entries"""
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute(f'DELETE FROM {self.table}')
+
+
+class SingleFlight(object):
+    """Runs a function only once at a time per key
+
+    Callers that ask for a key while its call is running wait for that
+    call and get its result or exception, instead of calling again.
+    """
+
+    __slots__ = ['calls', 'lock']
+
+    def __init__(self) -> None:
+        self.calls = {}  # type: Dict[Any, List]
+        self.lock = threading.Lock()
+
+    def do(self, key, func: Callable, *args):
+        """Calls ``func(*args)`` or waits for the running call of the key
+
+        :param key: key of the call
+        :param func: function to call
+        :returns: result of the call
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if call is None:
+                # done event, result and exception
+                call = self.calls[key] = [threading.Event(), None, None]
+
+        if not leader:
+            call[0].wait()
+
+            if call[2] is not None:
+                raise call[2]
+
+            return call[1]
+
+        try:
+            call[1] = func(*args)
+            return call[1]
+
+        except BaseException as e:
+            call[2] = e
+            raise
+
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+
+
+# concurrent lookups of the same key, shared by all routes
+FLIGHTS = SingleFlight()
+
+# url -> page title, shared by all rooms
+URL_TITLES = TTLCache()  # type: Union[TTLCache, SQLiteCache]
+
+# image url and content hash -> uploaded mxc uri
+MEDIA = TTLCache(
+    maxsize=4096,
+    ttl=7 * 24 * 3600.0,
+)  # type: Union[TTLCache, SQLiteCache]
+
+# normalized city -> weather, unknown cities as None
+WEATHER = TTLCache(
+    maxsize=256,
+    ttl=600.0,
+    negative_ttl=3600.0,
+)  # type: Union[TTLCache, SQLiteCache]
 
-MOSS = MossBot()
+
+def configure_caches(config: Dict) -> None:
+    """Sets up the shared caches from the bot config
+
+    The ``memory`` backend keeps the caches in the process, ``sqlite``
+    shares them through ``cache_path`` and is the default with shards.
+
+    :param config: bot config
+    """
+    # pylint: disable=global-statement
+    global URL_TITLES, MEDIA, WEATHER
+
+    backend = config.get(
+        'cache_backend',
+        'sqlite' if config.get('shards') else 'memory'
+    )
+
+    if backend == 'sqlite':
+        path = config.get('cache_path', 'cache.sqlite')
+
+        URL_TITLES = SQLiteCache(
+            path,
+            'url_titles',
+            maxsize=config.get('url_title_cache_size', 1024),
+            ttl=config.get('url_title_cache_ttl', 3600.0),
+            negative_ttl=config.get('url_title_cache_negative_ttl', 300.0),
+        )
+        MEDIA = SQLiteCache(
+            path,
+            'media',
+            maxsize=config.get('media_cache_size', 4096),
+            ttl=config.get('media_cache_ttl', 7 * 24 * 3600.0),
+        )
+        WEATHER = SQLiteCache(
+            path,
+            'weather',
+            maxsize=config.get('weather_cache_size', 256),
+            ttl=config.get('weather_cache_ttl', 600.0),
+            negative_ttl=config.get('weather_cache_negative_ttl', 3600.0),
+        )
+        return
+
+    if backend != 'memory':
+        raise ValueError(f'unknown cache backend {backend}')
+
+    URL_TITLES = TTLCache(
+        maxsize=config.get('url_title_cache_size', 1024),
+        ttl=config.get('url_title_cache_ttl', 3600.0),
+        negative_ttl=config.get('url_title_cache_negative_ttl', 300.0),
+        path=config.get('url_title_cache_path'),
+    )
+    MEDIA = TTLCache(
+        maxsize=config.get('media_cache_size', 4096),
+        ttl=config.get('media_cache_ttl', 7 * 24 * 3600.0),
+        path=config.get('media_cache_path'),
+    )
+    WEATHER = TTLCache(
+        maxsize=config.get('weather_cache_size', 256),
+        ttl=config.get('weather_cache_ttl', 600.0),
+        negative_ttl=config.get('weather_cache_negative_ttl', 3600.0),
+    )
 
 
 ##############################################################################
-# ROUTES #####################################################################
+# HELPER FUNCTIONS ###########################################################
 ##############################################################################
 
 
-@MOSS.route(r'^(?P<route>!ping)$')
-def ping(route: str, msg: str, event: Dict) -> MSG_RETURN:
-    """Pongs back in a Moss way"""
-    oneliners = (
-        'Good morning, thats a nice TNETENNBA',
-        'Ow. Four! I mean, five! I mean, fire!',
-        'Did you see that ludicrous display last night?',
-    )
+def write_json(path: str, data, mode: int = 0o644) -> None:
+    """Writes data to a JSON file by replacing it atomically
 
-    return MSG_RETURN('notice', random.choice(oneliners))
+    :param path: file path
+    :param data: JSON serializable data
+    :param mode: permissions if the file gets created
+    """
+    tmp_path = f'{path}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with open(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
 
 
-@MOSS.route(r'(?P<route>^http[s]?://.*(?:jpg|jpeg|png|gif)$)')
-def image(route: str, msg: str, event: Dict) -> MSG_RETURN:
-    """Posts image"""
-    return MSG_RETURN('image', route)
+def route_prefix(regex: Pattern) -> Tuple[bool, str]:
+    """Finds the literal text every match of a route starts with
 
+    Walks the parsed pattern until the first non literal element. Groups
+    without scoped flags are entered, everything else stops the walk.
 
-@MOSS.route(
-    (
-        r'(?i)(?P<route>\b((?:https?://|www\d{0,3}[.]'
-        r'|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|'
-        r'\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+'
-        r'(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)'
-        r'|[^\s`!()\[\]{};:\'\".,<>?'
-        r'\xab\xbb\u201c\u201d\u2018\u2019])))'
-        r'\s?(?P<msg>.*)?'
-    )
-)
-def url_title(route: str, msg: str, event: Dict) -> MSG_RETURN:
-    """Takes postet urls and parses the title"""
-    try:
+    :param regex: compiled route pattern
+    :returns: tuple of anchored at message start and casefolded prefix
+    """
+    anchored = False
+    prefix = []  # type: List[str]
 
-        logger.debug('get "%s"', route)
-        r = requests.get(route)
-        logger.debug('parse for title')
-        soup = BeautifulSoup(r.text, 'html.parser')
+    def walk(items: Iterable) -> bool:
+        """Collects literals, returns False when the walk has to stop"""
+        nonlocal anchored
 
-    except BaseException as e:
-        logger.exception('url_title could not get html title: %s', e)
+        for op, av in items:
 
-        return MSG_RETURN('skip', None)
+            if op is sre_parse.AT and av is sre_parse.AT_BEGINNING \
+                    and not prefix:
+                anchored = not regex.flags & re.MULTILINE
 
-    title = soup.title.string
-    logger.info('url title: %s', title)
+            elif op is sre_parse.LITERAL:
+                prefix.append(chr(av))
 
-    return MSG_RETURN(
-        'html',
-        f'<a href="{route}">{title}</a>'
-    )
+            elif op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+                if not walk(av[-1]):
+                    return False
 
+            else:
+                return False
 
-@MOSS.route(r'^(?P<route>!reaction)\s+(?P<msg>.+)')
-def reaction(route: str, msg: str, event: Dict) -> MSG_RETURN:
-    """Posts reaction gif
+        return True
 
-    :param route: reaction route
-    :param msg: reaction to look for
+    walk(sre_parse.parse(regex.pattern, regex.flags))
+
+    return anchored, ''.join(prefix).casefold()
+
+
+def get_giphy_reaction_url(
+        api_key: str,
+        term: str,
+        ttl: float = 3600.0,
+) -> Union[str, None]:
+    """Gets a random giphy gif and returns url
+
+    The gif urls of a search live in the media cache for ``ttl`` seconds,
+    next to the uploads of the gifs, so popular reactions need neither a
+    search nor an upload.
+
+    :param api_key: GIPHY api key
+    :param term: search term
+    :param ttl: seconds to cache the search results
+    :returns: gif url
     """
+    term = normalize_term(term)
+
     try:
+        urls = MEDIA.get(('giphy', term))
+        if urls is MISSING:
+            urls = FLIGHTS.do(
+                ('giphy', term),
+                search_giphy,
+                api_key,
+                term,
+                ttl,
+            )
 
-        gif_url = get_giphy_reaction_url(
-            event['config']['giphy_api_key'],
-            msg
-        )
-        if gif_url:
-            return MSG_RETURN('image', gif_url)
+    except BaseException as e:
+        logger.exception('could not get giphy data: %s', e)
+        return None
+
+    if not urls:
+        logger.error('could not get reaction video url')
+        return None
+
+    return random.choice(urls)
+
+
+def search_giphy(
+        api_key: str,
+        term: str,
+        ttl: float,
+) -> Union[List[str], None]:
+    """Searches giphy and caches the gif urls of the results
+
+    :param api_key: GIPHY api key
+    :param term: normalized search term
+    :param ttl: seconds to cache the results
+    :returns: gif urls without query or None if nothing was found
+    """
+    url = (
+        f'http://api.giphy.com/v1/gifs/search'
+        f'?api_key={api_key}'
+        f'&q={quote_plus(term)}'
+        f'&limit=20'
+    )
+
+    data = HTTP.get(url).json().get('data') or []
+
+    urls = [gif['images']['downsized']['url'].split('?')[0] for gif in data]
+    if not urls:
+        return MEDIA.set(('giphy', term), None)
+
+    return MEDIA.set(('giphy', term), urls, ttl=ttl)
+
+
+class TitleParser(HTMLParser):
+    """Collects title and og:title from the head of a html document"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.title = None  # type: Union[str, None]
+        self.og_title = None  # type: Union[str, None]
+        self.in_title = False
+        self.title_parts = []  # type: List[str]
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+
+        if tag == 'title' and self.title is None:
+            self.in_title = True
+
+        elif tag == 'body':
+            # pages without </head> start their body right away
+            self.done = True
+
+        elif tag == 'meta':
+            attributes = dict(attrs)
+            if attributes.get('property') == 'og:title':
+                self.og_title = attributes.get('content')
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.title = ''.join(self.title_parts)
+            self.done = self.og_title is not None
+
+        elif tag in ('head', 'body'):
+            self.done = True
+
+    def result(self) -> Union[str, None]:
+        """Returns the title, og:title if there is none"""
+        for title in (self.title, self.og_title):
+            if title and title.strip():
+                return ' '.join(title.split())
+
+        return None
+
+
+def get_url_title(
+        url: str,
+        max_bytes: int = TITLE_MAX_BYTES,
+) -> Union[str, None]:
+    """Streams the head of a page and parses its title
+
+    Stops reading at the end of the head or after ``max_bytes``, pages
+    that are no html are not read at all.
+
+    :param url: page url
+    :param max_bytes: maximum bytes to read
+    :returns: title or None
+    """
+    try:
+
+        logger.debug('get "%s"', url)
+        r = HTTP.get(url, stream=True)
+
+        try:
+
+            r.raise_for_status()
+
+            content_type = r.headers.get('Content-Type', '')
+            mime = content_type.split(';')[0].strip().lower()
+            if mime and mime not in HTML_TYPES:
+                logger.info('no html at %s: %s', url, mime)
+                return None
+
+            # without a charset header most pages are utf-8
+            encoding = 'utf-8'
+            if 'charset' in content_type and r.encoding:
+                encoding = r.encoding
+
+            try:
+                decoder = codecs.getincrementaldecoder(encoding)('replace')
+            except LookupError:
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+            logger.debug('parse for title')
+            parser = TitleParser()
+            read = 0
+
+            for chunk in r.iter_content(chunk_size=8192):
+                parser.feed(decoder.decode(chunk[:max_bytes - read]))
+                read += len(chunk)
+
+                if parser.done or read >= max_bytes:
+                    break
+
+            return parser.result()
+
+        finally:
+            r.close()
+
+    except BaseException as e:
+        logger.exception('url_title could not get html title: %s', e)
+
+        return None
+
+
+def lookup_url_title(
+        url: str,
+        max_bytes: int = TITLE_MAX_BYTES,
+) -> Union[str, None]:
+    """Gets the title of a page from the cache or the page
+
+    The fragment does not change the page and is left out of the key.
+
+    :param url: page url
+    :param max_bytes: maximum bytes to read
+    :returns: title or None
+    """
+    key = urlsplit(url)._replace(fragment='').geturl()
+
+    title = URL_TITLES.get(key)
+    if title is MISSING:
+        title = FLIGHTS.do(
+            ('title', key),
+            lambda: URL_TITLES.set(key, get_url_title(url, max_bytes)),
+        )
+
+    return title
+
+
+def normalize_term(term: str) -> str:
+    """Returns a search term with the same case and whitespace"""
+    return ' '.join(unicodedata.normalize('NFKC', term).casefold().split())
+
+
+def get_weather(city: str, api_key: str) -> Union[Dict, None]:
+    """Gets the weather of a city from openweathermap and caches it
+
+    :param city: normalized city name
+    :param api_key: openweathermap api key
+    :returns: dict with city, weather and temp or None for unknown cities
+    """
+    r = HTTP.get(
+        (
+            'http://api.openweathermap.org/data/2.5/'
+            f'weather?q={city}&APPID={api_key}&units=metric'
+        )
+    )
+
+    weather_data = r.json()
+    logger.debug('got weather data: %s', weather_data)
+
+    if str(weather_data['cod']) == '404':
+        return WEATHER.set(city, None)
+
+    return WEATHER.set(
+        city,
+        {
+            'city': weather_data['name'],
+            'weather': weather_data['weather'][0]['main'],
+            'temp': weather_data['main']['temp'],
+        }
+    )
+
+
+def get_image(
+        url: str,
+        max_bytes: int = MEDIA_MAX_BYTES,
+) -> Union[Dict, None]:
+    """Downloads image and analyzes it
+
+    The image is streamed into a spooled file while it gets hashed, its
+    size is read from the header bytes. Images above ``max_bytes`` are
+    dropped.
+
+    :param url: image url
+    :param max_bytes: maximum image size
+    :returns: dictionary with image and meta data
+    """
+    try:
+        logger.info('downloading image: %s', url)
+        r = HTTP.get(url, stream=True)
+
+        try:
+
+            if r.status_code != 200:
+                raise Exception('wrong status code %s', r.status_code)
+
+            length = r.headers.get('Content-Length')
+            if length and int(length) > max_bytes:
+                raise Exception('image too big %s', length)
+
+            img = SpooledTemporaryFile(max_size=MEDIA_SPOOL_BYTES)
+            digest = hashlib.sha256()
+            parser = ImageFile.Parser()
+            size = 0
+
+            try:
+
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise Exception('image too big %s', size)
+
+                    img.write(chunk)
+                    digest.update(chunk)
+
+                    # only the header is needed for the size
+                    if parser.image is None:
+                        parser.feed(chunk)
+
+                if parser.image is None:
+                    raise Exception('could not read image header')
+
+            except BaseException:
+                img.close()
+                raise
+
+            # seek to 0
+            img.seek(0)
+
+            return {
+                'content-type': (
+                    r.headers.get('Content-Type') or
+                    Image.MIME.get(parser.image.format)
+                ),
+                'image': img,
+                'width': parser.image.width,
+                'height': parser.image.height,
+                'size': size,
+                'sha256': digest.hexdigest(),
+            }
+
+        finally:
+            r.close()
+
+    except BaseException as e:
+        logger.error('could not download and analyze img: %s', str(e))
+
+        return None
+
+
+##############################################################################
+# MESSAGE HISTORY ############################################################
+##############################################################################
+
+
+class History(abc.ABC):
+    """Interface for message history backends
+
+    Keeps the last ``limit`` msgs of every sender in a room. Backends open
+    their storage on first use, so a handler created before forking the
+    sync process does not share it with the child.
+    """
+
+    __slots__ = ['limit']
+
+    def __init__(self, limit: int = HISTORY_LIMIT) -> None:
+        self.limit = limit
+
+    @abc.abstractmethod
+    def store(self, room_id: str, sender: str, body: str) -> None:
+        """Stores a msg and drops the oldest one above the limit"""
+
+    @abc.abstractmethod
+    def messages(self, room_id: str, sender: str) -> List[str]:
+        """Returns the stored msgs of a sender, oldest first"""
+
+    def store_many(self, msgs: List[HISTORY_MSG]) -> None:
+        """Stores msgs given as tuples of room, sender and body"""
+        for room_id, sender, body in msgs:
+            self.store(room_id, sender, body)
+
+    def flush(self) -> int:
+        """Stores buffered msgs, returns how many"""
+        return 0
+
+
+class SQLiteHistory(History):
+    """History in a SQLite table indexed by room and sender
+
+    Rooms and senders are stored once in a symbol table, msgs refer to
+    them by id.
+    """
+
+    __slots__ = ['conn', 'lock', 'path', 'symbols']
+
+    def __init__(self, path: str, limit: int = HISTORY_LIMIT) -> None:
+        super().__init__(limit)
+        self.path = path
+        self.conn = None  # type: Union[sqlite3.Connection, None]
+        self.lock = threading.Lock()
+        # name -> id, ids never change once stored
+        self.symbols = {}  # type: Dict[str, int]
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens the database and creates the schema if needed"""
+        if self.conn is None:
+            logger.info('open history db %s', self.path)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS symbols ('
+                    'id INTEGER PRIMARY KEY, '
+                    'name TEXT NOT NULL UNIQUE)'
+                )
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS messages ('
+                    'id INTEGER PRIMARY KEY, '
+                    'room INTEGER NOT NULL, '
+                    'sender INTEGER NOT NULL, '
+                    'body TEXT NOT NULL)'
+                )
+                conn.execute(
+                    'CREATE INDEX IF NOT EXISTS messages_room_sender '
+                    'ON messages (room, sender, id)'
+                )
+            self.conn = conn
+
+        return self.conn
+
+    def symbol(self, name: str) -> Union[int, None]:
+        """Returns the id of a room or sender or None if it is unknown"""
+        symbol = self.symbols.get(name)
+
+        if symbol is None:
+            row = self.connect().execute(
+                'SELECT id FROM symbols WHERE name = ?',
+                (name, )
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            symbol = self.symbols[sys.intern(name)] = row[0]
+
+        return symbol
+
+    def create_symbols(self, names: Iterable[str]) -> None:
+        """Stores unknown rooms and senders
+
+        New names are committed on their own, so a rolled back msg does
+        not leave an id in the cache that is not stored.
+        """
+        unknown = {name for name in names if name not in self.symbols}
+
+        if unknown:
+            with self.connect() as conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO symbols (name) VALUES (?)',
+                    ((name, ) for name in unknown)
+                )
+
+            for name in unknown:
+                self.symbol(name)
+
+    def store(self, room_id: str, sender: str, body: str) -> None:
+        self.store_many([HISTORY_MSG(room_id, sender, body)])
+
+    def store_many(self, msgs: List[HISTORY_MSG]) -> None:
+        with self.lock:
+            self.create_symbols(i for msg in msgs for i in msg[:2])
+
+            rows = [
+                (self.symbols[room_id], self.symbols[sender], body)
+                for room_id, sender, body in msgs
+            ]
+
+            conn = self.connect()
+            with conn:
+                conn.executemany(
+                    'INSERT INTO messages (room, sender, body) '
+                    'VALUES (?, ?, ?)',
+                    rows
+                )
+                conn.executemany(
+                    'DELETE FROM messages WHERE room = ? AND sender = ? '
+                    'AND id <= ('
+                    'SELECT id FROM messages WHERE room = ? AND sender = ? '
+                    'ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (
+                        (room, sender, room, sender, self.limit)
+                        for room, sender in {(i[0], i[1]) for i in rows}
+                    )
+                )
+
+    def messages(self, room_id: str, sender: str) -> List[str]:
+        with self.lock:
+            room = self.symbol(room_id)
+            sender_id = self.symbol(sender)
+
+            if room is None or sender_id is None:
+                return []
+
+            rows = self.connect().execute(
+                'SELECT body FROM messages WHERE room = ? AND sender = ? '
+                'ORDER BY id DESC LIMIT ?',
+                (room, sender_id, self.limit)
+            ).fetchall()
+
+        return [row[0] for row in reversed(rows)]
+
+
+class MemoryHistory(History):
+    """History in per sender ring buffers with periodic JSON snapshots
+
+    Rooms and senders are interned. Snapshots store them once in a symbol
+    table and refer to them by index.
+    """
+
+    __slots__ = ['buffers', 'interval', 'last_snapshot', 'lock', 'path']
+
+    def __init__(
+            self,
+            path: str,
+            limit: int = HISTORY_LIMIT,
+            interval: float = 60.0,
+    ) -> None:
+        super().__init__(limit)
+        self.path = path
+        self.interval = interval
+        self.buffers = None  # type: Union[Dict[Tuple[str, str], deque], None]
+        self.last_snapshot = 0.0
+        self.lock = threading.RLock()
+
+    def load(self) -> Dict[Tuple[str, str], deque]:
+        """Loads the last snapshot on first use"""
+        if self.buffers is None:
+            self.buffers = {}
+            self.last_snapshot = time.monotonic()
+
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+
+                symbols = [sys.intern(i) for i in data['symbols']]
+                for room, sender, bodies in data['buffers']:
+                    self.buffers[
+                        (symbols[room], symbols[sender])
+                    ] = deque(bodies, maxlen=self.limit)
+
+            except FileNotFoundError:
+                logger.info('no history snapshot in %s', self.path)
+
+        return self.buffers
+
+    def snapshot(self) -> None:
+        """Writes all buffers to the snapshot file"""
+        with self.lock:
+            symbols = {}  # type: Dict[str, int]
+            buffers = [
+                [
+                    symbols.setdefault(room_id, len(symbols)),
+                    symbols.setdefault(sender, len(symbols)),
+                    list(bodies),
+                ]
+                for (room_id, sender), bodies in self.load().items()
+            ]
+
+            write_json(
+                self.path,
+                {'symbols': list(symbols), 'buffers': buffers}
+            )
+
+            self.last_snapshot = time.monotonic()
+
+    def store(self, room_id: str, sender: str, body: str) -> None:
+        with self.lock:
+            buffers = self.load()
+            bodies = buffers.get((room_id, sender))
+            if bodies is None:
+                bodies = buffers[
+                    (sys.intern(room_id), sys.intern(sender))
+                ] = deque(maxlen=self.limit)
+            bodies.append(body)
+
+            if time.monotonic() - self.last_snapshot >= self.interval:
+                self.snapshot()
+
+    def messages(self, room_id: str, sender: str) -> List[str]:
+        with self.lock:
+            return list(self.load().get((room_id, sender), ()))
+
+
+def pid_alive(pid: int) -> bool:
+    """Checks if a process is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+# journal files in use and the pid of the process using them, histories
+# of several accounts in one process must not claim them from each other
+JOURNALS = {}  # type: Dict[str, int]
+
+
+class WriteBehindHistory(History):
+    """Buffers the msgs of another backend and stores them in batches
+
+    ``store`` appends the msg to a journal file of the process and to a
+    buffer. A thread stores the buffer in the backend with one transaction
+    when it holds ``batch_size`` msgs or every ``interval`` seconds. For a
+    batch the journal is renamed to ``<journal>.flushing`` and removed when
+    the batch is stored. Journals of processes that ended before that are
+    stored on first use, which can store the last batch of a process twice.
+    Keep the journal next to the database on a volume that outlives the
+    container.
+    """
+
+    __slots__ = [
+        'backend',
+        'batch_size',
+        'cond',
+        'flushing',
+        'interval',
+        'journal',
+        'lock',
+        'path',
+        'pending',
+        'pid',
+        'thread',
+    ]
+
+    def __init__(
+            self,
+            backend: History,
+            path: str,
+            batch_size: int = 100,
+            interval: float = 1.0,
+    ) -> None:
+        super().__init__(backend.limit)
+        self.backend = backend
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []  # type: List[HISTORY_MSG]
+        self.flushing = []  # type: List[HISTORY_MSG]
+        self.journal = None  # type: Union[int, None]
+        self.pid = None  # type: Union[int, None]
+        self.thread = None  # type: Union[threading.Thread, None]
+        # held while a batch gets stored, lock before cond
+        self.lock = threading.Lock()
+        # guards the buffers and the journal
+        self.cond = threading.Condition()
+
+    def journal_path(self, suffix: str = '') -> str:
+        """Returns the journal path of this process"""
+        return f'{self.path}.{self.pid}{suffix}'
+
+    def open(self) -> int:
+        """Opens the journal and starts the flusher in a new process
+
+        The buffers of the parent process stay with the parent.
+        """
+        journal = self.journal
+
+        if journal is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = []
+            self.flushing = []
+            self.recover()
+
+            JOURNALS[os.path.abspath(self.journal_path())] = os.getpid()
+            journal = self.journal = os.open(
+                self.journal_path(),
+                os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                0o600,
+            )
+
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        return journal
+
+    def recover(self) -> None:
+        """Stores the msgs of journals left behind by ended processes
+
+        Every process of the bot recovers on first use. A journal gets
+        claimed by renaming it to ``<journal>.recovering.<pid>`` first, so
+        only one of them stores it. Claims of ended processes are taken
+        over.
+        """
+        directory, prefix = os.path.split(self.path)
+        directory = directory or '.'
+
+        journals = []
+        for filename in os.listdir(directory):
+            name, _, claimer = filename[len(prefix) + 1:].partition(
+                '.recovering.'
+            )
+            pid, _, suffix = name.partition('.')
+
+            if not filename.startswith(prefix + '.') or \
+                    not pid.isdigit() or suffix not in ('', 'flushing'):
+                continue
+
+            owner = int(claimer) if claimer.isdigit() else int(pid)
+            if owner != self.pid and pid_alive(owner):
+                continue
+
+            # the journal of another history of this process
+            in_use = os.path.abspath(f'{self.path}.{pid}')
+            if owner == self.pid and JOURNALS.get(in_use) == self.pid:
+                continue
+
+            # the batch being stored is older than the journal
+            journals.append((int(pid), suffix != 'flushing', filename, name))
+
+        for _, _, filename, name in sorted(journals):
+            path = f'{self.path}.{name}.recovering.{self.pid}'
+            claim = os.path.abspath(path)
+
+            if JOURNALS.get(claim) == self.pid:
+                continue
+            JOURNALS[claim] = os.getpid()
+
+            try:
+                os.rename(os.path.join(directory, filename), path)
+            except FileNotFoundError:
+                # another process claimed it
+                del JOURNALS[claim]
+                continue
+
+            msgs = []
+
+            with open(path) as f:
+                for line in f:
+                    try:
+                        room_id, sender, body = json.loads(line)
+                    except ValueError:
+                        # the write of the last line got cut off
+                        logger.warning('broken line in journal %s', path)
+                        continue
+
+                    msgs.append(HISTORY_MSG(room_id, sender, body))
+
+            logger.info('recover %d msgs from journal %s', len(msgs), path)
+            self.backend.store_many(msgs)
+            os.remove(path)
+            del JOURNALS[claim]
+
+    def store(self, room_id: str, sender: str, body: str) -> None:
+        line = json.dumps([room_id, sender, body]) + '\n'
+
+        with self.cond:
+            os.write(self.open(), line.encode())
+            self.pending.append(
+                HISTORY_MSG(sys.intern(room_id), sys.intern(sender), body)
+            )
+
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def messages(self, room_id: str, sender: str) -> List[str]:
+        with self.lock:
+            with self.cond:
+                self.open()
+                buffered = [
+                    msg[2]
+                    for msg in self.flushing + self.pending
+                    if msg[0] == room_id and msg[1] == sender
+                ]
+
+            stored = self.backend.messages(room_id, sender)
+
+        return (stored + buffered)[-self.limit:]
+
+    def flush(self) -> int:
+        """Stores the buffered msgs in the backend
+
+        A batch that could not be stored is tried again first.
+
+        :returns: number of stored msgs
+        """
+        with self.lock:
+            with self.cond:
+                if not self.flushing and self.pending:
+                    os.close(self.open())
+                    os.rename(
+                        self.journal_path(),
+                        self.journal_path('.flushing')
+                    )
+                    self.journal = os.open(
+                        self.journal_path(),
+                        os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                        0o600,
+                    )
+                    self.flushing, self.pending = self.pending, []
+
+                batch = self.flushing
+
+            if not batch:
+                return 0
+
+            with METRICS.timer('mossbot_history_flush_seconds'):
+                self.backend.store_many(batch)
+
+            with self.cond:
+                self.flushing = []
+                os.remove(self.journal_path('.flushing'))
+
+        return len(batch)
+
+    def run(self) -> None:
+        """Stores batches in the background, runs in a thread"""
+        while True:
+            with self.cond:
+                if len(self.pending) < self.batch_size:
+                    self.cond.wait(self.interval)
+
+            try:
+                self.flush()
+
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception('could not store msgs: %s', e)
+                time.sleep(self.interval)
+
+
+def get_history(config: Dict) -> History:
+    """Creates the configured history backend
+
+    The sqlite backend gets write-behind batching, unless
+    ``history_write_behind`` is off.
+
+    :param config: bot config
+    :returns: history backend
+    """
+    backend = config.get('history_backend', 'sqlite')
+
+    if backend == 'sqlite':
+        path = config.get('history_path', 'db.sqlite')
+        history = SQLiteHistory(path)  # type: History
+
+        if config.get('history_write_behind', True):
+            history = WriteBehindHistory(
+                history,
+                config.get('history_journal_path', f'{path}.journal'),
+                batch_size=config.get('history_batch_size', 100),
+                interval=config.get('history_flush_interval', 1.0),
+            )
+
+        return history
+
+    if backend == 'memory':
+        return MemoryHistory(
+            config.get('history_path', 'history.json'),
+            interval=config.get('history_snapshot_interval', 60.0),
+        )
+
+    raise ValueError(f'unknown history backend {backend}')
+
+
+class RecentMessages(object):
+    """In-process cache of the last non substitution msgs per sender
+
+    Keyed by room and sender and bounded in both msgs per sender and
+    number of senders, the least recently used sender gets dropped first.
+    Senders not in the cache are loaded from the history backend, so the
+    cache gets warm again after a restart.
+    """
+
+    __slots__ = ['history', 'lock', 'maxlen', 'max_senders', 'msgs']
+
+    def __init__(
+            self,
+            history: History,
+            maxlen: int = HISTORY_LIMIT,
+            max_senders: int = 10000,
+    ) -> None:
+        self.history = history
+        self.maxlen = maxlen
+        self.max_senders = max_senders
+        self.msgs = OrderedDict()  # type: OrderedDict
+        self.lock = threading.Lock()
+
+    def _put(self, key: Tuple[str, str], bodies: Iterable[str]) -> deque:
+        """Adds a sender and evicts the least recently used ones"""
+        key = (sys.intern(key[0]), sys.intern(key[1]))
+        cached = self.msgs[key] = deque(bodies, maxlen=self.maxlen)
+
+        while len(self.msgs) > self.max_senders:
+            self.msgs.popitem(last=False)
+
+        return cached
+
+    def add(self, room_id: str, sender: str, body: str) -> None:
+        """Caches a msg unless it is a substitution
+
+        A sender that is not cached yet starts with this msg, which is
+        the newest one and all search and replace needs.
+        """
+        if SUBSTITUTION.match(body):
+            return
+
+        key = (room_id, sender)
+        with self.lock:
+            cached = self.msgs.get(key)
+
+            if cached is None:
+                self._put(key, (body, ))
+            else:
+                cached.append(body)
+                self.msgs.move_to_end(key)
+
+    def last(self, room_id: str, sender: str) -> Union[str, None]:
+        """Returns the newest non substitution msg of a sender
+
+        :param room_id: room the msg was sent to
+        :param sender: sender of the msg
+        :returns: msg body or None
+        """
+        key = (room_id, sender)
+        with self.lock:
+            cached = self.msgs.get(key)
+
+            if cached is None:
+                logger.debug('load recent msgs of %s from history', sender)
+                cached = self._put(
+                    key,
+                    (
+                        body
+                        for body in self.history.messages(room_id, sender)
+                        if not SUBSTITUTION.match(body)
+                    )
+                )
+            else:
+                self.msgs.move_to_end(key)
+
+            return cached[-1] if cached else None
+
+
+##############################################################################
+# MOSSBOT LOGIC ##############################################################
+##############################################################################
+
+
+class TokenBuckets(object):
+    """Token buckets by key, the least recently used are dropped
+
+    A bucket holds up to ``burst`` tokens and refills with ``rate`` tokens
+    per second. Taking a token from an empty bucket can be reserved ahead,
+    the caller then has to wait until the token refilled.
+    """
+
+    __slots__ = ['buckets', 'lock', 'maxsize']
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.maxsize = maxsize
+        # key -> [tokens, time of last update]
+        self.buckets = OrderedDict()  # type: OrderedDict
+        self.lock = threading.Lock()
+
+    def take(
+            self,
+            rules: Iterable[Tuple[Tuple, float, float]],
+            max_delay: float = 0.0,
+            now: Union[float, None] = None,
+    ) -> Tuple[float, Tuple]:
+        """Takes a token from every bucket or from none
+
+        :param rules: tuples of bucket key, rate and burst
+        :param max_delay: seconds a caller is willing to wait for a token
+        :param now: monotonic time, for tests
+        :returns: seconds to wait or -1 if over the limit and the key of
+            the bucket with the longest wait
+        """
+        if now is None:
+            now = time.monotonic()
+
+        delay = 0.0
+        limiting = ()  # type: Tuple
+        buckets = []
+
+        with self.lock:
+            for key, rate, burst in rules:
+                bucket = self.buckets.get(key)
+
+                if bucket is None:
+                    bucket = self.buckets[key] = [float(burst), now]
+                else:
+                    self.buckets.move_to_end(key)
+                    bucket[0] = min(
+                        float(burst),
+                        bucket[0] + (now - bucket[1]) * rate
+                    )
+                    bucket[1] = now
+
+                if bucket[0] < 1:
+                    wait = (1 - bucket[0]) / rate if rate > 0 else math.inf
+
+                    if wait > delay:
+                        delay, limiting = wait, key
+
+                buckets.append(bucket)
+
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+
+            if delay > max_delay:
+                return -1.0, limiting
+
+            for bucket in buckets:
+                bucket[0] -= 1
+
+        return delay, limiting
+
+    def clear(self) -> None:
+        """Forgets all buckets"""
+        with self.lock:
+            self.buckets.clear()
+
+
+class LazyRoute(object):
+    """Route function that gets imported on its first call
+
+    Plugins declare their routes with a ``module:function`` target, the
+    module is only imported when one of its routes matches.
+    """
+
+    __slots__ = ['__name__', 'func', 'target']
+
+    def __init__(self, target: str) -> None:
+        self.target = target
+        self.__name__ = target.rpartition(':')[2]
+        self.func = None  # type: Union[Callable, None]
+
+    def resolve(self) -> Callable:
+        """Imports the route function if it is not imported yet"""
+        if self.func is None:
+            module, _, name = self.target.partition(':')
+
+            with startup_stage(f'import {module}'):
+                self.func = getattr(importlib.import_module(module), name)
+
+        return self.func
+
+    def __call__(self, *args) -> Any:
+        return self.resolve()(*args)
+
+
+class MossBot(object):
+    """Bot routing logic
+
+    Routes anchored on a literal prefix are found by walking a trie of
+    the prefixes along the msg, the others are checked for every msg.
+    Only the regexes of these candidates run, in order of priority.
+    """
+
+    __slots__ = ['buckets', 'compiled', 'routes', 'scan', 'trie']
+
+    def __init__(self) -> None:
+        # stores all routes and its functions
+        self.routes = OrderedDict()  # type: ROUTES_TYPE
+
+        # compiled routes in registration order
+        self.compiled = []  # type: List[COMPILED_ROUTE]
+
+        # casefolded prefix chars, '' holds the indexes of routes ending there
+        self.trie = {}  # type: Any
+
+        # indexes of routes that have to be checked for every message
+        self.scan = []  # type: List[int]
+
+        # rate limits of routes per sender and room
+        self.buckets = TokenBuckets()
+
+    def route(
+            self,
+            route: str,
+            prefilter: Union[Iterable[str], None] = None,
+            priority: int = 0,
+    ) -> Callable:
+        """Decorator to save routes to a dictionary
+
+        The pattern gets compiled once and a literal prefix is extracted to
+        skip the regex for messages that can not match. Routes without a
+        usable prefix can pass ``prefilter``, substrings of which at least
+        one has to be in the message. Routes with a higher ``priority`` are
+        tried first, equal ones in registration order.
+
+        :param route: route pattern
+        :param prefilter: substrings needed for a match
+        :param priority: order of the route among matching routes
+        """
+
+        def decorator(f: Callable) -> Callable:
+            """Decorates the function."""
+            if route in self.routes:
+                self.routes[route] = f
+
+                index = list(self.routes.keys()).index(route)
+                self.compiled[index] = self.compiled[index]._replace(
+                    priority=priority,
+                    func=f,
+                )
+
+                return f
+
+            regex = re.compile(route, re.IGNORECASE)
+
+            if prefilter is not None:
+                anchored = False
+                prefixes = tuple(i.casefold() for i in prefilter)
+            else:
+                anchored, prefix = route_prefix(regex)
+                prefixes = (prefix, ) if prefix else ()
+
+            index = len(self.compiled)
+            self.routes[route] = f
+            self.compiled.append(
+                COMPILED_ROUTE(regex, anchored, prefixes, priority, f)
+            )
+
+            if anchored and prefixes:
+                node = self.trie
+                for char in prefixes[0]:
+                    node = node.setdefault(char, {})
+
+                node.setdefault('', []).append(index)
+            else:
+                self.scan.append(index)
+
+            return f
+
+        return decorator
+
+    def lazy_route(
+            self,
+            route: str,
+            target: str,
+            prefilter: Union[Iterable[str], None] = None,
+            priority: int = 0,
+    ) -> LazyRoute:
+        """Saves a route whose function is imported on its first match
+
+        :param route: route pattern
+        :param target: route function as ``module:function``
+        :param prefilter: substrings needed for a match
+        :param priority: order of the route among matching routes
+        """
+        return self.route(route, prefilter, priority)(LazyRoute(target))
+
+    @staticmethod
+    def resolve(func: Callable) -> Union[Callable, None]:
+        """Imports the function of a lazy route
+
+        :param func: route function
+        :returns: the function or None if it could not be imported
+        """
+        if not isinstance(func, LazyRoute):
+            return func
+
+        try:
+            return func.resolve()
+
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('could not import route %s: %s', func.target, e)
+            return None
+
+    def candidates(self, raw_msg: str) -> List[COMPILED_ROUTE]:
+        """Returns the routes passing the prefilter in order of priority
+
+        :param raw_msg: message body
+        """
+        folded = raw_msg.casefold()
+
+        indexes = [
+            index
+            for index in self.scan
+            if not self.compiled[index].prefixes
+            or any(i in folded for i in self.compiled[index].prefixes)
+        ]
+
+        node = self.trie
+        for char in folded:
+            node = node.get(char)
+
+            if node is None:
+                break
+
+            indexes.extend(node.get('', ()))
+
+        compiled = [self.compiled[index] for index in sorted(indexes)]
+        compiled.sort(key=lambda i: -i.priority)
+
+        return compiled
+
+    def matches(self, raw_msg: str) -> Iterator[Tuple[COMPILED_ROUTE, Match]]:
+        """Yields the routes matching a message in order of priority
+
+        :param raw_msg: message body
+        """
+        for compiled in self.candidates(raw_msg):
+            m = compiled.regex.search(raw_msg)
+
+            if m:
+                yield compiled, m
+
+    def match(
+            self,
+            raw_msg: str,
+    ) -> Union[Tuple[COMPILED_ROUTE, Match], None]:
+        """Finds the first route matching a message
+
+        :param raw_msg: message body
+        :returns: tuple of matched route and regex match or None
+        """
+        return next(self.matches(raw_msg), None)
+
+    def dispatch(
+            self,
+            event: Dict,
+    ) -> List[Tuple[Callable, Union[str, None], Union[str, None]]]:
+        """Finds the route functions for an event
+
+        Only the first matching route is used, unless the config opts in
+        to every matching route with ``route_all_matches``.
+
+        :param event: Event json object
+        :returns: list of tuples of route function, route and msg
+        """
+        raw_msg = event['content']['body']
+        every = (event.get('config') or {}).get('route_all_matches', False)
+
+        start = time.perf_counter()
+        if every:
+            matched = list(self.matches(raw_msg))
+        else:
+            first = self.match(raw_msg)
+            matched = [first] if first else []
+        METRICS.observe(
+            'mossbot_route_match_seconds',
+            time.perf_counter() - start,
+            route=matched[0][0].func.__name__ if matched else 'none',
+        )
+
+        dispatched = []
+        for compiled, m in matched:
+            matches = m.groupdict()
+            route = matches.get('route')
+            msg = matches.get('msg')
+
+            func = compiled.func
+
+            logger.info(
+                (
+                    'matched route %s '
+                    'with msg %s '
+                    'from %s '
+                    'and triggered "%s"'
+                ),
+                route, msg, raw_msg, func.__name__
+            )
+
+            dispatched.append((func, route, msg))
+
+        return dispatched
+
+    def throttle(self, func: Callable, event: Dict) -> float:
+        """Applies the rate limits of a route to an event
+
+        Limits are configured per route function name under ``throttle``,
+        as ``rate`` per second and ``burst`` for the ``sender`` and the
+        ``room``. Calls over a limit wait up to ``throttle_max_delay``
+        seconds for a token, otherwise they are dropped.
+
+        :param func: matched route function
+        :param event: Event json object
+        :returns: seconds to wait before running the route or -1 to drop
+        """
+        config = event.get('config') or {}
+        limits = (config.get('throttle') or {}).get(func.__name__)
+
+        if not limits:
+            return 0.0
+
+        rules = []
+        for scope, key in (
+                ('sender', event.get('sender')),
+                ('room', event.get('room_id')),
+        ):
+            limit = limits.get(scope)
+
+            if limit and key is not None:
+                rules.append(
+                    (
+                        (func.__name__, scope, key),
+                        float(limit['rate']),
+                        float(limit.get('burst', 1)),
+                    )
+                )
+
+        delay, limiting = self.buckets.take(
+            rules,
+            config.get('throttle_max_delay', 0.0),
+        )
+
+        if delay:
+            METRICS.inc(
+                'mossbot_throttled_total',
+                route=func.__name__,
+                scope=limiting[1],
+                action='dropped' if delay < 0 else 'deferred',
+            )
+            logger.info(
+                'throttled %s for %s in %s by %s limit',
+                func.__name__,
+                event.get('sender'),
+                event.get('room_id'),
+                limiting[1],
+            )
+
+        return delay
+
+    def serve(self, event: Dict) -> Union[MSG_RETURN, None]:
+        """Returns the right function for matching route
+
+        :param event: Event json object
+        :returns: reply of the first matching route
+        """
+        replies = self.serve_all(event)
+
+        return replies[0] if replies else None
+
+    def serve_all(self, event: Dict) -> List[MSG_RETURN]:
+        """Runs the matching routes of an event
+
+        Coroutine routes run on an event loop of their own.
+
+        :param event: Event json object
+        :returns: replies of the routes
+        """
+        replies = []
+
+        for func, route, msg in self.dispatch(event):
+            delay = self.throttle(func, event)
+            if delay < 0:
+                continue
+            if delay:
+                time.sleep(delay)
+
+            handler = self.resolve(func)
+            if handler is None:
+                continue
+
+            with METRICS.timer(
+                    'mossbot_route_handler_seconds',
+                    route=func.__name__,
+            ):
+
+                # inspect keeps asyncio out of the process engine
+                if inspect.iscoroutinefunction(handler):
+                    loop = asyncio.new_event_loop()
+                    try:
+                        reply = loop.run_until_complete(
+                            handler(route, msg, event)
+                        )
+                    finally:
+                        loop.close()
+
+                else:
+                    reply = handler(route, msg, event)
+
+            if reply is not None:
+                replies.append(reply)
+
+        return replies
+
+    async def serve_async(self, event: Dict) -> Union[MSG_RETURN, None]:
+        """Like serve, but on the running event loop
+
+        :param event: Event json object
+        :returns: reply of the first matching route
+        """
+        replies = await self.serve_all_async(event)
+
+        return replies[0] if replies else None
+
+    async def serve_all_async(self, event: Dict) -> List[MSG_RETURN]:
+        """Like serve_all, but on the running event loop
+
+        Coroutine routes are awaited, the others run in the default
+        executor of the loop.
+
+        :param event: Event json object
+        :returns: replies of the routes
+        """
+        replies = []
+
+        for func, route, msg in self.dispatch(event):
+            delay = self.throttle(func, event)
+            if delay < 0:
+                continue
+            if delay:
+                await asyncio.sleep(delay)
+
+            handler = self.resolve(func)
+            if handler is None:
+                continue
+
+            with METRICS.timer(
+                    'mossbot_route_handler_seconds',
+                    route=func.__name__,
+            ):
+
+                if asyncio.iscoroutinefunction(handler):
+                    reply = await handler(route, msg, event)
+
+                else:
+                    reply = await asyncio.get_event_loop().run_in_executor(
+                        None, handler, route, msg, event
+                    )
+
+            if reply is not None:
+                replies.append(reply)
+
+        return replies
+
+
+MOSS = MossBot()
+
+
+##############################################################################
+# ROUTES #####################################################################
+##############################################################################
+
+
+@MOSS.route(r'^(?P<route>!ping)$', priority=10)
+def ping(route: str, msg: str, event: Dict) -> MSG_RETURN:
+    """Pongs back in a Moss way"""
+    oneliners = (
+        'Good morning, thats a nice TNETENNBA',
+        'Ow. Four! I mean, five! I mean, fire!',
+        'Did you see that ludicrous display last night?',
+    )
+
+    return MSG_RETURN('notice', random.choice(oneliners))
+
+
+@MOSS.route(
+    r'(?P<route>^http[s]?://.*(?:jpg|jpeg|png|gif)$)',
+    # images are posted instead of looking up their title
+    priority=10,
+)
+def image(route: str, msg: str, event: Dict) -> MSG_RETURN:
+    """Posts image"""
+    return MSG_RETURN('image', route)
+
+
+@MOSS.route(
+    URL_PATTERN + r'\s?(?P<msg>.*)?',
+    # every url matched by the pattern has a scheme or a dot in it
+    prefilter=('//', '.'),
+    # urls in commands are left to the commands
+    priority=0,
+)
+def url_title(route: str, msg: str, event: Dict) -> MSG_RETURN:
+    """Takes postet urls and parses their titles
+
+    Up to ``url_title_max_urls`` urls of a msg are looked up in parallel
+    and answered with one msg.
+    """
+    config = event.get('config', {})
+    max_bytes = config.get('url_title_max_bytes', TITLE_MAX_BYTES)
+    max_urls = config.get('url_title_max_urls', TITLE_MAX_URLS)
+
+    urls = []  # type: List[str]
+    for m in URLS.finditer(event['content']['body']):
+        if len(urls) >= max_urls:
+            break
+
+        if m.group('route') not in urls:
+            urls.append(m.group('route'))
+
+    titles = FETCHES.map(
+        lambda url: lookup_url_title(url, max_bytes),
+        urls or [route],
+    )
+
+    links = [
+        f'<a href="{url}">{title}</a>'
+        for url, title in zip(urls or [route], titles)
+        if title is not None
+    ]
+
+    if not links:
+        return MSG_RETURN('skip', None)
+
+    logger.info('url titles: %s', titles)
+
+    return MSG_RETURN('html', '<br>'.join(links))
+
+
+@MOSS.route(r'^(?P<route>!reaction)\s+(?P<msg>.+)', priority=10)
+def reaction(route: str, msg: str, event: Dict) -> MSG_RETURN:
+    """Posts reaction gif
+
+    :param route: reaction route
+    :param msg: reaction to look for
+    """
+    try:
+
+        gif_url = get_giphy_reaction_url(
+            event['config']['giphy_api_key'],
+            msg,
+            event['config'].get('giphy_cache_ttl', 3600.0),
+        )
+        if gif_url:
+            return MSG_RETURN('image', gif_url)
+
+        logger.error('no gif url')
+
+    except BaseException as e:
+        logger.exception('could not get reaction: %s', e)
+
+    return MSG_RETURN('skip', None)
+
+
+@MOSS.route(r'^s/(?P<route>.+)/(?P<msg>.+)$', priority=10)
+def replace(route: str, msg: str, event: Dict) -> MSG_RETURN:
+    """Search and replace
+
+    :param route: search term
+    :param msg: replace term
+    :param event: full event dict
+    """
+    try:
+
+        sender = event['sender']
+
+        # newest user msg that is not a substitution
+        user_msg = event['recent'].last(event['room_id'], sender)
+
+        if user_msg is not None:
+
+            body = user_msg.replace(route, msg)
+
+            return MSG_RETURN(
+                'html',
+                f'<i><b>{sender}</b>: {body}</i>'
+            )
+
+        logger.warning(
+            'no usable msg for search and replace'
+        )
+        return MSG_RETURN('skip', None)
+
+    except BaseException as e:
+        logger.exception('could not search and replace: %s', e)
+        return MSG_RETURN('skip', None)
+
+
+@MOSS.route(r'^(?P<route>!weather)\s+(?P<msg>.+)$', priority=10)
+def weather(route: str, msg: str, event: Dict) -> MSG_RETURN:
+    """Gets weather
+
+    Weather is cached per city for ``weather_cache_ttl`` seconds,
+    unknown cities for ``weather_cache_negative_ttl``.
+
+    :param route: weather route
+    :param msg: city to look for
+    :param event: full event dict
+    """
+    try:
+
+        city = normalize_term(msg)
+
+        weather_data = WEATHER.get(city)
+        if weather_data is MISSING:
+            weather_data = FLIGHTS.do(
+                ('weather', city),
+                get_weather,
+                city,
+                event['config']['openweathermap_api_key'],
+            )
+
+        if weather_data is None:
+            return MSG_RETURN('notice', f'could not find city {msg}')
+
+        return MSG_RETURN(
+            'html',
+            (
+                f'The weather in <i>{weather_data["city"]}</i>: '
+                f'<b>{weather_data["weather"]}</b> with a temperature of '
+                f'<b>{weather_data["temp"]}°C</b>'
+            )
+        )
+
+    except BaseException as e:
+        logger.exception('problem with getting weather: %s', e)
+        return MSG_RETURN('notice', 'problem with getting weather')
+
+
+##############################################################################
+# PLUGINS ####################################################################
+##############################################################################
+
+
+def plugin_entry_points() -> List[Any]:
+    """Returns the installed entry points of mossbot plugins"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # pragma: no cover
+        # python < 3.8
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(PLUGIN_GROUP))
+
+    found = entry_points()
+
+    if hasattr(found, 'select'):
+        return list(found.select(group=PLUGIN_GROUP))
+
+    return list(found.get(PLUGIN_GROUP, ()))
+
+
+def load_plugins(config: Dict, moss: MossBot = MOSS) -> List[str]:
+    """Registers the routes of all plugins
+
+    Plugins are yaml files in ``plugin_path`` or, with
+    ``plugin_entry_points`` on, packages with a ``mossbot.plugins`` entry
+    point. Both are a list of routes with a ``pattern``, a ``handler`` as
+    ``module:function`` and optionally a ``prefilter`` and a
+    ``priority``. Modules next to the yaml files can be used as handlers.
+    Entry points are off by default, looking them up scans all installed
+    packages. Only the declarations are loaded here, handlers
+    are imported when their route first matches.
+
+    :param config: bot config
+    :param moss: bot to register the routes with
+    :returns: names of the loaded plugins
+    """
+    plugins = []  # type: List[Tuple[str, List[Dict]]]
+
+    if config.get('plugin_entry_points', False):
+        for entry_point in plugin_entry_points():
+            plugins.append((entry_point.name, entry_point.load()))
+
+    path = config.get('plugin_path')
+    if path and os.path.isdir(path):
+
+        if path not in sys.path:
+            sys.path.append(path)
+
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+
+            if ext in ('.yml', '.yaml'):
+                with open(os.path.join(path, filename)) as f:
+                    plugins.append((name, yaml.safe_load(f) or []))
+
+    for name, routes in plugins:
+        for route in routes:
+            moss.lazy_route(
+                route['pattern'],
+                route['handler'],
+                prefilter=route.get('prefilter'),
+                priority=route.get('priority', 0),
+            )
+
+        logger.info('loaded plugin %s with %d routes', name, len(routes))
+
+    return [name for name, _ in plugins]
+
+
+##############################################################################
+# WORKERS ####################################################################
+##############################################################################
+
+
+class RoomWorkers(object):
+    """Runs jobs on a bounded thread pool, in order per room
+
+    A room has at most one job running, the others wait in its queue and
+    are picked up by the same worker when the running one finishes. With
+    zero workers jobs run right away in the calling thread.
+    """
+
+    __slots__ = ['executor', 'lock', 'max_pending', 'pending']
+
+    def __init__(self, workers: int = 4, max_pending: int = 100) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers
+        ) if workers else None  # type: Union[ThreadPoolExecutor, None]
+        self.max_pending = max_pending
+        self.pending = {}  # type: Dict[str, deque]
+        self.lock = threading.Lock()
+
+    def submit(self, room_id: str, func: Callable, *args) -> bool:
+        """Queues a job for a room
+
+        :param room_id: room the job belongs to
+        :param func: job function
+        :returns: False if the room queue is full and the job got dropped
+        """
+        if self.executor is None:
+            self.run(room_id, func, args)
+            return True
+
+        with self.lock:
+            queue = self.pending.get(room_id)
+
+            if queue is None:
+                self.pending[room_id] = deque()
+                self.executor.submit(self.work, room_id, func, args)
+                return True
+
+            if len(queue) >= self.max_pending:
+                logger.warning('room %s is too busy, dropping job', room_id)
+                return False
+
+            queue.append((func, args))
+            return True
+
+    @staticmethod
+    def run(room_id: str, func: Callable, args: Tuple) -> None:
+        """Runs a single job and logs its exceptions"""
+        try:
+            func(*args)
+        except BaseException as e:
+            logger.exception('job in room %s failed: %s', room_id, e)
+
+    def work(self, room_id: str, func: Callable, args: Tuple) -> None:
+        """Runs jobs of a room until its queue is empty"""
+        while True:
+            self.run(room_id, func, args)
+
+            with self.lock:
+                queue = self.pending[room_id]
+
+                if not queue:
+                    del self.pending[room_id]
+                    return
+
+                func, args = queue.popleft()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the pool after the queued jobs"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+
+
+class AsyncRoomWorkers(object):
+    """Runs jobs on an event loop, in order per room
+
+    Jobs can be submitted from any thread. Coroutine functions are
+    awaited on the loop, other functions run in its default executor.
+    Jobs of different rooms run at the same time.
+    """
+
+    __slots__ = ['loop', 'max_pending', 'pending', 'tails']
+
+    def __init__(
+            self,
+            loop: 'asyncio.AbstractEventLoop',
+            max_pending: int = 100,
+    ) -> None:
+        self.loop = loop
+        self.max_pending = max_pending
+        self.pending = {}  # type: Dict[str, int]
+        self.tails = {}  # type: Dict[str, asyncio.Future]
+
+    def submit(self, room_id: str, func: Callable, *args) -> bool:
+        """Queues a job for a room
+
+        :param room_id: room the job belongs to
+        :param func: job function
+        :returns: False if the room queue is full and the job got dropped
+        """
+        if self.pending.get(room_id, 0) > self.max_pending:
+            logger.warning('room %s is too busy, dropping job', room_id)
+            return False
+
+        self.loop.call_soon_threadsafe(self.schedule, room_id, func, args)
+        return True
+
+    def schedule(self, room_id: str, func: Callable, args: Tuple) -> None:
+        """Chains a job to the last job of its room, runs in the loop"""
+        if self.pending.get(room_id, 0) > self.max_pending:
+            logger.warning('room %s is too busy, dropping job', room_id)
+            return
+
+        self.pending[room_id] = self.pending.get(room_id, 0) + 1
+
+        task = asyncio.ensure_future(
+            self.run(room_id, self.tails.get(room_id), func, args),
+            loop=self.loop,
+        )
+        self.tails[room_id] = task
+        task.add_done_callback(lambda _: self.done(room_id, task))
+
+    async def run(
+            self,
+            room_id: str,
+            previous: Union['asyncio.Future', None],
+            func: Callable,
+            args: Tuple,
+    ) -> None:
+        """Waits for the previous job of the room and runs the next one"""
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        try:
+            if asyncio.iscoroutinefunction(func):
+                await func(*args)
+            else:
+                await self.loop.run_in_executor(None, func, *args)
+
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('job in room %s failed: %s', room_id, e)
+
+    def done(self, room_id: str, task: 'asyncio.Future') -> None:
+        """Forgets a finished job"""
+        self.pending[room_id] -= 1
+
+        if not self.pending[room_id]:
+            del self.pending[room_id]
+
+        if self.tails.get(room_id) is task:
+            del self.tails[room_id]
+
+    async def join(self) -> None:
+        """Waits until all queued jobs are done"""
+        while self.tails:
+            await asyncio.wait(list(self.tails.values()))
+
+
+class SendQueue(object):
+    """Outbound msgs, queued per room and sent by a background thread
+
+    Rooms take turns, msgs of a room go out in order. Plain text msgs
+    that pile up in a room while it waits are coalesced into one. Server
+    and network errors are retried with exponential backoff, matrix-client
+    already waits out 429s itself. A msg keeps its random transaction id
+    over all retries, so it shows up only once, and ids do not repeat in
+    the next sync process.
+    """
+
+    __slots__ = [
+        'backoff',
+        'condition',
+        'max_chars',
+        'max_retries',
+        'queues',
+        'ready',
+        'retry_at',
+        'send',
+        'thread',
+    ]
+
+    def __init__(
+            self,
+            send: Callable,
+            max_retries: int = 5,
+            backoff: float = 1.0,
+            max_chars: int = 4000,
+    ) -> None:
+        """
+        :param send: function taking room id, content and transaction id
+        :param max_retries: attempts before a msg gets dropped
+        :param backoff: first retry delay in seconds, doubles every retry
+        :param max_chars: maximal size of a coalesced body, 0 disables
+        """
+        self.send = send
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_chars = max_chars
+
+        self.condition = threading.Condition()
+        self.queues = {}  # type: Dict[str, deque]
+        self.ready = deque()  # type: deque
+        self.retry_at = 0.0
+        self.thread = None  # type: Union[threading.Thread, None]
+
+    def put(self, room_id: str, content: Dict) -> None:
+        """Queues a msg for a room
+
+        :param room_id: room to send to
+        :param content: content of the m.room.message event
+        """
+        with self.condition:
+            queue = self.queues.get(room_id)
+
+            if queue is None:
+                queue = self.queues[room_id] = deque()
+                self.ready.append(room_id)
+
+            # msgs that were tried already keep their content
+            if queue and not queue[-1][2]:
+                coalesced = self.coalesce(queue[-1][1], content)
+                if coalesced is not None:
+                    queue[-1][1] = coalesced
+                    return
+
+            queue.append([f'mossbot{uuid.uuid4().hex}', content, 0])
+
+            # the thread does not survive forking the sync process
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+            self.condition.notify_all()
+
+    def coalesce(self, first: Dict, second: Dict) -> Union[Dict, None]:
+        """Joins two plain text msgs of the same type
+
+        :returns: the joined content or None if they do not fit together
+        """
+        if not self.max_chars:
+            return None
+
+        if first.keys() != {'msgtype', 'body'} or \
+                second.keys() != {'msgtype', 'body'} or \
+                first['msgtype'] != second['msgtype'] or \
+                first['msgtype'] not in ('m.text', 'm.notice'):
+            return None
+
+        body = f"{first['body']}\n{second['body']}"
+        if len(body) > self.max_chars:
+            return None
+
+        return {'msgtype': first['msgtype'], 'body': body}
+
+    def run(self) -> None:
+        """Sends queued msgs forever"""
+        while True:
+
+            with self.condition:
+                while not self.ready or time.monotonic() < self.retry_at:
+                    self.condition.wait(
+                        self.retry_at - time.monotonic()
+                        if self.ready else None
+                    )
+
+                room_id = self.ready.popleft()
+                item = self.queues[room_id][0]
+                item[2] += 1
+
+            txn_id, content, attempts = item
+
+            try:
+                self.send(room_id, content, txn_id)
+                sent = True
+
+            except Exception as e:  # pylint: disable=broad-except
+                sent = self.failed(room_id, e, attempts)
+
+            with self.condition:
+                queue = self.queues[room_id]
+
+                if sent:
+                    queue.popleft()
+
+                if not queue:
+                    del self.queues[room_id]
+                elif sent:
+                    self.ready.append(room_id)
+                else:
+                    self.ready.appendleft(room_id)
+
+                self.condition.notify_all()
+
+    def failed(self, room_id: str, error: Exception, attempts: int) -> bool:
+        """Decides about a failed msg
+
+        :returns: True if the msg is done with, False to retry it
+        """
+        code = getattr(error, 'code', None)
+
+        if code is not None and 400 <= code < 500 and code != 429:
+            logger.error('homeserver refused msg to %s: %s', room_id, error)
+            METRICS.inc('mossbot_send_dropped_total')
+            return True
+
+        if attempts >= self.max_retries:
+            logger.error('giving up sending msg to %s: %s', room_id, error)
+            METRICS.inc('mossbot_send_dropped_total')
+            return True
+
+        logger.warning('could not send msg to %s: %s', room_id, error)
+        self.retry_at = time.monotonic() + self.backoff * 2 ** (attempts - 1)
+        METRICS.inc('mossbot_send_retries_total', reason='error')
+        return False
+
+    def flush(self, timeout: Union[float, None] = None) -> bool:
+        """Waits until all queued msgs are sent
+
+        :param timeout: seconds to wait at most
+        :returns: False if msgs are left after the timeout
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queues, timeout)
+
+
+class ShardPool(object):
+    """Worker processes that own a share of the rooms each
+
+    Rooms are placed on a hash ring, all events of a room go to the same
+    shard in order and changing the number of shards moves only a few
+    rooms. Events go in and replies come back over one pipe per direction
+    and shard. Events wait in a bounded queue per shard and are written to
+    the pipe by a thread, so a slow shard does not hold up the caller.
+
+    Shards are only forked in ``start``, before the caller starts threads
+    that could hold a lock in the child. A shard that ended is not forked
+    again, its events are dropped and ``on_end`` is called, so the caller
+    can start over with new shards.
+    """
+
+    __slots__ = [
+        'event_writers',
+        'feeders',
+        'on_end',
+        'processes',
+        'queues',
+        'replica_shards',
+        'reply_readers',
+        'ring',
+        'shards',
+        'work',
+    ]
+
+    def __init__(
+            self,
+            shards: int,
+            replicas: int = 64,
+            max_pending: int = 1000,
+    ) -> None:
+        """
+        :param shards: number of worker processes
+        :param replicas: points of every shard on the hash ring
+        :param max_pending: events waiting for a shard at most
+        """
+        self.shards = shards
 
-        logger.error('no gif url')
+        points = sorted(
+            (self.hash_key(f'{shard}-{replica}'), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self.ring = [point for point, _ in points]
+        self.replica_shards = [shard for _, shard in points]
+
+        self.work = None  # type: Union[Callable, None]
+        self.on_end = None  # type: Union[Callable[[], Any], None]
+        self.event_writers = [
+            None
+        ] * shards  # type: List[Union[Connection, None]]
+        self.reply_readers = []  # type: List[Connection]
+        self.processes = [None] * shards  # type: List[Union[Process, None]]
+        self.queues = [
+            queue.Queue(max_pending) for _ in range(shards)
+        ]  # type: List[queue.Queue]
+        self.feeders = [
+            None
+        ] * shards  # type: List[Union[threading.Thread, None]]
+
+    @staticmethod
+    def hash_key(value: str) -> int:
+        """Stable hash, the same in every process and run"""
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def shard(self, room_id: str) -> int:
+        """Returns the shard of a room"""
+        index = bisect.bisect(self.ring, self.hash_key(room_id))
+
+        return self.replica_shards[index % len(self.ring)]
+
+    def start(
+            self,
+            work: Callable,
+            on_end: Union[Callable[[], Any], None] = None,
+    ) -> None:
+        """Forks the shard processes
+
+        :param work: runs in every shard with its event reader and reply
+            writer connection, gets tuples of room id and event
+        :param on_end: called when a shard ended before ``stop``
+        """
+        self.work = work
+        self.on_end = on_end
 
-    except BaseException as e:
-        logger.exception('could not get reaction: %s', e)
+        for shard in range(self.shards):
+            self.spawn(shard)
 
-    return MSG_RETURN('skip', None)
+    def spawn(self, shard: int) -> None:
+        """Forks a shard process and connects it"""
+        event_reader, event_writer = Pipe(duplex=False)
+        reply_reader, reply_writer = Pipe(duplex=False)
 
+        process = Process(
+            target=self.work,
+            args=(event_reader, reply_writer),
+            name=f'mossbot-shard-{shard}',
+            daemon=True,
+        )
+        process.start()
+
+        # only the shard uses these ends, closing them here lets the
+        # other ends see when it ends
+        event_reader.close()
+        reply_writer.close()
+
+        self.event_writers[shard] = event_writer
+        self.reply_readers.append(reply_reader)
+        self.processes[shard] = process
+
+    def feeder(self, shard: int) -> None:
+        """Starts the thread writing the events of a shard"""
+        # threads do not survive forking
+        feeder = self.feeders[shard]
+        if feeder is None or not feeder.is_alive():
+            feeder = self.feeders[shard] = threading.Thread(
+                target=self.feed,
+                args=(shard, ),
+                daemon=True,
+            )
+            feeder.start()
 
-@MOSS.route(r'^s/(?P<route>.+)/(?P<msg>.+)$')
-def replace(route: str, msg: str, event: Dict) -> MSG_RETURN:
-    """Search and replace
+    def submit(self, room_id: str, event: Dict) -> bool:
+        """Queues an event for the shard of its room
 
-    :param route: search term
-    :param msg: replace term
-    :param event: full event dict
-    """
-    try:
+        :returns: False if the shard is too busy and the event got dropped
+        """
+        shard = self.shard(room_id)
+        self.feeder(shard)
 
-        db = get_db()
-        msgs_table = db.table('msgs')
-        stored_msg = Query()
+        try:
+            self.queues[shard].put_nowait((room_id, event))
 
-        # get all user msgs
-        all_sender_msgs = msgs_table.search(
-            stored_msg.sender == event['sender']
-        )
+        except queue.Full:
+            logger.error('shard %d is too busy, dropping event', shard)
+            return False
 
-        for user_msg in reversed(all_sender_msgs):
+        return True
 
-            # message should not match the route
-            if not re.match(r'^s/.+/.+$', user_msg['body']):
+    def feed(self, shard: int) -> None:
+        """Writes the queued events of a shard to it, runs in a thread"""
+        while True:
+            item = self.queues[shard].get()
+            process = self.processes[shard]
+            writer = self.event_writers[shard]
 
-                sender = user_msg['sender']
-                body = user_msg['body'].replace(route, msg)
+            try:
+                if process is None or writer is None:
+                    logger.error('shard %d is not started', shard)
 
-                return MSG_RETURN(
-                    'html',
-                    f'<i><b>{sender}</b>: {body}</i>'
-                )
+                elif item is None:
+                    if process.is_alive():
+                        writer.send(None)
+                    return
 
-        logger.warning(
-            'no usable msg for search and replace'
-        )
-        return MSG_RETURN('skip', None)
+                elif process.is_alive():
+                    writer.send(item)
 
-    except BaseException as e:
-        logger.exception('could not search and replace: %s', e)
-        return MSG_RETURN('skip', None)
+                else:
+                    logger.error('shard %d ended, dropping event', shard)
 
+                    # forking here would copy the locks held by other
+                    # threads, the caller starts over instead
+                    if self.on_end is not None:
+                        self.on_end()
 
-@MOSS.route(r'^(?P<route>!weather)\s+(?P<msg>.+)$')
-def weather(route: str, msg: str, event: Dict) -> MSG_RETURN:
-    """Gets weather
+            except (OSError, ValueError) as e:
+                logger.error('could not hand event to shard %d: %s', shard, e)
 
-    :param route: weather route
-    :param msg: city to look for
-    :param event: full event dict
-    """
-    try:
+    def receive(self, timeout: Union[float, None] = None) -> List:
+        """Waits for replies of the shards
 
-        api_key = event['config']['openweathermap_api_key']
+        :param timeout: seconds to wait at most
+        :returns: list of replies, empty after the timeout
+        """
+        replies = []
 
-        r = requests.get(
-            (
-                'http://api.openweathermap.org/data/2.5/'
-                f'weather?q={msg}&APPID={api_key}&units=metric'
-            )
-        )
+        for conn in wait(list(self.reply_readers), timeout):
+            try:
+                replies.append(conn.recv())  # type: ignore
 
-        weather_data = r.json()
-        logger.debug('got weather data: %s', weather_data)
+            except EOFError:
+                self.reply_readers.remove(conn)  # type: ignore
+                conn.close()  # type: ignore
 
-        if weather_data['cod'] == '404':
-            return MSG_RETURN('notice', f'could not find city {msg}')
+        return replies
 
-        weather_in_words = weather_data['weather'][0]['main']
-        temp = weather_data['main']['temp']
-        city = weather_data['name']
+    def stop(self, timeout: float = 5.0) -> None:
+        """Lets the shards finish their events and end"""
+        for shard in range(self.shards):
+            self.feeder(shard)
+            self.queues[shard].put(None)
 
-        return MSG_RETURN(
-            'html',
-            (
-                f'The weather in <i>{city}</i>: '
-                f'<b>{weather_in_words}</b> with a temperature of '
-                f'<b>{temp}°C</b>'
-            )
-        )
+        for shard in range(self.shards):
+            feeder = self.feeders[shard]
+            if feeder is not None:
+                feeder.join(timeout)
 
-    except BaseException as e:
-        logger.exception('problem with getting weather: %s', e)
-        return MSG_RETURN('notice', 'problem with getting weather')
+            process = self.processes[shard]
+            if process is not None:
+                process.join(timeout)
 
 
 ##############################################################################
@@ -365,18 +3187,28 @@ class MatrixHandler(object):
     __slots__ = [
         'client',
         'config',
-        'db',
+        'engine',
         'giphy_api_key',
+        'history',
         'hostname',
+        'metrics_dumped',
         'openweathermap_api_key',
+        'outbox',
         'password',
-        'stored_msg',
+        'recent',
+        'reply_thread',
+        'saved_sync_token',
+        'seen_events',
+        'session_path',
+        'shards',
+        'stop_sync',
         'sync_process',
         'uid',
         'username',
+        'workers',
     ]
 
-    def __init__(self, config: Dict[str, str]) -> None:
+    def __init__(self, config: Dict) -> None:
         self.config = config
 
         self.hostname = config['hostname']
@@ -384,81 +3216,490 @@ class MatrixHandler(object):
         self.password = config['password']
         self.uid = config['uid']
 
-        self.db = get_db()
-        self.stored_msg = Query()
+        # access token and sync position are kept here between restarts
+        self.session_path = config.get('session_path', 'session.json')
+        self.saved_sync_token = None  # type: Union[str, None]
+
+        # set to let the sync process finish its work and end
+        self.stop_sync = Event()
+
+        self.history = get_history(config)
+        self.recent = RecentMessages(
+            self.history,
+            maxlen=config.get('recent_msgs', HISTORY_LIMIT),
+            max_senders=config.get('recent_senders', 10000),
+        )
+
+        # event ids that were handled already, replays get skipped
+        self.seen_events = TTLCache(
+            maxsize=config.get('seen_events_size', 10000),
+            ttl=config.get('seen_events_ttl', 24 * 3600.0),
+            path=config.get('seen_events_path'),
+            save_interval=config.get('seen_events_save_interval', 10.0),
+        )
 
         self.giphy_api_key = config['giphy_api_key']
         self.openweathermap_api_key = config['openweathermap_api_key']
 
-    def on_message(self, room: Room, event: Dict) -> None:
+        # process: sync in a forked process, routes on a thread pool
+        # asyncio: sync and routes on one event loop
+        self.engine = config.get('engine', 'process')
+        if self.engine not in ('process', 'asyncio'):
+            raise ValueError(f'unknown engine {self.engine}')
+
+        self.workers = RoomWorkers(
+            workers=config.get('workers', 4),
+            max_pending=config.get('max_pending', 100),
+        )  # type: Union[RoomWorkers, AsyncRoomWorkers]
+
+        # replies are sent in the background, retried and rate limited
+        self.outbox = SendQueue(
+            self.send_event,
+            max_retries=config.get('send_retries', 5),
+            backoff=config.get('send_backoff', 1.0),
+            max_chars=config.get('send_coalesce_chars', 4000),
+        )
+
+        # rooms spread over worker processes, replies come back here
+        shards = config.get('shards', 0)
+        if shards and config.get('history_backend', 'sqlite') != 'sqlite':
+            raise ValueError('shards need the sqlite history backend')
+
+        self.shards = ShardPool(shards) if shards else None
+        self.reply_thread = None  # type: Union[threading.Thread, None]
+
+        self.metrics_dumped = time.monotonic()
+
+    def on_message(self, room: 'Room', event: Dict) -> None:
         """Callback for recieved messages
 
-        Gets events and checks if something can be triggered.
+        Gets events and checks if something can be triggered. Events
+        that were seen before, after a reconnect or a retried sync, are
+        skipped.
         """
         logger.debug(event)
 
+        event_id = event.get('event_id')
+        if event_id is not None:
+
+            if self.seen_events.get(event_id) is not MISSING:
+                logger.info('skipping replayed event %s', event_id)
+                METRICS.inc('mossbot_events_replayed_total')
+                return
+
+            self.seen_events.set(event_id, True)
+
+        METRICS.inc('mossbot_events_total', room=room.room_id)
+
+        # the shard of the room stores and serves the msg
+        if self.shards is not None:
+            self.shards.submit(room.room_id, event)
+            return
+
+        # storing and serving run in one job of the room, so routes only
+        # see the msgs that came before their own and the sync loop goes on
+        self.workers.submit(
+            room.room_id,
+            self.process_message_async if self.engine == 'asyncio'
+            else self.process_message,
+            room,
+            event,
+        )
+
+    def should_serve(self, event: Dict) -> bool:
+        """Checks if an event is a text msg from someone else"""
+        return event['content'].get('msgtype') == 'm.text' and \
+            event['sender'] != self.uid
+
+    def process_message(self, room: 'Room', event: Dict) -> None:
+        """Stores a msg and serves it, runs as a job of its room"""
         logger.info('stores msg in db')
         self.store_msg(event)
 
-        if event['content'].get('msgtype') == 'm.text' and event['sender'] != \
-                self.uid:
+        if self.should_serve(event):
 
-            # add config to event
+            # add config and recent msgs to event
             event['config'] = self.config
+            event['recent'] = self.recent
 
-            # gives event to mossbot and watching out for a return message
-            msg = MOSS.serve(event)
+            self.handle_message(room, event)
 
-            if msg and msg.data:
+    async def process_message_async(self, room: 'Room', event: Dict) -> None:
+        """Like process_message, but on the event loop"""
+        logger.info('stores msg in db')
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.store_msg, event
+        )
 
-                if msg.type == 'text':
-                    logger.info('sending text msg...')
-                    room.send_text(msg.data)
+        if self.should_serve(event):
 
-                elif msg.type == 'notice':
-                    logger.info('sending notice msg...')
-                    room.send_notice(msg.data)
+            # add config and recent msgs to event
+            event['config'] = self.config
+            event['recent'] = self.recent
 
-                elif msg.type == 'html':
-                    logger.info('sending html msg...')
-                    room.send_html(msg.data)
+            await self.handle_message_async(room, event)
 
-                elif msg.type == 'image':
-                    logger.info('sending image msg...')
-                    self.write_media('image', room, msg.data)
+    def work_shard(self, events: Connection, replies: Connection) -> None:
+        """Stores and serves the msgs of a shard, runs in its process
 
-                else:
-                    logger.error(
-                        'could not recognize msg type "%s"',
-                        msg[0]
-                    )
+        :param events: connection to read events from
+        :param replies: connection to write replies to
+        """
+        while True:
+            try:
+                item = events.recv()
+            except EOFError:
+                # the sync process ended without stopping the shards
+                item = None
+
+            if item is None:
+                # buffered msgs would wait for the next start otherwise
+                self.history.flush()
+                return
+
+            room_id, event = item
+
+            try:
+                self.store_msg(event)
+
+                if self.should_serve(event):
+
+                    event['config'] = self.config
+                    event['recent'] = self.recent
+
+                    for msg in MOSS.serve_all(event):
+                        replies.send((room_id, msg))
+
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception('shard could not serve msg: %s', e)
+
+    def read_replies(self, shards: ShardPool) -> None:
+        """Sends the replies of the shards, runs in a thread"""
+        while shards.reply_readers:
+            # a timeout picks up the replies of restarted shards
+            for room_id, msg in shards.receive(1.0):
+                room = self.client.rooms.get(room_id)
+
+                if room is None:
+                    logger.error('reply for unknown room %s', room_id)
+                    continue
+
+                # images are downloaded and uploaded before they are sent
+                self.workers.submit(room_id, self.send_reply, room, msg)
+
+    def start_reply_reader(self) -> None:
+        """Starts reading replies of the shards in this process"""
+        if self.shards is None:
+            return
+
+        # the thread does not survive forking the sync process
+        if self.reply_thread is None or not self.reply_thread.is_alive():
+            self.reply_thread = threading.Thread(
+                target=self.read_replies,
+                args=(self.shards, ),
+                daemon=True,
+            )
+            self.reply_thread.start()
+
+    def on_event(self, event: Dict) -> None:
+        """Callback for msgs in all rooms, passes them on with their room"""
+        self.on_message(self.client.rooms[event['room_id']], event)
+
+    def handle_message(self, room: 'Room', event: Dict) -> None:
+        """Serves an event and sends the reply to its room"""
+        # gives event to mossbot and watching out for return messages
+        replies = MOSS.serve_all(event)
+        if not replies:
+            logger.debug('no matching in event')
+
+        for msg in replies:
+            self.send_reply(room, msg)
+
+    async def handle_message_async(self, room: 'Room', event: Dict) -> None:
+        """Serves an event on the event loop and sends the reply"""
+        replies = await MOSS.serve_all_async(event)
+        if not replies:
+            logger.debug('no matching in event')
+
+        for msg in replies:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.send_reply, room, msg
+            )
 
-            elif msg and msg.type == 'skip':
-                logger.info('skipping msg...')
+    def send_reply(self, room: 'Room', msg: Union[MSG_RETURN, None]) -> None:
+        """Sends the reply of a route to a room"""
+        if msg and msg.data:
+
+            if msg.type == 'text':
+                logger.info('sending text msg...')
+                self.outbox.put(
+                    room.room_id,
+                    {'msgtype': 'm.text', 'body': msg.data}
+                )
+
+            elif msg.type == 'notice':
+                logger.info('sending notice msg...')
+                self.outbox.put(
+                    room.room_id,
+                    {'msgtype': 'm.notice', 'body': msg.data}
+                )
+
+            elif msg.type == 'html':
+                logger.info('sending html msg...')
+                self.outbox.put(
+                    room.room_id,
+                    {
+                        'msgtype': 'm.text',
+                        'body': re.sub('<[^<]+?>', '', msg.data),
+                        'format': 'org.matrix.custom.html',
+                        'formatted_body': msg.data,
+                    }
+                )
+
+            elif msg.type == 'image':
+                logger.info('sending image msg...')
+                self.write_media('image', room, msg.data)
 
             else:
-                logger.debug('no matching in event')
+                logger.error(
+                    'could not recognize msg type "%s"',
+                    msg[0]
+                )
+
+        elif msg and msg.type == 'skip':
+            logger.info('skipping msg...')
+
+        else:
+            logger.debug('no matching in event')
+
+    def send_event(self, room_id: str, content: Dict, txn_id: str) -> None:
+        """Sends a m.room.message event with a fixed transaction id"""
+        self.client.api.send_message_event(
+            room_id,
+            'm.room.message',
+            content,
+            txn_id=txn_id,
+        )
 
     def on_invite(self, room_id, state):
         """Callback for recieving invites"""
         logger.info('got invite for room %s', room_id)
         self.client.join_room(room_id)
 
+    def load_session(self) -> Union[Dict, None]:
+        """Reads the saved session of this account
+
+        :returns: session dict or None
+        """
+        if not self.session_path:
+            return None
+
+        try:
+            with open(self.session_path) as f:
+                session = json.load(f)
+
+        except FileNotFoundError:
+            return None
+
+        except ValueError:
+            logger.exception('could not read session %s', self.session_path)
+            return None
+
+        if session.get('hostname') != self.hostname or \
+                session.get('username') != self.username:
+            logger.info('saved session is for another account')
+            return None
+
+        return session
+
+    def save_session(self) -> None:
+        """Saves access token and sync token if the sync token changed"""
+        if not self.session_path or \
+                self.client.sync_token == self.saved_sync_token:
+            return
+
+        try:
+            write_json(
+                self.session_path,
+                {
+                    'hostname': self.hostname,
+                    'username': self.username,
+                    'user_id': self.client.user_id,
+                    'access_token': self.client.api.token,
+                    'next_batch': self.client.sync_token,
+                },
+                mode=0o600
+            )
+            self.saved_sync_token = self.client.sync_token
+
+        except OSError:
+            logger.exception('could not save session')
+
+    def drop_session(self) -> None:
+        """Removes the saved session"""
+        if self.session_path:
+            try:
+                os.remove(self.session_path)
+            except FileNotFoundError:
+                pass
+
+    def login(self) -> None:
+        """Restores the saved session or logs in with password
+
+        A restored session continues with an incremental sync from the
+        saved sync token.
+        """
+        logger.info('create matrix client')
+        self.client = matrix_client.MatrixClient(self.hostname)
+
+        session = self.load_session()
+        if session:
+            logger.info('restore session of %s', session['user_id'])
+            self.client.api.token = session['access_token']
+            self.client.token = session['access_token']
+            self.client.user_id = session['user_id']
+            self.client.sync_token = session['next_batch']
+            self.saved_sync_token = session['next_batch']
+
+        else:
+            logger.info('login with password')
+            self.client.login_with_password(
+                self.username,
+                self.password
+            )
+            self.save_session()
+
     def listen_forever(self, timeout_ms: int = 30000) -> None:
-        """Loop to run _sync in a process"""
-        while True:
+        """Loop to run _sync in a process
+
+        Returns when the access token got rejected, so the parent can log
+        in again.
+        """
+        # shards belong to the sync process and end with it, they are
+        # forked before any thread gets started here. a shard that ended
+        # ends the sync process, the parent starts it over
+        if self.shards is not None:
+            self.shards.start(self.work_shard, self.stop_sync.set)
+
+        # metrics live in the sync process, so they get served from here
+        self.serve_metrics()
+        self.start_reply_reader()
+
+        while not self.stop_sync.is_set():
 
             try:
                 # pylint: disable=protected-access
-                self.client._sync(timeout_ms)
+                with METRICS.timer('mossbot_sync_seconds'):
+                    self.client._sync(timeout_ms)
+                self.seen_events.save()
+                self.save_session()
+                self.dump_metrics()
+
+            except MatrixRequestError as e:
+                if e.code == 401:
+                    logger.error('access token got rejected: %s', e)
+                    self.drop_session()
+                    self.seen_events.save()
+                    return
+
+                logger.exception('problem with sync: %s', e)
+                self.stop_sync.wait(10)
+
             except BaseException as e:
                 logger.exception('problem with sync: %s', e)
-                time.sleep(10)
+                self.stop_sync.wait(10)
 
             time.sleep(0.1)
 
+        self.drain()
+
+    def drain(self) -> None:
+        """Finishes the queued jobs and msgs before the sync process ends"""
+        logger.info('finish queued work')
+
+        # shards store and serve their events, the reader hands the
+        # replies to the workers until all shards ended
+        if self.shards is not None:
+            self.shards.stop()
+
+            if self.reply_thread is not None:
+                self.reply_thread.join(5)
+
+        if isinstance(self.workers, RoomWorkers):
+            self.workers.shutdown()
+
+        if not self.outbox.flush(self.config.get('drain_timeout', 30.0)):
+            logger.error('could not send all queued msgs')
+
+        self.history.flush()
+        self.seen_events.save()
+
+    async def listen_async(self, timeout_ms: int = 30000) -> None:
+        """Long polls sync on the event loop
+
+        The blocking sync request runs in a thread of its own, listeners
+        get called from there and hand msgs over to the loop. There is no
+        polling, waiting for the next batch takes no CPU.
+
+        Returns when the access token got rejected.
+        """
+        loop = asyncio.get_event_loop()
+        sync_executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            while True:
+
+                try:
+                    with METRICS.timer('mossbot_sync_seconds'):
+                        await loop.run_in_executor(
+                            sync_executor,
+                            # pylint: disable=protected-access
+                            self.client._sync,
+                            timeout_ms,
+                        )
+                    self.seen_events.save()
+                    self.save_session()
+                    self.dump_metrics()
+
+                except MatrixRequestError as e:
+                    if e.code == 401:
+                        logger.error('access token got rejected: %s', e)
+                        self.drop_session()
+                        self.seen_events.save()
+                        return
+
+                    logger.exception('problem with sync: %s', e)
+                    await asyncio.sleep(10)
+
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.exception('problem with sync: %s', e)
+                    await asyncio.sleep(10)
+
+        finally:
+            sync_executor.shutdown(wait=False)
+
+    def serve_metrics(self) -> None:
+        """Starts the metrics server if there is a ``metrics_port``"""
+        metrics_port = self.config.get('metrics_port')
+
+        if metrics_port is not None:
+            METRICS.serve(
+                metrics_port,
+                self.config.get('metrics_host', '127.0.0.1'),
+            )
+
+    def dump_metrics(self) -> None:
+        """Writes the metrics to ``metrics_path`` every interval"""
+        metrics_path = self.config.get('metrics_path')
+
+        if metrics_path and time.monotonic() - self.metrics_dumped >= \
+                self.config.get('metrics_interval', 60):
+            METRICS.dump(metrics_path)
+            self.metrics_dumped = time.monotonic()
+
     def start_listener_process(self, timeout_ms: int = 30000) -> None:
         """Create sync process."""
+        self.stop_sync = Event()
         self.sync_process = Process(
             target=self.listen_forever,
             args=(timeout_ms, ),
@@ -467,40 +3708,62 @@ class MatrixHandler(object):
         self.sync_process.start()
 
     def connect(self) -> None:
-        """Connection handler."""
-        while True:
+        """Connection handler.
 
-            try:
+        With ``reconnect_minutes`` set the sync process gets restarted
+        regularly, otherwise only when it ends.
+        """
+        if self.engine == 'asyncio':
+            self.connect_async()
+            return
 
-                logger.info('create matrix client')
-                self.client = MatrixClient(self.hostname)
+        reconnect_minutes = self.config.get('reconnect_minutes', 10)
+        backoff = 0.0
 
-                logger.info('login with password')
-                self.client.login_with_password(
-                    self.username,
-                    self.password
-                )
+        while True:
 
-                for room_id in self.client.get_rooms():
-                    logger.info('join room %s', room_id)
+            try:
 
-                    room = self.client.join_room(room_id)
-                    room.add_listener(self.on_message)
+                self.login()
 
+                self.client.add_listener(self.on_event, 'm.room.message')
                 self.client.add_invite_listener(self.on_invite)
                 self.start_listener_process()
+                started = time.monotonic()
+
+                self.sync_process.join(
+                    reconnect_minutes * 60 if reconnect_minutes else None
+                )
 
-                start_time = pendulum.now()
-                while True:
+                if self.sync_process.is_alive():
+                    logger.info('planed reconnect')
+                    backoff = 0.0
+                    self.stop_sync.set()
 
-                    if pendulum.now() >= start_time.add(minutes=10):
+                    # the last long poll plus sending what is queued
+                    self.sync_process.join(
+                        30 + self.config.get('drain_timeout', 30.0) + 5
+                    )
 
-                        logger.info('planed reconnect')
+                    if self.sync_process.is_alive():
+                        logger.error('sync process did not end, kill it')
                         self.sync_process.terminate()
+                        self.sync_process.join()
 
-                        break
-
-                    time.sleep(0.1)
+                else:
+                    # a process dying right away, e.g. on a busy metrics
+                    # port, waits longer each time instead of forking in
+                    # a tight loop
+                    if time.monotonic() - started < 60:
+                        backoff = min(max(backoff * 2, 1.0), 300.0)
+                    else:
+                        backoff = 0.0
+
+                    logger.warning(
+                        'sync process ended, reconnect in %.0fs',
+                        backoff
+                    )
+                    time.sleep(backoff)
 
             except KeyboardInterrupt:
                 logger.info('GoodBye')
@@ -511,55 +3774,136 @@ class MatrixHandler(object):
                 logger.exception('problem while try to connect: %s', e)
                 time.sleep(10)
 
-    def write_media(self, media_type: str, room: Room, url: str) -> None:
+    def connect_async(self) -> None:
+        """Connection handler of the asyncio engine
+
+        Sync, routes, sending and uploads share one event loop in this
+        process. ``workers`` threads run the blocking parts.
+        """
+        connect_all([self], self.config)
+
+    async def run_async(self) -> None:
+        """Logs in and syncs on the running event loop, reconnects forever"""
+        loop = asyncio.get_event_loop()
+
+        self.workers = AsyncRoomWorkers(
+            loop,
+            max_pending=self.config.get('max_pending', 100),
+        )
+        self.start_reply_reader()
+
+        while True:
+
+            try:
+
+                # every login brings a new client that needs the listeners
+                await loop.run_in_executor(None, self.login)
+                self.client.add_listener(self.on_event, 'm.room.message')
+                self.client.add_invite_listener(self.on_invite)
+
+                await self.listen_async()
+                logger.warning('sync of %s ended, reconnect', self.uid)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception('problem while try to connect: %s', e)
+                await asyncio.sleep(10)
+
+    def write_media(self, media_type: str, room: 'Room', url: str) -> None:
         """Get media, upload it and post to room
+
+        Uploads are cached by url and by content hash, a known url is
+        posted without downloading it again and known content is not
+        uploaded again.
         """
         # image is the only media type supported right now
         if media_type != 'image':
             logger.error('%s as media type is not supported', media_type)
             return None
 
+        media = MEDIA.get(('url', url))
+        if media is MISSING:
+            media = MEDIA.set(('url', url), self.upload_image(url))
+
+        if not media:
+            logger.error('no image to send for %s', url)
+            return None
+
+        # getting name
+        name = urlsplit(url).path.split('/')[-1]
+
+        # send image to room
+        logger.info('send media: %s', name)
+        self.outbox.put(
+            room.room_id,
+            {
+                'msgtype': 'm.image',
+                'url': media['uri'],
+                'body': name,
+                'info': media['info'],
+            }
+        )
+
+    def upload_image(self, url: str) -> Union[Dict, None]:
+        """Downloads an image and uploads it to the homeserver
+
+        :param url: image url
+        :returns: dictionary with mxc uri and image info
+        """
         # getting image and analyze it
         logger.info('download %s', url)
-        image_data = get_image(url)
+        image_data = get_image(
+            url,
+            self.config.get('media_max_bytes', MEDIA_MAX_BYTES)
+        )
         logger.debug('got image_data: %s', image_data)
 
         if not image_data:
             logger.error('got no image_data')
-            return
+            return None
 
-        # analyze image file and create image info dict
-        media_info = {}  # type: Dict[str, Union[str, int, BytesIO, None]]
+        try:
 
-        # getting mimetype
-        media_info['mimetype'] = image_data.get('content-type')
-        if not media_info['mimetype']:
-            media_info['mimetype'] = mimetypes.guess_type(url)[0]
+            # analyze image file and create image info dict
+            media_info = {}  # type: Dict[str, Union[str, int, None]]
 
-        # getting name
-        name = urlsplit(url).path.split('/')[-1]
+            # getting mimetype
+            media_info['mimetype'] = image_data.get('content-type')
+            if not media_info['mimetype']:
+                media_info['mimetype'] = mimetypes.guess_type(url)[0]
 
-        # image size
-        media_info['h'] = image_data.get('height')
-        media_info['w'] = image_data.get('width')
+            # image size
+            media_info['h'] = image_data.get('height')
+            media_info['w'] = image_data.get('width')
+            media_info['size'] = image_data.get('size')
 
-        logger.debug('media_info content: %s', media_info)
+            logger.debug('media_info content: %s', media_info)
 
-        # upload it to homeserver
-        logger.info('upload file')
-        uploaded = self.client.upload(
-            image_data['image'],
-            media_info['mimetype']
-        )
-        logger.debug('upload: %s', uploaded)
+            # same content was uploaded before
+            uploaded = MEDIA.get(('sha256', image_data['sha256']))
+            if uploaded is MISSING:
 
-        # send image to room
-        logger.info('send media: %s', name)
-        room.send_image(
-            uploaded,
-            name,
-            **media_info
-        )
+                # upload it to homeserver
+                logger.info('upload file')
+                uploaded = MEDIA.set(
+                    ('sha256', image_data['sha256']),
+                    self.client.upload(
+                        image_data['image'],
+                        media_info['mimetype']
+                    )
+                )
+                logger.debug('upload: %s', uploaded)
+                METRICS.inc(
+                    'mossbot_upload_bytes_total',
+                    image_data.get('size') or 0
+                )
+
+            return {'uri': uploaded, 'info': media_info}
+
+        finally:
+            image_data['image'].close()
 
     def store_msg(self, event: Dict) -> None:
         """Store msgs in a db"""
@@ -567,27 +3911,18 @@ class MatrixHandler(object):
 
         try:
 
-            msgs_table = self.db.table('msgs')
-
             if event['content']['msgtype'] == 'm.text':
 
-                all_sender_msgs = msgs_table.search(
-                    self.stored_msg.sender == event['sender']
-                )
-
-                while len(all_sender_msgs) >= 10:
-
-                    msgs_table.remove(doc_ids=[all_sender_msgs[0].doc_id])
-
-                    all_sender_msgs = msgs_table.search(
-                        self.stored_msg.sender == event['sender']
+                with METRICS.timer('mossbot_history_store_seconds'):
+                    self.history.store(
+                        event['room_id'],
+                        event['sender'],
+                        event['content']['body'],
                     )
-
-                msgs_table.insert(
-                    {
-                        'sender': event['sender'],
-                        'body': event['content']['body'],
-                    }
+                self.recent.add(
+                    event['room_id'],
+                    event['sender'],
+                    event['content']['body'],
                 )
 
         except BaseException:
@@ -596,20 +3931,158 @@ class MatrixHandler(object):
             return None
 
 
+def account_configs(config: Dict) -> List[Dict]:
+    """Splits a config into one config per account
+
+    Every entry of ``accounts`` is laid over the shared settings. Shared
+    or default history, journal, session and seen event files get the
+    account in their name, so accounts do not overwrite each other.
+    Accounts always use the asyncio engine.
+
+    :param config: parsed config
+    :returns: list of account configs
+    """
+    accounts = config.get('accounts')
+    if not accounts:
+        return [config]
+
+    shared = {k: v for k, v in config.items() if k != 'accounts'}
+    configs = []
+
+    for account in accounts:
+        merged = dict(shared, engine='asyncio')
+        merged.update(account)
+
+        # the defaults of get_history and MatrixHandler, the journal
+        # follows the history path unless it is set
+        defaults = {
+            'history_path': 'history.json'
+            if merged.get('history_backend') == 'memory' else 'db.sqlite',
+            'session_path': 'session.json',
+        }
+
+        name = re.sub(r'\W+', '_', merged['uid'].lstrip('@'))
+        for key in (
+                'history_path',
+                'history_journal_path',
+                'session_path',
+                'seen_events_path',
+        ):
+            path = merged.get(key, defaults.get(key))
+            if key not in account and path:
+                root, ext = os.path.splitext(path)
+                merged[key] = f'{root}.{name}{ext}'
+
+        configs.append(merged)
+
+    return configs
+
+
+def connect_all(handlers: List[MatrixHandler], config: Dict) -> None:
+    """Runs the accounts of the handlers on one event loop
+
+    They share the routes, the HTTP pool, the caches, the metrics and
+    ``workers`` threads for the blocking parts.
+
+    :param handlers: handlers of the accounts
+    :param config: shared settings
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=config.get('workers', 4) or 1)
+    )
+
+    accounts = asyncio.gather(*(handler.run_async() for handler in handlers))
+
+    def shard_ended() -> None:
+        loop.call_soon_threadsafe(accounts.cancel)
+
+    # shards are forked before any thread gets started, a shard that
+    # ended ends the bot, so it gets started over by its supervisor
+    for handler in handlers:
+        if handler.shards is not None:
+            handler.shards.start(handler.work_shard, shard_ended)
+
+    handlers[0].serve_metrics()
+
+    try:
+        loop.run_until_complete(accounts)
+
+    except asyncio.CancelledError:
+        logger.error('a shard ended, exit')
+        sys.exit(1)
+
+    except KeyboardInterrupt:
+        logger.info('GoodBye')
+        loop.close()
+        sys.exit()
+
+
 ##############################################################################
 # USER INTERFACE
 ##############################################################################
 
 
+# everything between the imports and here
+STARTUP.append(('mossbot module', time.perf_counter() - STARTUP_BEGIN, 0))
+
+
+def print_startup_report() -> None:
+    """Prints the duration of the startup stages
+
+    Lazy modules that are not imported yet get imported first, so the
+    report covers everything the bot loads before it connects.
+    """
+    for module in LAZY_MODULES:
+        module.resolve()
+
+    click.echo(f'{"stage":<36}{"ms":>10}')
+    for stage, seconds, depth in STARTUP:
+        click.echo(f'{"  " * depth + stage:<36}{seconds * 1000:>10.1f}')
+
+    total = sum(seconds for _, seconds, depth in STARTUP if not depth)
+    click.echo(f'{"total":<36}{total * 1000:>10.1f}')
+
+
 @click.command()
 @click.argument('config', type=click.File('r'))
 @click.option('--debug', is_flag=True)
-def main(config: click.File, debug: bool) -> None:
+@click.option(
+    '--startup-report',
+    is_flag=True,
+    help='print the import and init time per stage and exit',
+)
+def main(config: click.File, debug: bool, startup_report: bool) -> None:
     """Main"""
     if debug:
         loglevel(logging.DEBUG)
 
-    MatrixHandler(yaml.load(config)).connect()
+    with startup_stage('load config'):
+        conf = yaml.safe_load(config)
+
+    with startup_stage('configure http'):
+        HTTP.configure(conf)
+        FETCHES.configure(conf)
+
+    with startup_stage('configure caches'):
+        configure_caches(conf)
+
+    with startup_stage('load plugins'):
+        load_plugins(conf)
+
+    with startup_stage('create handlers'):
+        configs = account_configs(conf)
+        handlers = [MatrixHandler(i) for i in configs]
+
+    if startup_report:
+        print_startup_report()
+        return
+
+    if len(handlers) == 1:
+        handlers[0].connect()
+    else:
+        connect_all(handlers, conf)
 
 
 if __name__ == '__main__':
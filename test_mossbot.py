@@ -1,9 +1,22 @@
 # pylint: disable=redefined-builtin,missing-docstring
 
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
 from io import BytesIO
 from unittest import mock
+from urllib.request import urlopen
 
 import pytest
+from click.testing import CliRunner
 
 import mossbot
 
@@ -32,6 +45,573 @@ def test_serve(input, expected):
     assert moss.serve({'content': {'body': input}}) == expected
 
 
+@pytest.mark.parametrize('pattern,expected', [
+    (r'^(?P<route>!ping)$', (True, '!ping')),
+    (r'(?P<route>^HTTP[s]?://.*)', (True, 'http')),
+    (r'^s/(?P<route>.+)/(?P<msg>.+)$', (True, 's/')),
+    (r'(?P<route>hello)\s?(?P<msg>.*)', (False, 'hello')),
+    (r'(?m)^(?P<route>!ping)$', (False, '!ping')),
+    (r'(?P<route>\bfoo)', (False, '')),
+    (r'(?:foo|bar)', (False, '')),
+])
+def test_route_prefix(pattern, expected):
+    assert mossbot.route_prefix(re.compile(pattern, re.IGNORECASE)) == \
+        expected
+
+
+@pytest.mark.parametrize('input,expected', [
+    ('look at foo.bar', 'foo.bar'),
+    ('nothing to see', None),
+])
+def test_serve_prefilter(input, expected):
+    moss = mossbot.MossBot()
+
+    @moss.route(r'(?P<route>\w+\.\w+)', prefilter=('.', ))
+    # pylint: disable=unused-variable
+    def prefiltered(route=None, msg=None, event=None):
+        return route
+
+    assert moss.serve({'content': {'body': input}}) == expected
+
+
+def test_serve_order():
+    moss = mossbot.MossBot()
+
+    @moss.route(r'(?P<route>foo)')
+    # pylint: disable=unused-variable
+    def first(route=None, msg=None, event=None):
+        return 'first'
+
+    @moss.route(r'^(?P<route>!foo)')
+    # pylint: disable=unused-variable
+    def second(route=None, msg=None, event=None):
+        return 'second'
+
+    assert moss.serve({'content': {'body': '!foo'}}) == 'first'
+
+    @moss.route(r'(?P<route>foo)')
+    # pylint: disable=unused-variable
+    def third(route=None, msg=None, event=None):
+        return 'third'
+
+    assert moss.serve({'content': {'body': '!FOO'}}) == 'third'
+    assert len(moss.compiled) == 2
+
+
+def test_serve_priority():
+    moss = mossbot.MossBot()
+
+    @moss.route(r'(?P<route>foo)')
+    # pylint: disable=unused-variable
+    def anywhere(route=None, msg=None, event=None):
+        return 'anywhere'
+
+    @moss.route(r'^(?P<route>!foo)', priority=5)
+    # pylint: disable=unused-variable
+    def command(route=None, msg=None, event=None):
+        return 'command'
+
+    @moss.route(r'^(?P<route>!foobar)', priority=5)
+    # pylint: disable=unused-variable
+    def longer(route=None, msg=None, event=None):
+        return 'longer'
+
+    assert moss.serve({'content': {'body': '!foobar'}}) == 'command'
+    assert moss.serve({'content': {'body': 'a foo'}}) == 'anywhere'
+
+    assert [i.func.__name__ for i in moss.candidates('!FOOBAR')] == [
+        'command', 'longer', 'anywhere'
+    ]
+    assert [i.func.__name__ for i in moss.candidates('!fo')] == []
+    assert [i.func.__name__ for i in moss.candidates('!fofoo')] == [
+        'anywhere'
+    ]
+
+    # registering a route again replaces its function and priority
+    @moss.route(r'(?P<route>foo)', priority=10)
+    # pylint: disable=unused-variable
+    def first(route=None, msg=None, event=None):
+        return 'first'
+
+    assert moss.serve({'content': {'body': '!foobar'}}) == 'first'
+
+
+def test_serve_all_matches():
+    moss = mossbot.MossBot()
+
+    @moss.route(r'(?P<route>foo)')
+    # pylint: disable=unused-variable
+    def anywhere(route=None, msg=None, event=None):
+        return 'anywhere'
+
+    @moss.route(r'^(?P<route>!foo)', priority=5)
+    # pylint: disable=unused-variable
+    async def command(route=None, msg=None, event=None):
+        return 'command'
+
+    @moss.route(r'^(?P<route>!foo)bar')
+    # pylint: disable=unused-variable
+    def nothing(route=None, msg=None, event=None):
+        return None
+
+    event = {'content': {'body': '!foobar'}}
+    assert moss.serve_all(event) == ['command']
+
+    event['config'] = {'route_all_matches': True}
+    assert moss.serve_all(event) == ['command', 'anywhere']
+    assert moss.serve(event) == 'command'
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(moss.serve_all_async(event)) == [
+            'command', 'anywhere'
+        ]
+    finally:
+        loop.close()
+
+
+def test_candidates_many_routes():
+    moss = mossbot.MossBot()
+
+    for i in range(100):
+        moss.route(rf'^(?P<route>!cmd{i})$')(lambda route, msg, event: route)
+
+    assert [i.regex.pattern for i in moss.candidates('!cmd42')] == [
+        r'^(?P<route>!cmd4)$', r'^(?P<route>!cmd42)$'
+    ]
+    assert moss.candidates('hello') == []
+    assert moss.serve({'content': {'body': '!cmd42'}}) == '!cmd42'
+
+
+def test_load_plugins_from_path(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+
+    tmpdir.join('shout.yml').write(
+        '- pattern: \'^(?P<route>!shout)\\s+(?P<msg>.+)\'\n'
+        '  handler: \'mossbot_shout:shout\'\n'
+        '  priority: 20\n'
+    )
+    tmpdir.join('mossbot_shout.py').write(
+        'import mossbot\n'
+        '\n'
+        '\n'
+        'def shout(route, msg, event):\n'
+        '    return mossbot.MSG_RETURN(\'text\', msg.upper())\n'
+    )
+    tmpdir.join('README').write('not a plugin')
+
+    moss = mossbot.MossBot()
+    config = {'plugin_path': tmpdir.strpath, 'plugin_entry_points': False}
+
+    assert mossbot.load_plugins(config, moss) == ['shout']
+    assert 'mossbot_shout' not in sys.modules
+    assert moss.compiled[0].priority == 20
+
+    assert moss.serve({'content': {'body': 'hello'}}) is None
+    assert 'mossbot_shout' not in sys.modules
+
+    try:
+        assert moss.serve({'content': {'body': '!shout hey'}}) == (
+            'text', 'HEY'
+        )
+        assert 'mossbot_shout' in sys.modules
+        assert (
+            'mossbot_route_handler_seconds_count{route="shout"} 1'
+        ) in mossbot.METRICS.render()
+    finally:
+        sys.modules.pop('mossbot_shout', None)
+
+
+@mock.patch('mossbot.plugin_entry_points')
+def test_load_plugins_from_entry_points(entry_points_mock):
+    entry_point = mock.Mock()
+    entry_point.name = 'foo'
+    entry_point.load.return_value = [
+        {'pattern': r'^(?P<route>!ping)$', 'handler': 'mossbot:ping'},
+        {'pattern': r'^(?P<route>!broken)$', 'handler': 'mossbot_nope:foo'},
+    ]
+    entry_points_mock.return_value = [entry_point]
+
+    moss = mossbot.MossBot()
+
+    # off by default, the lookup scans all installed packages
+    assert mossbot.load_plugins({}, moss) == []
+    assert entry_points_mock.called is False
+
+    assert mossbot.load_plugins({'plugin_entry_points': True}, moss) == [
+        'foo'
+    ]
+    assert moss.serve({'content': {'body': '!ping'}}).type == 'notice'
+
+    # handlers that can not be imported are logged and skipped
+    with mock.patch('mossbot.logger') as logger_mock:
+        assert moss.serve({'content': {'body': '!broken'}}) is None
+        assert logger_mock.exception.called is True
+
+
+def test_plugin_entry_points():
+    assert isinstance(mossbot.plugin_entry_points(), list)
+
+
+def test_token_buckets():
+    buckets = mossbot.TokenBuckets(maxsize=2)
+    rules = [(('foo', 'sender', '@a'), 1.0, 2.0)]
+
+    assert buckets.take(rules, now=0) == (0.0, ())
+    assert buckets.take(rules, now=0) == (0.0, ())
+    assert buckets.take(rules, now=0) == (-1.0, ('foo', 'sender', '@a'))
+
+    # half a token refilled, the other half can be waited for
+    assert buckets.take(rules, max_delay=1, now=0.5) == (
+        0.5, ('foo', 'sender', '@a')
+    )
+    assert buckets.take(rules, max_delay=1, now=0.5) == (
+        -1.0, ('foo', 'sender', '@a')
+    )
+
+    # no token is taken when one of the buckets is empty
+    both = rules + [(('foo', 'room', '!r'), 1.0, 1.0)]
+    assert buckets.take(both, max_delay=0.5, now=1) == (
+        -1.0, ('foo', 'sender', '@a')
+    )
+    assert buckets.buckets[('foo', 'room', '!r')][0] == 1
+
+    buckets.take([(('bar', 'sender', '@a'), 1.0, 1.0)], now=2)
+    assert list(buckets.buckets) == [
+        ('foo', 'room', '!r'),
+        ('bar', 'sender', '@a'),
+    ]
+
+
+def test_serve_throttle():
+    moss = mossbot.MossBot()
+
+    @moss.route(r'^(?P<route>!foo)')
+    # pylint: disable=unused-variable
+    def foo(route=None, msg=None, event=None):
+        return route
+
+    config = {
+        'throttle': {
+            'foo': {
+                'sender': {'rate': 0.001, 'burst': 2},
+                'room': {'rate': 0.001, 'burst': 3},
+            },
+        },
+    }
+
+    def serve(sender, room_id):
+        return moss.serve(
+            {
+                'content': {'body': '!foo'},
+                'sender': sender,
+                'room_id': room_id,
+                'config': config,
+            }
+        )
+
+    assert [serve('@a', '!r') for _ in range(3)] == ['!foo', '!foo', None]
+
+    # a noisy sender does not use up other rooms
+    assert serve('@a', '!s') is None
+    assert serve('@b', '!s') == '!foo'
+    assert serve('@b', '!r') == '!foo'
+    assert serve('@c', '!r') is None
+
+    text = mossbot.METRICS.render()
+    assert (
+        'mossbot_throttled_total'
+        '{action="dropped",route="foo",scope="sender"} 2'
+    ) in text
+    assert (
+        'mossbot_throttled_total'
+        '{action="dropped",route="foo",scope="room"} 1'
+    ) in text
+
+
+def test_serve_throttle_defer():
+    moss = mossbot.MossBot()
+
+    @moss.route(r'^(?P<route>!foo)')
+    # pylint: disable=unused-variable
+    async def foo(route=None, msg=None, event=None):
+        return route
+
+    event = {
+        'content': {'body': '!foo'},
+        'sender': '@a',
+        'config': {
+            'throttle': {'foo': {'sender': {'rate': 20}}},
+            'throttle_max_delay': 1,
+        },
+    }
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.monotonic()
+        for _ in range(3):
+            assert loop.run_until_complete(moss.serve_async(event)) == '!foo'
+        assert time.monotonic() - start >= 0.09
+    finally:
+        loop.close()
+
+    assert (
+        'mossbot_throttled_total'
+        '{action="deferred",route="foo",scope="sender"} 2'
+    ) in mossbot.METRICS.render()
+
+
+def test_http_client_configure():
+    http = mossbot.HTTPClient()
+    http.configure(
+        {
+            'http_connect_timeout': 1,
+            'http_read_timeout': 2,
+            'http_retries': 5,
+            'http_backoff': 0.1,
+            'http_pool_size': 4,
+        }
+    )
+
+    assert http.timeout == (1, 2)
+
+    adapter = http.session.get_adapter('https://api.giphy.com')
+
+    assert adapter is http.session.get_adapter('http://foo.bar')
+    assert adapter.max_retries.total == 5
+    assert adapter.max_retries.backoff_factor == 0.1
+    assert adapter.max_retries.respect_retry_after_header is False
+    assert adapter._pool_maxsize == 4  # pylint: disable=protected-access
+
+
+def test_http_client_lazy_session():
+    http = mossbot.HTTPClient()
+
+    assert http.session is None
+
+    with mock.patch('requests.Session') as session_mock:
+        http.get('http://foo.bar')
+        http.get('http://foo.bar')
+
+    assert session_mock.call_count == 1
+    assert session_mock.return_value.get.call_count == 2
+
+
+def test_http_client_session_per_process():
+    http = mossbot.HTTPClient()
+    http.configure({'http_retries': 5})
+    parent = http.session
+
+    # as seen from a forked process
+    http.pid = -1
+
+    with mock.patch.object(parent, 'get') as get_mock:
+        with mock.patch('requests.Session.get') as session_get_mock:
+            http.get('http://foo.bar')
+
+    assert get_mock.called is False
+    assert session_get_mock.called is True
+    assert http.session is not parent
+    assert http.pid == os.getpid()
+    assert http.session.get_adapter('http://foo.bar').max_retries.total == 5
+
+
+def test_lazy_module():
+    module = mossbot.LazyModule('colorsys')
+    mossbot.LAZY_MODULES.remove(module)
+
+    assert module.module is None
+    assert module.rgb_to_hsv(0, 0, 0) == (0, 0, 0)
+    assert module.module is sys.modules['colorsys']
+    assert mossbot.STARTUP[-1][0] == 'import colorsys'
+
+
+def test_import_is_lazy():
+    modules = subprocess.check_output(
+        [
+            sys.executable,
+            '-c',
+            'import sys, mossbot; print(" ".join(sys.modules))',
+        ],
+        cwd=os.path.dirname(os.path.abspath(mossbot.__file__)),
+    ).decode().split()
+
+    for name in ('asyncio', 'yaml', 'requests', 'PIL.Image', 'http.server'):
+        assert name not in modules
+
+
+def test_main_startup_report(monkeypatch, tmpdir, config):
+    monkeypatch.setattr(mossbot, 'URL_TITLES', mossbot.URL_TITLES)
+    monkeypatch.setattr(mossbot, 'MEDIA', mossbot.MEDIA)
+    monkeypatch.setattr(mossbot, 'STARTUP', [])
+
+    path = tmpdir.join('config.yml')
+    path.write(json.dumps(config))
+
+    with mock.patch('mossbot.MatrixHandler.connect') as connect_mock:
+        result = CliRunner().invoke(
+            mossbot.main,
+            [path.strpath, '--startup-report']
+        )
+
+    assert result.exit_code == 0
+    assert connect_mock.called is False
+
+    # nested imports are indented
+    stages = [
+        line.rsplit(None, 1)[0]
+        for line in result.output.splitlines()
+        if not line.startswith(' ')
+    ]
+
+    assert stages[:6] == [
+        'stage',
+        'load config',
+        'configure http',
+        'configure caches',
+        'load plugins',
+        'create handlers',
+    ]
+    assert stages[-1] == 'total'
+
+
+def test_http_client_get_timeout():
+    http = mossbot.HTTPClient()
+    http.session = mock.Mock()
+    http.pid = os.getpid()
+
+    http.get('http://foo.bar')
+    http.session.get.assert_called_with(
+        'http://foo.bar',
+        timeout=(3.05, 10.0)
+    )
+
+    http.get('http://foo.bar', timeout=1)
+    http.session.get.assert_called_with('http://foo.bar', timeout=1)
+
+
+def test_http_client_get_metrics():
+    http = mossbot.HTTPClient()
+    http.session = mock.Mock()
+    http.pid = os.getpid()
+    http.session.get.side_effect = [
+        mock.Mock(),
+        mossbot.requests.ConnectionError('foo'),
+    ]
+
+    http.get('http://foo.bar/baz')
+
+    with pytest.raises(mossbot.requests.ConnectionError):
+        http.get('http://foo.bar/baz')
+
+    text = mossbot.METRICS.render()
+
+    assert 'mossbot_http_request_seconds_count{host="foo.bar"} 2' in text
+    assert 'mossbot_http_errors_total{host="foo.bar"} 1.0' in text
+
+
+def test_metrics_render():
+    metrics = mossbot.Metrics(buckets=(0.1, 1.0))
+    metrics.inc('mossbot_events_total', room='!a"b:foo.tld')
+    metrics.inc('mossbot_events_total', 2, room='!a"b:foo.tld')
+    metrics.observe('mossbot_sync_seconds', 0.05)
+    metrics.observe('mossbot_sync_seconds', 0.5)
+    metrics.observe('mossbot_sync_seconds', 5)
+
+    assert metrics.render().splitlines() == [
+        '# HELP mossbot_events_total Msg events received per room',
+        '# TYPE mossbot_events_total counter',
+        'mossbot_events_total{room="!a\\"b:foo.tld"} 3.0',
+        '# HELP mossbot_sync_seconds Duration of a sync loop iteration',
+        '# TYPE mossbot_sync_seconds histogram',
+        'mossbot_sync_seconds_bucket{le="0.1"} 1',
+        'mossbot_sync_seconds_bucket{le="1.0"} 2',
+        'mossbot_sync_seconds_bucket{le="+Inf"} 3',
+        'mossbot_sync_seconds_sum 5.55',
+        'mossbot_sync_seconds_count 3',
+    ]
+
+
+def test_metrics_serve_and_dump(tmpdir):
+    metrics = mossbot.Metrics()
+    metrics.inc('mossbot_upload_bytes_total', 42)
+
+    server = metrics.serve(0)
+    try:
+        with urlopen(f'http://127.0.0.1:{server.server_port}/metrics') as r:
+            assert r.headers['Content-Type'].startswith('text/plain')
+            assert r.read().decode() == metrics.render()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    path = tmpdir.join('metrics.prom')
+    metrics.dump(path.strpath)
+
+    assert path.read() == metrics.render()
+
+
+def test_serve_metrics():
+    mossbot.MOSS.serve({'content': {'body': '!ping'}})
+    mossbot.MOSS.serve({'content': {'body': 'foo bar'}})
+
+    text = mossbot.METRICS.render()
+
+    assert 'mossbot_route_match_seconds_count{route="ping"} 1' in text
+    assert 'mossbot_route_match_seconds_count{route="none"} 1' in text
+    assert 'mossbot_route_handler_seconds_count{route="ping"} 1' in text
+
+
+def test_serve_coroutine_route():
+    moss = mossbot.MossBot()
+
+    @moss.route(r'^(?P<route>!sync)')
+    # pylint: disable=unused-variable
+    def plain(route=None, msg=None, event=None):
+        return threading.current_thread()
+
+    @moss.route(r'^(?P<route>!async)')
+    # pylint: disable=unused-variable
+    async def coroutine(route=None, msg=None, event=None):
+        await asyncio.sleep(0)
+        return route
+
+    assert moss.serve({'content': {'body': '!async'}}) == '!async'
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(
+            moss.serve_async({'content': {'body': '!async'}})
+        ) == '!async'
+
+        # plain routes run in the executor of the loop
+        assert loop.run_until_complete(
+            moss.serve_async({'content': {'body': '!sync'}})
+        ) is not threading.current_thread()
+
+        assert loop.run_until_complete(
+            moss.serve_async({'content': {'body': 'foo'}})
+        ) is None
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('input,expected', [
+    ('!ping', 'ping'),
+    ('s/foo/bar', 'replace'),
+    ('look at http://foo.bar', 'url_title'),
+    ('foo bar', None),
+])
+def test_match(input, expected):
+    matched = mossbot.MOSS.match(input)
+
+    if expected is None:
+        assert matched is None
+    else:
+        assert matched[0].func.__name__ == expected
+        assert matched[1].group('route')
+
+
 @pytest.mark.parametrize('input,expected', [
     (
         '!ping',
@@ -60,17 +640,18 @@ def test_ping(input, expected):
         ('html', '<a href="http://foo.bar">foobar</a>')
     ),
 ])
-@mock.patch('mossbot.requests.get')
-def test_url_title(requests_mock, route, html, expected):
-    requests_mock.return_value.text = html
+@mock.patch('mossbot.HTTP')
+def test_url_title(http_mock, route, html, expected):
+    http_mock.get.return_value.headers = {'Content-Type': 'text/html'}
+    http_mock.get.return_value.iter_content.return_value = [html.encode()]
 
     assert mossbot.MOSS.serve({'content': {'body': route}}) == expected
 
 
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.requests')
-def test_url_title_exception(requests_mock, logger_mock):
-    requests_mock.get.side_effect = Exception('foo bar')
+@mock.patch('mossbot.HTTP')
+def test_url_title_exception(http_mock, logger_mock):
+    http_mock.get.side_effect = Exception('foo bar')
 
     assert mossbot.MOSS.serve(
         {'content': {'body': 'http://foo.bar'}}
@@ -79,9 +660,280 @@ def test_url_title_exception(requests_mock, logger_mock):
     assert logger_mock.exception.called is True
 
 
-@mock.patch('mossbot.requests.get')
-def test_url_exception(requests_mock):
-    requests_mock.return_value.text = 'foobar'
+@mock.patch('mossbot.HTTP')
+def test_url_title_cached(http_mock):
+    http_mock.get.return_value.headers = {}
+    http_mock.get.return_value.iter_content.return_value = [
+        b'<title>foobar</title>'
+    ]
+
+    for body in ('http://foo.bar#one', 'http://foo.bar#two'):
+        assert mossbot.MOSS.serve({'content': {'body': body}}) == (
+            'html',
+            '<a href="{}">foobar</a>'.format(body)
+        )
+
+    assert http_mock.get.call_count == 1
+
+
+@mock.patch('mossbot.logger')
+@mock.patch('mossbot.HTTP')
+def test_url_title_negative_cached(http_mock, logger_mock):
+    http_mock.get.side_effect = Exception('foo bar')
+
+    for _ in range(2):
+        assert mossbot.MOSS.serve(
+            {'content': {'body': 'http://foo.bar'}}
+        ) == ('skip', None)
+
+    assert http_mock.get.call_count == 1
+    assert mossbot.URL_TITLES.get('http://foo.bar') is None
+
+
+@mock.patch('mossbot.HTTP')
+def test_url_title_many(http_mock):
+    started = threading.Barrier(4, timeout=5)
+
+    def get(url, **kwargs):
+        # all four requests have to run at the same time
+        started.wait()
+
+        response = mock.MagicMock()
+        response.headers = {}
+        response.iter_content.return_value = [
+            b'' if 'broken' in url else f'<title>{url[7:]}</title>'.encode()
+        ]
+        return response
+
+    http_mock.get.side_effect = get
+
+    body = (
+        'see http://foo.tld and http://bar.tld, http://foo.tld again, '
+        'http://broken.tld and http://baz.tld http://capped.tld'
+    )
+    config = {'url_title_max_urls': 4, 'http_fetch_workers': 4}
+
+    mossbot.FETCHES.configure(config)
+    try:
+        assert mossbot.MOSS.serve(
+            {'content': {'body': body}, 'config': config}
+        ) == (
+            'html',
+            (
+                '<a href="http://foo.tld">foo.tld</a><br>'
+                '<a href="http://bar.tld">bar.tld</a><br>'
+                '<a href="http://baz.tld">baz.tld</a>'
+            )
+        )
+    finally:
+        mossbot.FETCHES.configure({})
+
+    assert sorted(c[0][0] for c in http_mock.get.call_args_list) == [
+        'http://bar.tld', 'http://baz.tld', 'http://broken.tld',
+        'http://foo.tld',
+    ]
+
+
+def test_fetch_pool():
+    pool = mossbot.FetchPool(workers=3)
+
+    assert pool.map(lambda i: threading.current_thread(), [1]) == [
+        threading.current_thread()
+    ]
+    assert pool.map(lambda i: i * 2, list(range(10))) == list(range(0, 20, 2))
+    assert pool.executor is not None
+
+    pool.configure({'http_fetch_workers': 1})
+    assert pool.executor is None
+    assert pool.map(lambda i: threading.current_thread(), [1, 2]) == [
+        threading.current_thread()
+    ] * 2
+
+
+@mock.patch('mossbot.time')
+def test_ttl_cache_expire_and_evict(time_mock):
+    time_mock.time.return_value = 1000
+    time_mock.monotonic.return_value = 0
+
+    cache = mossbot.TTLCache(maxsize=2, ttl=10, negative_ttl=1)
+    cache.set('a', 'foo')
+    cache.set('b', None)
+
+    assert cache.get('a') == 'foo'
+    assert cache.get('b') is None
+
+    time_mock.time.return_value = 1005
+
+    assert cache.get('b') is mossbot.MISSING
+    assert cache.get('a') == 'foo'
+
+    cache.set('c', 'bar')
+    cache.set('d', 'baz')
+
+    assert cache.get('a') is mossbot.MISSING
+    assert list(cache.data.keys()) == ['c', 'd']
+
+
+def test_ttl_cache_persist(tmpdir):
+    path = tmpdir.join('cache.json').strpath
+
+    cache = mossbot.TTLCache(path=path, save_interval=3600)
+    cache.set('http://foo.bar', 'foobar')
+    cache.set(('foo', 'bar'), None)
+
+    assert not tmpdir.join('cache.json').check()
+
+    cache.save()
+
+    loaded = mossbot.TTLCache(path=path)
+
+    assert loaded.get('http://foo.bar') == 'foobar'
+    assert loaded.get(('foo', 'bar')) is None
+
+    # nothing set since the last save, the file stays as it is
+    tmpdir.join('cache.json').write('[]')
+    cache.save()
+
+    assert tmpdir.join('cache.json').read() == '[]'
+
+
+@mock.patch('mossbot.time')
+def test_sqlite_cache(time_mock, tmpdir):
+    path = tmpdir.join('cache.sqlite').strpath
+    time_mock.time.return_value = 1000.0
+
+    cache = mossbot.SQLiteCache(
+        path,
+        'foo',
+        maxsize=2,
+        ttl=10,
+        negative_ttl=1,
+        prune_interval=1,
+    )
+    other = mossbot.SQLiteCache(path, 'foo')
+
+    assert cache.get(('url', 'a')) is mossbot.MISSING
+    assert cache.set(('url', 'a'), {'uri': 'mxc://a'}) == {'uri': 'mxc://a'}
+    cache.set('b', None)
+
+    # another connection to the same file sees the entries
+    assert other.get(('url', 'a')) == {'uri': 'mxc://a'}
+    assert other.get('b') is None
+
+    time_mock.time.return_value = 1002.0
+    assert cache.get('b') is mossbot.MISSING
+
+    # least recently used entries get pruned
+    cache.set('c', 'c')
+    time_mock.time.return_value = 1002.5
+    cache.get(('url', 'a'))
+    time_mock.time.return_value = 1003.0
+    cache.set('d', 'd')
+
+    assert other.get('c') is mossbot.MISSING
+    assert other.get(('url', 'a')) == {'uri': 'mxc://a'}
+
+    time_mock.time.return_value = 1020.0
+    assert cache.get('d') is mossbot.MISSING
+
+    cache.clear()
+    time_mock.time.return_value = 1000.0
+    assert other.get(('url', 'a')) is mossbot.MISSING
+
+
+def test_configure_caches(monkeypatch, tmpdir):
+    monkeypatch.setattr(mossbot, 'URL_TITLES', mossbot.URL_TITLES)
+    monkeypatch.setattr(mossbot, 'MEDIA', mossbot.MEDIA)
+
+    mossbot.configure_caches(
+        {'shards': 2, 'cache_path': tmpdir.join('c.sqlite').strpath}
+    )
+
+    assert isinstance(mossbot.URL_TITLES, mossbot.SQLiteCache)
+    assert mossbot.MEDIA.table == 'media'
+
+    mossbot.configure_caches({'url_title_cache_size': 5})
+
+    assert isinstance(mossbot.URL_TITLES, mossbot.TTLCache)
+    assert mossbot.URL_TITLES.maxsize == 5
+
+    with pytest.raises(ValueError):
+        mossbot.configure_caches({'cache_backend': 'foo'})
+
+
+@pytest.mark.parametrize('chunks,expected', [
+    (
+        [b'<html><head><title>\n  foo\n  bar </title></head>'],
+        'foo bar'
+    ),
+    (
+        [b'<head><meta property="og:title" content="og foo">', b'</head>'],
+        'og foo'
+    ),
+    (
+        [b'<head><meta property="og:title" content="og foo"><ti', b'tle>foo'],
+        'og foo'
+    ),
+    (
+        [b'<head><title>f\xc3', b'\xbc&amp;r</title>'],
+        'f\xfc&r'
+    ),
+    (
+        [b'<head></head><body><title>foo</title></body>'],
+        None
+    ),
+])
+@mock.patch('mossbot.HTTP')
+def test_get_url_title(http_mock, chunks, expected):
+    http_mock.get.return_value.headers = {'Content-Type': 'text/html'}
+    http_mock.get.return_value.iter_content.return_value = chunks
+
+    assert mossbot.get_url_title('http://foo.bar') == expected
+
+    http_mock.get.assert_called_with('http://foo.bar', stream=True)
+    assert http_mock.get.return_value.close.called is True
+
+
+@mock.patch('mossbot.HTTP')
+def test_get_url_title_stops_reading(http_mock):
+    def chunks():
+        yield b'<head><title>foo</title>'
+        yield b'</head>'
+        raise AssertionError('read too much')
+
+    http_mock.get.return_value.headers = {}
+    http_mock.get.return_value.iter_content.return_value = chunks()
+
+    assert mossbot.get_url_title('http://foo.bar') == 'foo'
+
+    def chunks_no_head_end():
+        yield b'<head><title>foo</title><body>'
+        raise AssertionError('read too much')
+
+    http_mock.get.return_value.iter_content.return_value = \
+        chunks_no_head_end()
+
+    assert mossbot.get_url_title('http://foo.bar') == 'foo'
+
+    http_mock.get.return_value.iter_content.return_value = iter(
+        [b'<head><title>', b'x' * 10, b'</title>']
+    )
+
+    assert mossbot.get_url_title('http://foo.bar', max_bytes=12) is None
+
+
+@mock.patch('mossbot.HTTP')
+def test_get_url_title_no_html(http_mock):
+    http_mock.get.return_value.headers = {'Content-Type': 'image/png'}
+
+    assert mossbot.get_url_title('http://foo.bar/foo.png') is None
+
+    http_mock.get.return_value.iter_content.assert_not_called()
+
+
+@mock.patch('mossbot.HTTP')
+def test_url_exception(http_mock):
+    http_mock.get.return_value.text = 'foobar'
 
     with pytest.raises(Exception):
         assert mossbot.MOSS.serve('http://foo.bar') == ('skip', None)
@@ -186,15 +1038,62 @@ def test_on_message_nothing(moss_mock, store_msg_mock, matrix_handler, room):
 
     room.assert_not_called()
 
-    moss_mock.assert_not_called()
+    moss_mock.assert_not_called()
+
+    store_msg_mock.assert_called_with(event)
+
+
+@mock.patch('mossbot.MatrixHandler.handle_message')
+@mock.patch('mossbot.MatrixHandler.store_msg')
+def test_on_message_replayed(
+        store_msg_mock,
+        handle_message_mock,
+        matrix_handler,
+        room
+):
+    event = {
+        'event_id': '$foo:bar.tld',
+        'content': {'msgtype': 'm.text', 'body': '!ping'},
+        'sender': '@bar:foo.tld',
+    }
+
+    for _ in range(3):
+        matrix_handler.on_message(room, dict(event))
+
+    assert store_msg_mock.call_count == 1
+    assert handle_message_mock.call_count == 1
+    assert 'mossbot_events_replayed_total 2.0' in mossbot.METRICS.render()
+
+
+@mock.patch('mossbot.MatrixHandler.handle_message')
+@mock.patch('mossbot.MatrixHandler.store_msg')
+def test_on_message_replayed_after_restart(
+        store_msg_mock,
+        handle_message_mock,
+        config,
+        room,
+        tmpdir
+):
+    config['seen_events_path'] = tmpdir.join('seen.json').strpath
+    config['seen_events_save_interval'] = 0
+
+    event = {
+        'event_id': '$foo:bar.tld',
+        'content': {'msgtype': 'm.text', 'body': '!ping'},
+        'sender': '@bar:foo.tld',
+    }
+
+    mossbot.MatrixHandler(config).on_message(room, dict(event))
+    mossbot.MatrixHandler(config).on_message(room, dict(event))
 
-    store_msg_mock.assert_called_with(event)
+    assert store_msg_mock.call_count == 1
+    assert handle_message_mock.call_count == 1
 
 
 @mock.patch('mossbot.logger')
 @mock.patch('mossbot.MOSS', autospec=True)
 def test_on_message_no_msg(moss_mock, logger_mock, matrix_handler, room):
-    moss_mock.serve.return_value = None
+    moss_mock.serve_all.return_value = []
 
     event = {
         'content': {
@@ -229,7 +1128,7 @@ def test_on_message_image(
 
     msg = mossbot.MSG_RETURN('image', 'http://foo.tld/bar.png')
 
-    moss_mock.serve.return_value = msg
+    moss_mock.serve_all.return_value = [msg]
 
     matrix_handler.on_message(room, event)
 
@@ -262,7 +1161,7 @@ def test_on_message_reaction(
 
     msg = mossbot.MSG_RETURN('image', 'https://foo.tld/bar.gif')
 
-    moss_mock.serve.return_value = msg
+    moss_mock.serve_all.return_value = [msg]
 
     matrix_handler.on_message(room, event)
 
@@ -275,6 +1174,750 @@ def test_on_message_reaction(
     store_msg_mock.assert_called_with(event)
 
 
+def test_room_workers_order():
+    workers = mossbot.RoomWorkers(workers=2)
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def job(room_id, value):
+        if value == 'a0':
+            started.set()
+            release.wait(5)
+        done.append((room_id, value))
+
+    workers.submit('!a', job, '!a', 'a0')
+    started.wait(5)
+
+    for i in range(1, 4):
+        workers.submit('!a', job, '!a', 'a{}'.format(i))
+
+    # other rooms do not wait for the blocked one
+    workers.submit('!b', job, '!b', 'b0')
+    for _ in range(500):
+        if done:
+            break
+        time.sleep(0.01)
+
+    assert done == [('!b', 'b0')]
+
+    release.set()
+    workers.shutdown()
+
+    assert [v for r, v in done if r == '!a'] == ['a0', 'a1', 'a2', 'a3']
+    assert workers.pending == {}
+
+
+@mock.patch('mossbot.logger')
+def test_room_workers_full_and_failing(logger_mock):
+    workers = mossbot.RoomWorkers(workers=1, max_pending=1)
+    release = threading.Event()
+
+    def job():
+        release.wait(5)
+        raise KeyError('problem')
+
+    assert workers.submit('!a', job) is True
+    assert workers.submit('!a', job) is True
+    assert workers.submit('!a', job) is False
+
+    release.set()
+    workers.shutdown()
+
+    assert logger_mock.warning.called is True
+    assert logger_mock.exception.call_count == 2
+
+
+def test_room_workers_inline():
+    workers = mossbot.RoomWorkers(workers=0)
+    done = []
+
+    workers.submit('!a', done.append, 'foo')
+
+    assert done == ['foo']
+
+
+@mock.patch('mossbot.logger')
+def test_async_room_workers(logger_mock):
+    loop = asyncio.new_event_loop()
+    workers = mossbot.AsyncRoomWorkers(loop, max_pending=2)
+    done = []
+
+    async def slow(room_id, value):
+        await asyncio.sleep(0.01)
+        done.append((room_id, value))
+
+    def plain(room_id, value):
+        if value == 'fail':
+            raise KeyError('problem')
+        done.append((room_id, value))
+
+    async def run():
+        # submitted from another thread like the sync thread does
+        submitter = threading.Thread(
+            target=lambda: [
+                workers.submit('!a', slow, '!a', 'a0'),
+                workers.submit('!a', plain, '!a', 'fail'),
+                workers.submit('!a', plain, '!a', 'a1'),
+                workers.submit('!a', plain, '!a', 'dropped'),
+                workers.submit('!b', plain, '!b', 'b0'),
+            ]
+        )
+        submitter.start()
+        await loop.run_in_executor(None, submitter.join)
+        await workers.join()
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    # the slow job does not hold up other rooms
+    assert done[0] == ('!b', 'b0')
+    assert [v for r, v in done if r == '!a'] == ['a0', 'a1']
+    assert workers.pending == {}
+    assert workers.tails == {}
+    assert logger_mock.warning.called is True
+    assert logger_mock.exception.call_count == 1
+
+
+def test_on_message_asyncio_engine(config, room):
+    config['engine'] = 'asyncio'
+    handler = mossbot.MatrixHandler(config)
+    handler.client = mock.Mock()
+
+    loop = asyncio.new_event_loop()
+    handler.workers = mossbot.AsyncRoomWorkers(loop)
+
+    handler.on_message(
+        room,
+        {
+            'room_id': room.room_id,
+            'content': {'msgtype': 'm.text', 'body': '!ping'},
+            'sender': '@bar:foo.tld',
+        }
+    )
+
+    try:
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.run_until_complete(handler.workers.join())
+    finally:
+        loop.close()
+
+    handler.outbox.flush(5)
+
+    assert handler.client.api.send_message_event.call_args[0][2][
+        'msgtype'] == 'm.notice'
+
+
+def test_matrix_handler_unknown_engine(config):
+    config['engine'] = 'foo'
+
+    with pytest.raises(ValueError):
+        mossbot.MatrixHandler(config)
+
+
+@mock.patch('mossbot.logger')
+def test_send_queue_rate_limit_and_coalesce(logger_mock):
+    sent = []
+    release = threading.Event()
+
+    def send(room_id, content, txn_id):
+        if not sent:
+            sent.append((room_id, content, txn_id))
+            release.wait(5)
+            raise mossbot.MatrixRequestError(429, '{"retry_after_ms": 20}')
+        sent.append((room_id, content, txn_id))
+
+    outbox = mossbot.SendQueue(send, backoff=0.02)
+
+    outbox.put('!a', {'msgtype': 'm.text', 'body': 'first'})
+    for _ in range(500):
+        if sent:
+            break
+        time.sleep(0.01)
+
+    # queued while the first msg is in flight
+    outbox.put('!a', {'msgtype': 'm.text', 'body': 'second'})
+    outbox.put('!a', {'msgtype': 'm.text', 'body': 'third'})
+    outbox.put('!a', {'msgtype': 'm.notice', 'body': 'fourth'})
+    outbox.put('!b', {'msgtype': 'm.image', 'url': 'mxc://foo', 'body': 'b'})
+    outbox.put('!b', {'msgtype': 'm.text', 'body': 'fifth'})
+
+    release.set()
+    start = time.monotonic()
+    assert outbox.flush(5) is True
+
+    assert time.monotonic() - start >= 0.02
+    assert logger_mock.warning.called is True
+
+    # the retry reuses the transaction id
+    assert sent[0] == sent[1]
+    assert [(r, c['body']) for r, c, _ in sent[1:]] == [
+        ('!a', 'first'),
+        ('!b', 'b'),
+        ('!a', 'second\nthird'),
+        ('!b', 'fifth'),
+        ('!a', 'fourth'),
+    ]
+    assert len({txn_id for _, _, txn_id in sent}) == 5
+
+
+@mock.patch('mossbot.logger')
+def test_send_queue_errors(logger_mock):
+    calls = []
+
+    def send(room_id, content, txn_id):
+        calls.append(content['body'])
+        if content['body'] == 'forbidden':
+            raise mossbot.MatrixRequestError(403, 'M_FORBIDDEN')
+        raise ConnectionError('down')
+
+    outbox = mossbot.SendQueue(send, max_retries=3, backoff=0.001)
+    outbox.put('!a', {'msgtype': 'm.text', 'body': 'forbidden'})
+    outbox.put('!b', {'msgtype': 'm.text', 'body': 'down'})
+
+    assert outbox.flush(5) is True
+
+    assert calls.count('forbidden') == 1
+    assert calls.count('down') == 3
+    assert logger_mock.error.call_count == 2
+    assert 'mossbot_send_dropped_total 2.0' in mossbot.METRICS.render()
+
+
+def test_shard_pool_ring():
+    pool = mossbot.ShardPool(4)
+    rooms = [f'!room{i}:foo.tld' for i in range(1000)]
+    shards = [pool.shard(room_id) for room_id in rooms]
+
+    assert shards == [pool.shard(room_id) for room_id in rooms]
+    assert min(shards.count(shard) for shard in range(4)) > 150
+
+    # a new shard only takes rooms from the others
+    bigger = mossbot.ShardPool(5)
+    moved = [
+        (old, bigger.shard(room_id))
+        for old, room_id in zip(shards, rooms)
+        if bigger.shard(room_id) != old
+    ]
+
+    assert len(moved) < 350
+    assert all(new == 4 for _, new in moved)
+
+
+def test_shard_pool_processes():
+    pool = mossbot.ShardPool(2)
+
+    def work(events, replies):
+        while True:
+            item = events.recv()
+            if item is None:
+                return
+            replies.send((item[0], os.getpid()))
+
+    pool.start(work)
+    try:
+        for i in range(20):
+            pool.submit(f'!room{i}:foo.tld', {})
+
+        replies = []
+        for _ in range(100):
+            replies.extend(pool.receive(0.1))
+            if len(replies) == 20:
+                break
+    finally:
+        pool.stop()
+
+    pids = dict(replies)
+
+    assert len(replies) == 20
+    assert len(set(pids.values())) == 2
+    assert all(
+        pids[f'!room{i}:foo.tld'] == pids[f'!room{j}:foo.tld']
+        for i in range(20) for j in range(20)
+        if pool.shard(f'!room{i}:foo.tld') == pool.shard(f'!room{j}:foo.tld')
+    )
+    assert not any(process.is_alive() for process in pool.processes)
+
+
+def echo_shard(events, replies):
+    while True:
+        item = events.recv()
+        if item is None:
+            return
+        replies.send((item[0], os.getpid()))
+
+
+def test_shard_pool_shard_ended():
+    ended = threading.Event()
+    pool = mossbot.ShardPool(2)
+    pool.start(echo_shard, ended.set)
+
+    try:
+        dead = pool.processes[pool.shard('!a:foo.tld')]
+        dead.terminate()
+        dead.join()
+
+        assert pool.submit('!a:foo.tld', {}) is True
+        assert ended.wait(5) is True
+
+        # the other shard keeps going, the dead one is not forked again
+        rooms = [f'!room{i}:foo.tld' for i in range(20)]
+        alive = [
+            room for room in rooms
+            if pool.processes[pool.shard(room)] is not dead
+        ]
+        assert pool.submit(alive[0], {}) is True
+
+        replies = []
+        for _ in range(100):
+            replies.extend(pool.receive(0.1))
+            if replies:
+                break
+    finally:
+        pool.stop()
+
+    assert [room for room, _ in replies] == [alive[0]]
+    assert dead in pool.processes
+
+
+def test_shard_pool_busy():
+    pool = mossbot.ShardPool(1, max_pending=2)
+    # a feeder that never gets to send
+    pool.feeders[0] = mock.Mock()
+
+    assert pool.submit('!a:foo.tld', {}) is True
+    assert pool.submit('!a:foo.tld', {}) is True
+    assert pool.submit('!a:foo.tld', {}) is False
+
+
+def test_on_message_shards(config, room):
+    config['shards'] = 2
+    handler = mossbot.MatrixHandler(config)
+    handler.client = mock.Mock()
+    handler.client.rooms = {room.room_id: room}
+
+    handler.shards.start(handler.work_shard)
+    handler.start_reply_reader()
+
+    try:
+        handler.on_message(
+            room,
+            {
+                'room_id': room.room_id,
+                'content': {'msgtype': 'm.text', 'body': '!ping'},
+                'sender': '@bar:foo.tld',
+            }
+        )
+
+        for _ in range(500):
+            if handler.client.api.send_message_event.called:
+                break
+            time.sleep(0.01)
+    finally:
+        handler.shards.stop()
+
+    # stored and served by the shard, sent from here
+    assert handler.history.messages(room.room_id, '@bar:foo.tld') == [
+        '!ping'
+    ]
+    assert handler.client.api.send_message_event.call_args[0][2][
+        'msgtype'] == 'm.notice'
+
+
+def test_matrix_handler_shards_need_sqlite(config):
+    config['shards'] = 2
+    config['history_backend'] = 'memory'
+
+    with pytest.raises(ValueError):
+        mossbot.MatrixHandler(config)
+
+
+@mock.patch('mossbot.MatrixHandler.handle_message')
+@mock.patch('mossbot.MatrixHandler.store_msg')
+def test_on_message_submits_to_workers(
+        store_msg_mock,
+        handle_message_mock,
+        matrix_handler,
+        room
+):
+    matrix_handler.workers = mossbot.RoomWorkers(workers=2)
+
+    event = {
+        'content': {
+            'msgtype': 'm.text',
+            'body': 'Foo Bar'
+        },
+        'sender': '@bar:foo.tld'
+    }
+
+    matrix_handler.on_message(room, event)
+    matrix_handler.workers.shutdown()
+
+    store_msg_mock.assert_called_with(event)
+    handle_message_mock.assert_called_with(room, event)
+
+
+def test_on_message_replace_sees_earlier_msgs(matrix_handler, room):
+    matrix_handler.workers = mossbot.RoomWorkers(workers=2)
+
+    # the room is busy while the msgs come in
+    release = threading.Event()
+    matrix_handler.workers.submit(room.room_id, release.wait, 5)
+
+    for body in ('I like cats', 's/cats/dogs', 'unrelated cats follow up'):
+        matrix_handler.on_message(
+            room,
+            {
+                'room_id': room.room_id,
+                'content': {'msgtype': 'm.text', 'body': body},
+                'sender': '@a:foo.tld',
+            }
+        )
+
+    release.set()
+    matrix_handler.workers.shutdown()
+    matrix_handler.outbox.flush(5)
+
+    matrix_handler.client.api.send_message_event.assert_called_once_with(
+        room.room_id,
+        'm.room.message',
+        {
+            'msgtype': 'm.text',
+            'format': 'org.matrix.custom.html',
+            'body': mock.ANY,
+            'formatted_body': '<i><b>@a:foo.tld</b>: I like dogs</i>',
+        },
+        txn_id=mock.ANY
+    )
+
+
+@mock.patch('mossbot.MatrixHandler.on_message')
+def test_on_event(on_message_mock, matrix_handler, room):
+    matrix_handler.client.rooms = {'!room:foo.tld': room}
+
+    event = {'room_id': '!room:foo.tld', 'content': {}}
+    matrix_handler.on_event(event)
+
+    on_message_mock.assert_called_with(room, event)
+
+
+@mock.patch('matrix_client.client.MatrixClient')
+def test_login_with_password(client_mock, matrix_handler, config):
+    client = client_mock.return_value
+    client.user_id = '@foo:bar.tld'
+    client.api.token = 'token'
+    client.sync_token = 'batch1'
+
+    matrix_handler.login()
+
+    client_mock.assert_called_with('bar.tld')
+    client.login_with_password.assert_called_with('foo', 'bar')
+
+    with open(config['session_path']) as f:
+        assert json.load(f) == {
+            'hostname': 'bar.tld',
+            'username': 'foo',
+            'user_id': '@foo:bar.tld',
+            'access_token': 'token',
+            'next_batch': 'batch1',
+        }
+
+    assert os.stat(config['session_path']).st_mode & 0o777 == 0o600
+
+
+@mock.patch('matrix_client.client.MatrixClient')
+def test_login_restore_session(client_mock, matrix_handler, config):
+    with open(config['session_path'], 'w') as f:
+        json.dump(
+            {
+                'hostname': 'bar.tld',
+                'username': 'foo',
+                'user_id': '@foo:bar.tld',
+                'access_token': 'token',
+                'next_batch': 'batch1',
+            },
+            f
+        )
+
+    matrix_handler.login()
+
+    client = client_mock.return_value
+    client.login_with_password.assert_not_called()
+
+    assert client.api.token == 'token'
+    assert client.user_id == '@foo:bar.tld'
+    assert client.sync_token == 'batch1'
+
+    # nothing changed, nothing to write
+    with mock.patch('mossbot.write_json') as write_json_mock:
+        matrix_handler.save_session()
+
+    write_json_mock.assert_not_called()
+
+
+@pytest.mark.parametrize('content', [
+    '{"hostname": "other.tld", "username": "foo"}',
+    '{"hostname": "bar.tld", "username": "other"}',
+    'no json',
+])
+def test_load_session_invalid(content, matrix_handler, config):
+    with open(config['session_path'], 'w') as f:
+        f.write(content)
+
+    assert matrix_handler.load_session() is None
+
+
+def test_load_session_disabled(matrix_handler):
+    matrix_handler.session_path = None
+
+    assert matrix_handler.load_session() is None
+
+
+def test_listen_forever_drains(matrix_handler, room):
+    matrix_handler.client.rooms = {room.room_id: room}
+    matrix_handler.workers = mossbot.RoomWorkers(workers=2)
+
+    def sync(timeout_ms):
+        matrix_handler.workers.submit(
+            room.room_id,
+            matrix_handler.send_reply,
+            room,
+            mossbot.MSG_RETURN('notice', 'foo'),
+        )
+        matrix_handler.stop_sync.set()
+
+    matrix_handler.client._sync.side_effect = sync
+
+    assert matrix_handler.listen_forever() is None
+
+    # sent before the sync process ends
+    matrix_handler.client.api.send_message_event.assert_called_with(
+        room.room_id,
+        'm.room.message',
+        {'msgtype': 'm.notice', 'body': 'foo'},
+        txn_id=mock.ANY
+    )
+
+
+def test_listen_forever_saves_seen_events(matrix_handler, tmpdir):
+    path = tmpdir.join('seen.json').strpath
+    matrix_handler.seen_events = mossbot.TTLCache(
+        path=path,
+        save_interval=3600.0
+    )
+
+    def sync(timeout_ms):
+        matrix_handler.seen_events.set('$foo:bar.tld', True)
+        matrix_handler.stop_sync.set()
+
+    matrix_handler.client._sync.side_effect = sync
+
+    with mock.patch('mossbot.MatrixHandler.drain'):
+        matrix_handler.listen_forever()
+
+    # written before the process ends, without drain
+    assert mossbot.TTLCache(path=path).get('$foo:bar.tld') is True
+
+
+def test_send_queue_txn_ids_per_process():
+    sent = []
+    outbox = mossbot.SendQueue(lambda *args: sent.append(args[2]))
+
+    reader, writer = mossbot.Pipe(duplex=False)
+
+    def child():
+        outbox.put('!a', {'msgtype': 'm.text', 'body': 'foo'})
+        outbox.flush(5)
+        writer.send(sent)
+
+    process = mossbot.Process(target=child)
+    process.start()
+    child_sent = reader.recv()
+    process.join()
+
+    child()
+    assert len(set(child_sent + sent)) == 2
+
+
+@mock.patch('mossbot.logger')
+def test_listen_forever_token_rejected(logger_mock, matrix_handler, config):
+    with open(config['session_path'], 'w') as f:
+        f.write('{}')
+
+    matrix_handler.client._sync.side_effect = mossbot.MatrixRequestError(
+        401,
+        'M_UNKNOWN_TOKEN'
+    )
+
+    assert matrix_handler.listen_forever() is None
+
+    assert not os.path.exists(config['session_path'])
+    assert logger_mock.error.called is True
+
+
+@mock.patch('mossbot.logger')
+def test_listen_async_token_rejected(logger_mock, matrix_handler, config):
+    with open(config['session_path'], 'w') as f:
+        f.write('{}')
+
+    matrix_handler.client._sync.side_effect = mossbot.MatrixRequestError(
+        401,
+        'M_UNKNOWN_TOKEN'
+    )
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(matrix_handler.listen_async()) is None
+    finally:
+        loop.close()
+
+    assert not os.path.exists(config['session_path'])
+    assert logger_mock.error.called is True
+
+
+@mock.patch('mossbot.MatrixHandler.listen_async')
+@mock.patch('mossbot.MatrixHandler.login')
+def test_run_async_reconnects(login_mock, listen_async_mock, matrix_handler):
+    clients = []
+
+    def login():
+        matrix_handler.client = mock.Mock()
+        clients.append(matrix_handler.client)
+
+    async def listen_async():
+        if len(clients) == 2:
+            raise asyncio.CancelledError()
+
+    login_mock.side_effect = login
+    listen_async_mock.side_effect = listen_async
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(matrix_handler.run_async())
+    finally:
+        loop.close()
+
+    assert len(clients) == 2
+
+    # every new client gets the listeners
+    for client in clients:
+        client.add_listener.assert_called_with(
+            matrix_handler.on_event,
+            'm.room.message'
+        )
+        client.add_invite_listener.assert_called_with(
+            matrix_handler.on_invite
+        )
+
+
+def test_account_configs(config):
+    assert mossbot.account_configs(config) == [config]
+
+    config['accounts'] = [
+        {'username': 'one', 'uid': '@one:foo.tld'},
+        {
+            'username': 'two',
+            'uid': '@two:bar.tld',
+            'hostname': 'baz.tld',
+            'session_path': 'two.json',
+        },
+    ]
+
+    one, two = mossbot.account_configs(config)
+
+    assert 'accounts' not in one
+    assert one['engine'] == two['engine'] == 'asyncio'
+    assert one['hostname'] == 'bar.tld'
+    assert two['hostname'] == 'baz.tld'
+    assert one['giphy_api_key'] == two['giphy_api_key'] == 'f00b4r'
+
+    assert one['history_path'].endswith('db.one_foo_tld.sqlite')
+    assert two['history_path'].endswith('db.two_bar_tld.sqlite')
+    assert one['session_path'].endswith('session.one_foo_tld.json')
+    assert two['session_path'] == 'two.json'
+
+
+def test_account_configs_default_paths():
+    one, two = mossbot.account_configs(
+        {
+            'accounts': [
+                {'username': 'one', 'uid': '@one:foo.tld'},
+                {'username': 'two', 'uid': '@two:foo.tld'},
+            ],
+            'history_journal_path': 'journal',
+        }
+    )
+
+    assert one['history_path'] == 'db.one_foo_tld.sqlite'
+    assert two['history_path'] == 'db.two_foo_tld.sqlite'
+    assert one['session_path'] == 'session.one_foo_tld.json'
+    assert two['session_path'] == 'session.two_foo_tld.json'
+    assert one['history_journal_path'] == 'journal.one_foo_tld'
+    assert 'seen_events_path' not in one
+
+    assert mossbot.account_configs(
+        {
+            'accounts': [{'uid': '@one:foo.tld'}],
+            'history_backend': 'memory',
+        }
+    )[0]['history_path'] == 'history.one_foo_tld.json'
+
+
+@mock.patch('mossbot.time.sleep')
+@mock.patch('mossbot.MatrixHandler.start_listener_process')
+@mock.patch('mossbot.MatrixHandler.login')
+def test_connect_backoff(login_mock, start_mock, sleep_mock, matrix_handler):
+    matrix_handler.sync_process = mock.Mock()
+    matrix_handler.sync_process.is_alive.return_value = False
+
+    sleep_mock.side_effect = [None, None, None, KeyboardInterrupt]
+
+    with pytest.raises(SystemExit):
+        matrix_handler.connect()
+
+    assert sleep_mock.call_args_list == [
+        mock.call(1.0),
+        mock.call(2.0),
+        mock.call(4.0),
+        mock.call(8.0),
+    ]
+
+
+def test_connect_all(config):
+    loops = []
+
+    async def run_async():
+        loops.append(asyncio.get_event_loop())
+
+    handlers = [mock.Mock(), mock.Mock()]
+    for handler in handlers:
+        handler.run_async = run_async
+
+    mossbot.connect_all(handlers, config)
+
+    assert len(loops) == 2
+    assert loops[0] is loops[1]
+    assert handlers[0].serve_metrics.called is True
+    assert handlers[1].serve_metrics.called is False
+
+
+def test_connect_all_shard_ended(config):
+    async def run_async():
+        await asyncio.sleep(10)
+
+    handler = mock.Mock()
+    handler.run_async = run_async
+    handler.shards.start.side_effect = lambda work, on_end: on_end()
+
+    with pytest.raises(SystemExit) as e:
+        mossbot.connect_all([handler], config)
+
+    assert e.value.code == 1
+    assert handler.serve_metrics.called is True
+
+
 @pytest.mark.parametrize('response,expected', [
     (
         {
@@ -315,16 +1958,16 @@ def test_on_message_reaction(
         None
     )
 ])
-@mock.patch('mossbot.requests')
-def test_get_giphy_reaction_url(requests_mock, response, expected):
-    requests_mock.get.return_value.json.return_value = response
+@mock.patch('mossbot.HTTP')
+def test_get_giphy_reaction_url(http_mock, response, expected):
+    http_mock.get.return_value.json.return_value = response
 
     assert mossbot.get_giphy_reaction_url(
         'f00b4r',
         'it crowd'
     ) == expected
 
-    requests_mock.get.assert_called_with(
+    http_mock.get.assert_called_with(
         (
             'http://api.giphy.com/v1/gifs/search'
             '?api_key=f00b4r&q=it+crowd&limit=20'
@@ -332,11 +1975,45 @@ def test_get_giphy_reaction_url(requests_mock, response, expected):
     )
 
 
-@mock.patch('mossbot.requests')
-def test_get_giphy_reaction_url_exception(requests_mock):
-    requests_mock.get.side_effect = Exception
+@mock.patch('mossbot.HTTP')
+def test_get_giphy_reaction_url_exception(http_mock):
+    http_mock.get.side_effect = Exception
 
     assert mossbot.get_giphy_reaction_url('f00b4r', 'it crowd') is None
+    assert mossbot.MEDIA.get(('giphy', 'it crowd')) is mossbot.MISSING
+
+
+@mock.patch('mossbot.HTTP')
+def test_get_giphy_reaction_url_cached(http_mock):
+    http_mock.get.return_value.json.return_value = {
+        'data': [
+            {'images': {'downsized': {'url': f'https://foo.tld/{i}.gif?x'}}}
+            for i in range(3)
+        ]
+    }
+
+    urls = {
+        mossbot.get_giphy_reaction_url('f00b4r', term, 60)
+        for term in ('it crowd', 'IT  Crowd', ' it crowd') * 10
+    }
+
+    assert urls <= {f'https://foo.tld/{i}.gif' for i in range(3)}
+    assert http_mock.get.call_count == 1
+    assert http_mock.get.return_value.json.call_count == 1
+
+    expires, _ = mossbot.MEDIA.load()[('giphy', 'it crowd')]
+    assert 0 < expires - time.time() <= 60
+
+
+@mock.patch('mossbot.HTTP')
+def test_get_giphy_reaction_url_not_found_cached(http_mock):
+    http_mock.get.return_value.json.return_value = {'data': []}
+
+    for _ in range(3):
+        assert mossbot.get_giphy_reaction_url('f00b4r', 'nothing') is None
+
+    assert http_mock.get.call_count == 1
+    assert mossbot.MEDIA.get(('giphy', 'nothing')) is None
 
 
 @mock.patch('mossbot.MatrixHandler.store_msg')
@@ -355,11 +2032,18 @@ def test_on_message_text(moss_mock, store_msg_mock, matrix_handler, room):
         'Foo Bar'
     )
 
-    moss_mock.serve.return_value = msg
+    moss_mock.serve_all.return_value = [msg]
 
     matrix_handler.on_message(room, event)
 
-    room.send_text.assert_called_with('Foo Bar')
+    matrix_handler.outbox.flush(5)
+
+    matrix_handler.client.api.send_message_event.assert_called_with(
+        '!room:foo.tld',
+        'm.room.message',
+        {'msgtype': 'm.text', 'body': 'Foo Bar'},
+        txn_id=mock.ANY
+    )
 
     store_msg_mock.assert_called_with(event)
 
@@ -380,11 +2064,18 @@ def test_on_message_notice(moss_mock, store_msg_mock, matrix_handler, room):
         'Foo Bar'
     )
 
-    moss_mock.serve.return_value = msg
+    moss_mock.serve_all.return_value = [msg]
 
     matrix_handler.on_message(room, event)
 
-    room.send_notice.assert_called_with('Foo Bar')
+    matrix_handler.outbox.flush(5)
+
+    matrix_handler.client.api.send_message_event.assert_called_with(
+        '!room:foo.tld',
+        'm.room.message',
+        {'msgtype': 'm.notice', 'body': 'Foo Bar'},
+        txn_id=mock.ANY
+    )
 
     store_msg_mock.assert_called_with(event)
 
@@ -402,18 +2093,28 @@ def test_on_message_html(moss_mock, store_msg_mock, matrix_handler):
 
     msg = mossbot.MSG_RETURN(
         'html',
-        'Foo Bar'
+        '<b>Foo</b> Bar'
     )
 
-    moss_mock.serve.return_value = msg
+    moss_mock.serve_all.return_value = [msg]
 
     room_mock = mock.Mock()
     room_mock.room_id = '!foobar:foo.tld'
-    room_mock.client.api.get_html_content.return_value = 'HTML'
 
     matrix_handler.on_message(room_mock, event)
+    matrix_handler.outbox.flush(5)
 
-    room_mock.send_html.assert_called_with('Foo Bar')
+    matrix_handler.client.api.send_message_event.assert_called_with(
+        '!foobar:foo.tld',
+        'm.room.message',
+        {
+            'msgtype': 'm.text',
+            'body': 'Foo Bar',
+            'format': 'org.matrix.custom.html',
+            'formatted_body': '<b>Foo</b> Bar',
+        },
+        txn_id=mock.ANY
+    )
 
     store_msg_mock.assert_called_with(event)
 
@@ -443,7 +2144,7 @@ def test_on_message_skip(
         None
     )
 
-    moss_mock.serve.return_value = msg
+    moss_mock.serve_all.return_value = [msg]
 
     matrix_handler.on_message(room, event)
 
@@ -463,14 +2164,16 @@ def test_on_message_skip(
             'content-type': 'image/gif',
             'height': 100,
             'width': 200,
-            'image': 'gif_image'
+            'size': 300,
+            'sha256': 'abc',
         }
     ),
     (
         {
             'height': 100,
             'width': 200,
-            'image': 'gif_image'
+            'size': 300,
+            'sha256': 'abc',
         }
     ),
 ])
@@ -482,6 +2185,8 @@ def test_write_media(
         matrix_handler,
         room,
 ):
+    gif = BytesIO(b'gif_image')
+    image_data['image'] = gif
     get_image_mock.return_value = image_data
 
     matrix_handler.client.upload.return_value = 'succ_uploaded'
@@ -492,17 +2197,64 @@ def test_write_media(
         'http://foo.bar/image.gif'
     ) is None
 
-    matrix_handler.client.upload.assert_called_with(
-        'gif_image',
-        'image/gif'
-    )
+    matrix_handler.client.upload.assert_called_with(
+        gif,
+        'image/gif'
+    )
+
+    matrix_handler.outbox.flush(5)
+
+    matrix_handler.client.api.send_message_event.assert_called_with(
+        '!room:foo.tld',
+        'm.room.message',
+        {
+            'msgtype': 'm.image',
+            'url': 'succ_uploaded',
+            'body': 'image.gif',
+            'info': {'h': 100, 'mimetype': 'image/gif', 'size': 300, 'w': 200},
+        },
+        txn_id=mock.ANY
+    )
+
+    assert gif.closed is True
+
+
+@mock.patch('mossbot.get_image')
+def test_write_media_cached(get_image_mock, matrix_handler, room):
+    get_image_mock.side_effect = lambda url, max_bytes: {
+        'content-type': 'image/gif',
+        'height': 100,
+        'width': 200,
+        'size': 300,
+        'sha256': 'abc',
+        'image': BytesIO(b'gif_image'),
+    }
+
+    matrix_handler.client.upload.return_value = 'mxc://foo.tld/abc'
+
+    # same url twice and the same content from another url
+    for url in (
+            'http://foo.bar/image.gif',
+            'http://foo.bar/image.gif',
+            'http://foo.bar/other.gif',
+    ):
+        matrix_handler.write_media('image', room, url)
+
+    assert get_image_mock.call_count == 2
+    assert matrix_handler.client.upload.call_count == 1
+
+    matrix_handler.outbox.flush(5)
 
-    room.send_image.assert_called_with(
-        'succ_uploaded',
-        'image.gif',
-        h=100,
-        mimetype='image/gif',
-        w=200
+    matrix_handler.client.api.send_message_event.assert_called_with(
+        '!room:foo.tld',
+        'm.room.message',
+        {
+            'msgtype': 'm.image',
+            'url': 'mxc://foo.tld/abc',
+            'body': 'other.gif',
+            'info': {'h': 100, 'mimetype': 'image/gif', 'size': 300, 'w': 200},
+        },
+        txn_id=mock.ANY
     )
 
 
@@ -517,13 +2269,21 @@ def test_write_media_no_image_data(
 ):
     get_image_mock.return_value = None
 
-    assert matrix_handler.write_media(
-        'image',
-        room,
+    for _ in range(2):
+        assert matrix_handler.write_media(
+            'image',
+            room,
+            'http://foo.bar/image.gif'
+        ) is None
+
+    logger_mock.error.assert_any_call('got no image_data')
+    logger_mock.error.assert_called_with(
+        'no image to send for %s',
         'http://foo.bar/image.gif'
-    ) is None
+    )
 
-    logger_mock.error.assert_called_with('got no image_data')
+    assert get_image_mock.call_count == 1
+    assert matrix_handler.outbox.queues == {}
 
 
 @mock.patch('mossbot.logger')
@@ -540,48 +2300,85 @@ def test_write_media_not_image(logger_mock, config, matrix_handler, room):
     )
 
 
-@mock.patch('mossbot.BytesIO')
+@pytest.mark.parametrize('headers,content_type', [
+    ({'Content-Type': 'image/gif'}, 'image/gif'),
+    ({}, 'image/gif'),
+])
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.Image')
-@mock.patch('mossbot.requests')
+@mock.patch('mossbot.HTTP')
 def test_get_image_200(
-        requests_mock,
-        image_mock,
+        http_mock,
         logger_mock,
-        bytesio_mock,
+        headers,
+        content_type,
+        gif_image,
 ):
-    requests_mock.get.return_value.status_code = 200
-    requests_mock.get.return_value.content = 'foo'
-    requests_mock.get.return_value.headers = {'Content-Type': 'image/gif'}
-
-    gif = BytesIO()
-    bytesio_mock.return_value = gif
-
-    image_mock.open.return_value.width = 200
-    image_mock.open.return_value.height = 100
-
-    assert mossbot.get_image('http://foo.bar/test.gif') == {
-        'content-type': 'image/gif',
-        'image': gif,
-        'width': 200,
-        'height': 100,
+    data = gif_image.read()
+
+    http_mock.get.return_value.status_code = 200
+    http_mock.get.return_value.headers = headers
+    http_mock.get.return_value.iter_content.return_value = [
+        data[:10],
+        data[10:],
+    ]
+
+    image_data = mossbot.get_image('http://foo.bar/test.gif')
+    img = image_data.pop('image')
+
+    assert image_data == {
+        'content-type': content_type,
+        'width': 50,
+        'height': 50,
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest(),
     }
+    assert img.read() == data
 
     logger_mock.info.assert_called_with(
         'downloading image: %s',
         'http://foo.bar/test.gif'
     )
 
-    requests_mock.get.assert_called_with('http://foo.bar/test.gif')
+    http_mock.get.assert_called_with('http://foo.bar/test.gif', stream=True)
+    assert http_mock.get.return_value.close.called is True
+
+
+@pytest.mark.parametrize('headers,chunks,error', [
+    (
+        {'Content-Length': '11'},
+        [],
+        "('image too big %s', '11')"
+    ),
+    (
+        {},
+        [b'GIF89a', b'12345'],
+        "('image too big %s', 11)"
+    ),
+    (
+        {},
+        [b'no image'],
+        'could not read image header'
+    ),
+])
+@mock.patch('mossbot.logger')
+@mock.patch('mossbot.HTTP')
+def test_get_image_invalid(http_mock, logger_mock, headers, chunks, error):
+    http_mock.get.return_value.status_code = 200
+    http_mock.get.return_value.headers = headers
+    http_mock.get.return_value.iter_content.return_value = chunks
+
+    assert mossbot.get_image('http://foo.bar/test.gif', max_bytes=10) is None
 
-    bytesio_mock.assert_called_with('foo')
+    logger_mock.error.assert_called_with(
+        'could not download and analyze img: %s',
+        error
+    )
 
 
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.Image')
-@mock.patch('mossbot.requests')
-def test_get_image_wrong_status_code(requests_mock, image_mock, logger_mock):
-    requests_mock.get.return_value.status_code = 404
+@mock.patch('mossbot.HTTP')
+def test_get_image_wrong_status_code(http_mock, logger_mock):
+    http_mock.get.return_value.status_code = 404
 
     assert mossbot.get_image('http://foo.bar/test.gif') is None
 
@@ -592,9 +2389,9 @@ def test_get_image_wrong_status_code(requests_mock, image_mock, logger_mock):
 
 
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.requests')
-def test_get_image_exception(requests_mock, logger_mock):
-    requests_mock.get.side_effect = KeyError('problem')
+@mock.patch('mossbot.HTTP')
+def test_get_image_exception(http_mock, logger_mock):
+    http_mock.get.side_effect = KeyError('problem')
 
     assert mossbot.get_image('http://foo.bar/test.gif') is None
 
@@ -610,15 +2407,11 @@ def test_get_image_exception(requests_mock, logger_mock):
                 'msgtype': 'm.text',
                 'body': 'Foo Bar'
             },
+            'room_id': '!room:foo.tld',
             'sender': '@bar:foo.tld'
         },
         [],
-        [
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Foo Bar',
-            }
-        ]
+        ['Foo Bar']
     ),
     (
         {
@@ -626,122 +2419,43 @@ def test_get_image_exception(requests_mock, logger_mock):
                 'msgtype': 'm.text',
                 'body': 'Message 12'
             },
+            'room_id': '!room:foo.tld',
             'sender': '@bar:foo.tld'
         },
-        [
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 1',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 2',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 3',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 4',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 5',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 6',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 7',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 8',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 9',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 10',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 11',
-            },
-        ],
-        [
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 3',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 4',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 5',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 6',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 7',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 8',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 9',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 10',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 11',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 12',
-            },
-        ]
-
+        ['Message {}'.format(i) for i in range(1, 12)],
+        ['Message {}'.format(i) for i in range(3, 13)],
     )
 ])
 def test_store_msg(event, db_prefill, db_all, matrix_handler):
     # prepare db
     for prefill in db_prefill:
-        matrix_handler.db.table('msgs').insert(prefill)
+        matrix_handler.history.store(
+            '!room:foo.tld',
+            '@bar:foo.tld',
+            prefill
+        )
 
     # try to store event
     matrix_handler.store_msg(event)
 
-    assert matrix_handler.db.table('msgs').all() == db_all
+    stored = matrix_handler.history.messages('!room:foo.tld', '@bar:foo.tld')
+
+    assert stored == db_all
 
-    assert len(matrix_handler.db.table('msgs').all()) <= 10
+    assert len(stored) <= 10
 
 
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.MatrixHandler.db')
-def test_store_msg_exception(db_mock, logger_mock, matrix_handler):
-    db_mock.table.side_effect = KeyError('problem')
+@mock.patch('mossbot.MatrixHandler.history')
+def test_store_msg_exception(history_mock, logger_mock, matrix_handler):
+    history_mock.store.side_effect = KeyError('problem')
 
     event = {
         'content': {
             'msgtype': 'm.text',
             'body': 'Foo Bar'
         },
+        'room_id': '!room:foo.tld',
         'sender': '@bar:foo.tld'
     }
 
@@ -755,6 +2469,94 @@ def test_store_msg_exception(db_mock, logger_mock, matrix_handler):
     logger_mock.exception.assert_called_with('could not store msg')
 
 
+@pytest.mark.parametrize('backend', ['sqlite', 'memory'])
+def test_history_separates_rooms_and_senders(backend, tmpdir):
+    history = mossbot.get_history(
+        {
+            'history_backend': backend,
+            'history_path': tmpdir.join('history').strpath,
+        }
+    )
+
+    for i in range(15):
+        history.store('!a:foo.tld', '@bar:foo.tld', 'bar {}'.format(i))
+        history.store('!a:foo.tld', '@baz:foo.tld', 'baz {}'.format(i))
+        history.store('!b:foo.tld', '@bar:foo.tld', 'other {}'.format(i))
+
+    assert history.messages('!a:foo.tld', '@bar:foo.tld') == [
+        'bar {}'.format(i) for i in range(5, 15)
+    ]
+    assert history.messages('!b:foo.tld', '@bar:foo.tld')[-1] == 'other 14'
+    assert history.messages('!c:foo.tld', '@bar:foo.tld') == []
+
+
+def test_sqlite_history_persists(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+
+    mossbot.SQLiteHistory(path).store('!a:foo.tld', '@bar:foo.tld', 'foo')
+
+    assert mossbot.SQLiteHistory(path).messages(
+        '!a:foo.tld',
+        '@bar:foo.tld'
+    ) == ['foo']
+
+
+def test_sqlite_history_symbols(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+
+    history = mossbot.SQLiteHistory(path)
+    history.store_many(
+        [
+            mossbot.HISTORY_MSG('!a:foo.tld', f'@user{i % 3}:foo.tld', 'foo')
+            for i in range(30)
+        ]
+    )
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT COUNT(*) FROM symbols').fetchone() == (4, )
+    assert conn.execute(
+        'SELECT typeof(room), typeof(sender) FROM messages'
+    ).fetchall() == [('integer', 'integer')] * 30
+
+    assert history.messages('!b:foo.tld', '@user0:foo.tld') == []
+    assert conn.execute('SELECT COUNT(*) FROM symbols').fetchone() == (4, )
+
+
+def test_memory_history_snapshot(tmpdir):
+    path = tmpdir.join('history.json').strpath
+
+    history = mossbot.MemoryHistory(path, limit=2, interval=3600)
+    history.store('!a:foo.tld', '@bar:foo.tld', 'foo')
+
+    assert not tmpdir.join('history.json').check()
+
+    history.store('!a:foo.tld', '@bar:foo.tld', 'bar')
+    history.store('!a:foo.tld', '@bar:foo.tld', 'baz')
+    history.snapshot()
+
+    assert mossbot.MemoryHistory(path, limit=2).messages(
+        '!a:foo.tld',
+        '@bar:foo.tld'
+    ) == ['bar', 'baz']
+
+
+def test_memory_history_snapshot_symbols(tmpdir):
+    path = tmpdir.join('history.json')
+
+    history = mossbot.MemoryHistory(path.strpath, interval=3600)
+    for i in range(4):
+        history.store('!a:foo.tld', f'@user{i % 2}:foo.tld', f'msg {i}')
+    history.snapshot()
+
+    assert json.loads(path.read()) == {
+        'symbols': ['!a:foo.tld', '@user0:foo.tld', '@user1:foo.tld'],
+        'buffers': [[0, 1, ['msg 0', 'msg 2']], [0, 2, ['msg 1', 'msg 3']]],
+    }
+
+    keys = list(mossbot.MemoryHistory(path.strpath).load())
+    assert keys[0][0] is keys[1][0]
+
+
 @pytest.mark.parametrize('event,db_prefill,expected', [
     (
         {
@@ -762,21 +2564,13 @@ def test_store_msg_exception(db_mock, logger_mock, matrix_handler):
                 'msgtype': 'm.text',
                 'body': 's/Foo Bar/Zick Zack'
             },
+            'room_id': '!room:foo.tld',
             'sender': '@bar:foo.tld'
         },
         [
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Message 1',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 'Dies ist ein Foo Bar',
-            },
-            {
-                'sender': '@bar:foo.tld',
-                'body': 's/Foo Bar/Zick Zack',
-            },
+            'Message 1',
+            'Dies ist ein Foo Bar',
+            's/Foo Bar/Zick Zack',
         ],
         mossbot.MSG_RETURN(
             'html',
@@ -789,13 +2583,11 @@ def test_store_msg_exception(db_mock, logger_mock, matrix_handler):
                 'msgtype': 'm.text',
                 'body': 's/Foo Bar/Zick Zack'
             },
+            'room_id': '!room:foo.tld',
             'sender': '@bar:foo.tld'
         },
         [
-            {
-                'sender': '@bar:foo.tld',
-                'body': 's/Foo Bar/Zick Zack'
-            }
+            's/Foo Bar/Zick Zack'
         ],
         mossbot.MSG_RETURN(
             'skip',
@@ -803,21 +2595,73 @@ def test_store_msg_exception(db_mock, logger_mock, matrix_handler):
         )
     ),
 ])
-@mock.patch('mossbot.get_db')
-def test_replace(get_db_mock, db, event, db_prefill, expected):
+def test_replace(history, event, db_prefill, expected):
     # prepare database
     for prefill in db_prefill:
-        db.table('msgs').insert(prefill)
+        history.store('!room:foo.tld', '@bar:foo.tld', prefill)
 
-    get_db_mock.return_value = db
+    event['recent'] = mossbot.RecentMessages(history)
 
     assert mossbot.MOSS.serve(event) == expected
 
 
+def test_recent_messages_from_memory():
+    history_mock = mock.Mock()
+    recent = mossbot.RecentMessages(history_mock, maxlen=2, max_senders=2)
+
+    recent.add('!a:foo.tld', '@bar:foo.tld', 'foo')
+    recent.add('!a:foo.tld', '@bar:foo.tld', 's/foo/bar')
+    recent.add('!a:foo.tld', '@baz:foo.tld', 'baz')
+
+    assert recent.last('!a:foo.tld', '@bar:foo.tld') == 'foo'
+    assert recent.last('!a:foo.tld', '@baz:foo.tld') == 'baz'
+
+    history_mock.messages.assert_not_called()
+
+    # least recently used sender gets evicted
+    recent.add('!b:foo.tld', '@bar:foo.tld', 'zonk')
+
+    assert list(recent.msgs.keys()) == [
+        ('!a:foo.tld', '@baz:foo.tld'),
+        ('!b:foo.tld', '@bar:foo.tld'),
+    ]
+
+
+def test_recent_messages_fallback(history):
+    history.store('!a:foo.tld', '@bar:foo.tld', 'foo')
+    history.store('!a:foo.tld', '@bar:foo.tld', 's/foo/bar')
+
+    recent = mossbot.RecentMessages(history)
+
+    assert recent.last('!a:foo.tld', '@bar:foo.tld') == 'foo'
+    assert recent.last('!a:foo.tld', '@baz:foo.tld') is None
+
+    history.store('!a:foo.tld', '@bar:foo.tld', 'zonk')
+
+    # served from memory now
+    assert recent.last('!a:foo.tld', '@bar:foo.tld') == 'foo'
+
+
+def test_store_msg_fills_recent(matrix_handler):
+    matrix_handler.store_msg(
+        {
+            'content': {
+                'msgtype': 'm.text',
+                'body': 'Foo Bar'
+            },
+            'room_id': '!room:foo.tld',
+            'sender': '@bar:foo.tld'
+        }
+    )
+
+    assert matrix_handler.recent.msgs[('!room:foo.tld', '@bar:foo.tld')] \
+        == deque(['Foo Bar'])
+
+
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.get_db')
-def test_replace_exception(get_db_mock, logger_mock):
-    get_db_mock.side_effect = KeyError('problem')
+def test_replace_exception(logger_mock):
+    recent_mock = mock.Mock()
+    recent_mock.last.side_effect = KeyError('problem')
 
     assert mossbot.MOSS.serve(
         {
@@ -825,18 +2669,223 @@ def test_replace_exception(get_db_mock, logger_mock):
                 'msgtype': 'm.text',
                 'body': 's/Foo Bar/Zick Zack'
             },
-            'sender': '@bar:foo.tld'
+            'room_id': '!room:foo.tld',
+            'sender': '@bar:foo.tld',
+            'recent': recent_mock,
         }
     ) == mossbot.MSG_RETURN('skip', None)
 
     assert logger_mock.exception.called is True
 
 
-@mock.patch('mossbot.TinyDB')
-def test_get_db(tinydb_mock):
-    mossbot.get_db()
+@pytest.mark.parametrize('config,expected', [
+    ({}, mossbot.SQLiteHistory),
+    ({'history_backend': 'sqlite'}, mossbot.SQLiteHistory),
+    ({'history_backend': 'memory'}, mossbot.MemoryHistory),
+])
+def test_get_history(config, expected):
+    history = mossbot.get_history(config)
+
+    # sqlite gets write-behind batching
+    if isinstance(history, mossbot.WriteBehindHistory):
+        history = history.backend
+
+    assert isinstance(history, expected)
+
+
+def test_get_history_no_write_behind():
+    assert isinstance(
+        mossbot.get_history({'history_write_behind': False}),
+        mossbot.SQLiteHistory
+    )
+
+
+def test_write_behind_history(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+    backend = mossbot.SQLiteHistory(path)
+    history = mossbot.WriteBehindHistory(
+        backend,
+        path + '.journal',
+        batch_size=1000,
+        interval=60,
+    )
+
+    for i in range(15):
+        history.store('!a:foo.tld', '@bar:foo.tld', f'bar {i}')
+
+    # nothing written to the db yet, but readable
+    assert backend.messages('!a:foo.tld', '@bar:foo.tld') == []
+    assert history.messages('!a:foo.tld', '@bar:foo.tld') == [
+        f'bar {i}' for i in range(5, 15)
+    ]
+    assert len(tmpdir.join(f'db.sqlite.journal.{os.getpid()}').readlines()) \
+        == 15
+
+    assert history.flush() == 15
+    assert history.flush() == 0
+
+    assert backend.messages('!a:foo.tld', '@bar:foo.tld') == [
+        f'bar {i}' for i in range(5, 15)
+    ]
+    assert history.messages('!a:foo.tld', '@bar:foo.tld') == [
+        f'bar {i}' for i in range(5, 15)
+    ]
+    assert tmpdir.join(f'db.sqlite.journal.{os.getpid()}').read() == ''
+    assert not tmpdir.join(
+        f'db.sqlite.journal.{os.getpid()}.flushing'
+    ).exists()
+
+
+def test_write_behind_history_batch_size(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+    backend = mossbot.SQLiteHistory(path)
+    history = mossbot.WriteBehindHistory(
+        backend,
+        path + '.journal',
+        batch_size=5,
+        interval=60,
+    )
+
+    for i in range(5):
+        history.store('!a:foo.tld', '@bar:foo.tld', f'bar {i}')
+
+    for _ in range(500):
+        if backend.messages('!a:foo.tld', '@bar:foo.tld'):
+            break
+        time.sleep(0.01)
+
+    assert backend.messages('!a:foo.tld', '@bar:foo.tld') == [
+        f'bar {i}' for i in range(5)
+    ]
+
+
+def test_write_behind_history_recover(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+
+    # journals of an ended process, one batch was being stored
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    tmpdir.join(f'db.sqlite.journal.{dead.pid}.flushing').write(
+        json.dumps(['!a:foo.tld', '@bar:foo.tld', 'foo']) + '\n'
+    )
+    tmpdir.join(f'db.sqlite.journal.{dead.pid}').write(
+        json.dumps(['!a:foo.tld', '@bar:foo.tld', 'bar']) + '\n'
+        '["!a:foo.tld", "@bar:fo'
+    )
+    # a running process keeps its journal
+    tmpdir.join(f'db.sqlite.journal.{os.getppid()}').write(
+        json.dumps(['!a:foo.tld', '@bar:foo.tld', 'baz']) + '\n'
+    )
+
+    history = mossbot.WriteBehindHistory(
+        mossbot.SQLiteHistory(path),
+        path + '.journal',
+    )
+
+    assert history.messages('!a:foo.tld', '@bar:foo.tld') == ['foo', 'bar']
+    assert sorted(i.basename for i in tmpdir.listdir()) == sorted(
+        [
+            'db.sqlite',
+            f'db.sqlite.journal.{os.getpid()}',
+            f'db.sqlite.journal.{os.getppid()}',
+        ]
+    )
+
+
+def test_write_behind_history_recover_claimed(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    # claimed by an ended process, taken over
+    tmpdir.join(
+        f'db.sqlite.journal.{dead.pid}.flushing.recovering.{dead.pid}'
+    ).write(json.dumps(['!a:foo.tld', '@bar:foo.tld', 'foo']) + '\n')
+    # claimed by a running process, left to it
+    tmpdir.join(
+        f'db.sqlite.journal.{dead.pid}.recovering.{os.getppid()}'
+    ).write(json.dumps(['!a:foo.tld', '@bar:foo.tld', 'bar']) + '\n')
+
+    history = mossbot.WriteBehindHistory(
+        mossbot.SQLiteHistory(path),
+        path + '.journal',
+    )
+
+    assert history.messages('!a:foo.tld', '@bar:foo.tld') == ['foo']
+    assert sorted(i.basename for i in tmpdir.listdir()) == sorted(
+        [
+            'db.sqlite',
+            f'db.sqlite.journal.{dead.pid}.recovering.{os.getppid()}',
+            f'db.sqlite.journal.{os.getpid()}',
+        ]
+    )
+
+
+def test_write_behind_history_recover_shared(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    tmpdir.join(f'db.sqlite.journal.{dead.pid}').write(
+        json.dumps(['!a:foo.tld', '@bar:foo.tld', 'foo']) + '\n'
+    )
+
+    histories = [
+        mossbot.WriteBehindHistory(
+            mossbot.SQLiteHistory(path),
+            path + '.journal',
+        )
+        for _ in range(2)
+    ]
+    rename = os.rename
+
+    def claim_first(src, dst):
+        # the other process claims the journal in between
+        rename_mock.side_effect = rename
+        histories[1].pid = os.getpid()
+        histories[1].recover()
+        rename(src, dst)
+
+    with mock.patch('mossbot.os.rename') as rename_mock:
+        rename_mock.side_effect = claim_first
+        histories[0].store('!a:foo.tld', '@bar:foo.tld', 'bar')
+
+    assert histories[0].messages('!a:foo.tld', '@bar:foo.tld') == [
+        'foo',
+        'bar'
+    ]
+
+
+def test_write_behind_history_recover_same_process(tmpdir):
+    path = tmpdir.join('db.sqlite').strpath
+
+    histories = [
+        mossbot.WriteBehindHistory(
+            mossbot.SQLiteHistory(path),
+            path + '.journal',
+            interval=3600.0,
+        )
+        for _ in range(2)
+    ]
+
+    histories[0].store('!a:foo.tld', '@bar:foo.tld', 'one')
+    # the journal of the first one is left alone
+    histories[1].store('!a:foo.tld', '@bar:foo.tld', 'two')
 
-    tinydb_mock.assert_called_with('db.json')
+    assert mossbot.SQLiteHistory(path).messages(
+        '!a:foo.tld',
+        '@bar:foo.tld'
+    ) == []
+
+
+def test_history_abstract():
+    with pytest.raises(TypeError):
+        mossbot.History()  # pylint: disable=abstract-class-instantiated
+
+
+def test_get_history_unknown():
+    with pytest.raises(ValueError):
+        mossbot.get_history({'history_backend': 'foo'})
 
 
 @pytest.mark.parametrize('return_data,expected', [
@@ -871,9 +2920,9 @@ def test_get_db(tinydb_mock):
         )
     )
 ])
-@mock.patch('mossbot.requests')
-def test_weather(requests_mock, return_data, expected, config):
-    requests_mock.get.return_value.json.return_value = return_data
+@mock.patch('mossbot.HTTP')
+def test_weather(http_mock, return_data, expected, config):
+    http_mock.get.return_value.json.return_value = return_data
 
     event = {
         'content': {
@@ -889,9 +2938,9 @@ def test_weather(requests_mock, return_data, expected, config):
 
 
 @mock.patch('mossbot.logger')
-@mock.patch('mossbot.requests')
-def test_weather_exception(requests_mock, logger_mock, config):
-    requests_mock.get.side_effect = Exception('foo bar')
+@mock.patch('mossbot.HTTP')
+def test_weather_exception(http_mock, logger_mock, config):
+    http_mock.get.side_effect = Exception('foo bar')
 
     event = {
         'content': {
@@ -909,3 +2958,85 @@ def test_weather_exception(requests_mock, logger_mock, config):
     )
 
     assert logger_mock.exception.called is True
+
+
+@mock.patch('mossbot.HTTP')
+def test_weather_cached(http_mock, config):
+    http_mock.get.return_value.json.side_effect = [
+        {
+            'weather': [{'main': 'Fog'}],
+            'main': {'temp': 20},
+            'name': 'Wolfsburg',
+            'cod': 200,
+        },
+        {'cod': '404'},
+    ]
+
+    def ask(city):
+        return mossbot.MOSS.serve(
+            {
+                'content': {'msgtype': 'm.text', 'body': f'!weather {city}'},
+                'sender': '@bar:foo.tld',
+                'config': config,
+            }
+        )
+
+    for city in ('Wolfsburg', 'wolfsburg', '  WOLFSBURG '):
+        assert ask(city).type == 'html'
+
+    for city in ('Atlantis', 'atlantis'):
+        assert ask(city) == mossbot.MSG_RETURN(
+            'notice',
+            f'could not find city {city}'
+        )
+
+    assert http_mock.get.call_count == 2
+    assert mossbot.WEATHER.get('wolfsburg')['city'] == 'Wolfsburg'
+    assert mossbot.WEATHER.get('atlantis') is None
+
+
+def test_single_flight():
+    flights = mossbot.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def lookup(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return value * 2
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(flights.do('foo', lookup, 21))
+        )
+        for _ in range(5)
+    ]
+
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [21]
+    assert results == [42] * 5
+    assert flights.calls == {}
+
+
+def test_single_flight_exception():
+    flights = mossbot.SingleFlight()
+
+    def fail():
+        raise KeyError('foo')
+
+    with pytest.raises(KeyError):
+        flights.do('foo', fail)
+
+    assert flights.do('foo', lambda: 'bar') == 'bar'